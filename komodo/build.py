@@ -1,15 +1,17 @@
 #!/usr/bin/env python
 
-import hashlib
+import contextlib
 import os
 import re
 import stat
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Mapping, Optional, Set
 
-import requests
-
-from komodo.shell import pushd, shell
+from komodo.build_cache import BuildCache, build_keys, source_digest
+from komodo.downloader import downloader
+from komodo.scheduler import build_order, run_in_dependency_order
+from komodo.shell import shell
+from komodo.tracing import span
 
 # When running cmake we pass the option -DDEST_PREFIX=fakeroot, this is an
 # absolute hack to be able to build opm-common and sunbeam with the ~fakeroot
@@ -32,7 +34,16 @@ def cmake(
     ld_lib_path=None,
     bin_path=None,
     cmake="cmake",
+    *,
+    log_file=None,
+    install_context=None,
 ):
+    """Configure, compile and install a cmake package into fakeroot.
+
+    If install_context is given, it is a context manager factory which is
+    entered around the install step only, i.e. the only step writing to
+    fakeroot.
+    """
     bdir = f"{package_name}-{ver}-build"
     if builddir is not None:
         bdir = os.path.join(builddir, bdir)
@@ -50,18 +61,23 @@ def cmake(
     ]
 
     Path(bdir).mkdir(parents=True, exist_ok=True)
-    with pushd(bdir):
-        os.environ["LD_LIBRARY_PATH"] = ld_lib_path
-        _pre_PATH = os.environ["PATH"]
-        os.environ["PATH"] = bin_path
-
-        print(f"Installing {package_name} ({ver}) from source with cmake")
-        shell([cmake, pkgpath, *flags, makeopts])
-        print(shell(f"make -j{jobs}"))
-        print(shell(f"make DESTDIR={fakeroot} install"))
-
-        del os.environ["LD_LIBRARY_PATH"]
-        os.environ["PATH"] = _pre_PATH
+    env = dict(os.environ)
+    if ld_lib_path is not None:
+        env["LD_LIBRARY_PATH"] = ld_lib_path
+    if bin_path is not None:
+        env["PATH"] = bin_path
+
+    print(f"Installing {package_name} ({ver}) from source with cmake")
+    shell([cmake, pkgpath, *flags, makeopts], cwd=bdir, env=env, log_file=log_file)
+    output = shell(f"make -j{jobs}", cwd=bdir, env=env, log_file=log_file)
+    if log_file is None:
+        print(output)
+    with (install_context or contextlib.nullcontext)():
+        output = shell(
+            f"make DESTDIR={fakeroot} install", cwd=bdir, env=env, log_file=log_file
+        )
+    if log_file is None:
+        print(output)
 
 
 def sh(
@@ -79,30 +95,33 @@ def sh(
     jobs=None,
     cmake=None,
     makeopts=None,
+    *,
+    log_file=None,
 ):
     makefile = data.get(makefile)
 
-    with pushd(pkgpath):
-        cmd = [
-            f"bash {makefile} --prefix {prefix}",
-            f"--fakeroot {fakeroot}",
-            f"--python {prefix}/bin/python",
-        ]
-        if jobs:
-            cmd.append(f"--jobs {jobs}")
-        if cmake:
-            cmd.append(f"--cmake {cmake}")
-        cmd.append(f"--pythonpath {pythonpath}")
-        cmd.append(f"--path {bin_path}")
-        cmd.append(f"--pip {pip}")
-        cmd.append(f"--ld-library-path {ld_lib_path}")
-        cmd.append(makeopts)
-
-        print(f"Installing {package_name} ({ver}) from sh")
-        shell(cmd)
-
-
-def rsync(package_name, ver, pkgpath, prefix, fakeroot, makeopts=None):
+    cmd = [
+        f"bash {makefile} --prefix {prefix}",
+        f"--fakeroot {fakeroot}",
+        f"--python {prefix}/bin/python",
+    ]
+    if jobs:
+        cmd.append(f"--jobs {jobs}")
+    if cmake:
+        cmd.append(f"--cmake {cmake}")
+    cmd.append(f"--pythonpath {pythonpath}")
+    cmd.append(f"--path {bin_path}")
+    cmd.append(f"--pip {pip}")
+    cmd.append(f"--ld-library-path {ld_lib_path}")
+    cmd.append(makeopts)
+
+    print(f"Installing {package_name} ({ver}) from sh")
+    shell(cmd, cwd=pkgpath, log_file=log_file)
+
+
+def rsync(
+    package_name, ver, pkgpath, prefix, fakeroot, makeopts=None, *, log_file=None
+):
     print(f"Installing {package_name} ({ver}) with rsync")
     # assume a root-like layout in the pkgpath dir, and just copy it
     shell(
@@ -112,6 +131,7 @@ def rsync(package_name, ver, pkgpath, prefix, fakeroot, makeopts=None):
             f"{pkgpath}/",
             fakeroot + prefix,
         ],
+        log_file=log_file,
     )
 
 
@@ -132,28 +152,7 @@ def download(package_name, ver, prefix, url, hash_str, fakeroot, destination):
     fakeprefix = Path(fakeroot + prefix)
     dest_path = fakeprefix / destination
 
-    session = requests.Session()
-    session.mount("https://", requests.adapters.HTTPAdapter(max_retries=20))
-    response = session.get(url, stream=True)
-
-    if response.status_code != requests.codes.ok:
-        msg = f"GET request to {url} returned status code {response.status_code}"
-        raise RuntimeError(
-            msg,
-        )
-
-    sha256 = hashlib.sha256()
-
-    with open(dest_path, "wb") as file_handle:
-        for chunk in response.iter_content(chunk_size=1024):
-            file_handle.write(chunk)
-            sha256.update(chunk)
-
-    if sha256.hexdigest() != hash_value:
-        msg = f"Hash of downloaded file ({sha256.hexdigest()}) not equal to expected hash."
-        raise ValueError(
-            msg,
-        )
+    downloader.download(url, dest_path, sha256=hash_value)
 
     # Add executable permission if in bin folder:
     if "bin" in dest_path.parts:
@@ -183,6 +182,26 @@ def pypaths(prefix, version):
     )
 
 
+def dependency_graph(
+    pkgs: Mapping[str, str], repo: Mapping[str, Mapping[str, dict]]
+) -> Dict[str, Set[str]]:
+    """Map each package in pkgs to the packages in pkgs it must be built after.
+
+    Edges come from the `depends` lists in the repository. Dependencies that
+    are not part of the release are ignored. Everything is built after
+    python, if python is part of the release.
+    """
+    graph = {}
+    for package_name, ver in pkgs.items():
+        depends = repo[package_name][ver].get("depends") or []
+        graph[package_name] = {
+            dep for dep in depends if dep in pkgs and dep != package_name
+        }
+        if "python" in pkgs and package_name != "python":
+            graph[package_name].add("python")
+    return graph
+
+
 def make(
     pkgs: Dict[str, str],
     repo,
@@ -194,12 +213,52 @@ def make(
     cmk="cmake",
     pip="pip",
     fakeroot=".",
+    *,
+    workers=1,
+    build_cache: Optional[BuildCache] = None,
+    logdir=None,
 ):
-    pkgorder = list(pkgs.keys())
-    # We only need to ensure that python is 'installed' first
-    if "python" in pkgorder:
-        pkgorder.remove("python")
-        pkgorder.insert(0, "python")
+    """Build and install the non-pip packages in pkgs into fakeroot.
+
+    Packages are built in the order given by their `depends` lists in the
+    repository, and up to `workers` packages that do not depend on each other
+    are built at the same time.
+
+    If build_cache is given, cmake and sh packages found in it are unpacked
+    into fakeroot instead of being built, and the files installed by the
+    ones that are built are added to it. Nothing else may write to fakeroot
+    while a package is captured, which is the install step of a cmake
+    package but the whole build of an sh package, so sh packages missing
+    from the cache are not built in parallel with other packages.
+
+    If logdir is given, the output of the commands building each package is
+    written to logdir/<package>-<version>.log instead of the console.
+    """
+    for package_name, ver in pkgs.items():
+        current = repo[package_name][ver]
+        make = current["make"]
+
+        download_keys = ["url", "destination", "hash"]
+        if any(key in current for key in download_keys) and make != "download":
+            raise ValueError(
+                ", ".join(download_keys) + " only valid with 'make: download'",
+            )
+        if not all(key in current for key in download_keys) and make == "download":
+            raise ValueError(
+                ", ".join(download_keys) + " all required with 'make: download'",
+            )
+
+        if "pypi_package_name" in current and make != "pip":
+            msg = "pypi_package_name is only valid when building with pip"
+            raise ValueError(msg)
+
+        if make not in ("cmake", "pip", "sh", "rsync", "noop", "download"):
+            raise ValueError(f"Non-supported make: {make}")
+
+    graph = dependency_graph(pkgs, repo)
+    if logdir is not None:
+        Path(logdir).mkdir(parents=True, exist_ok=True)
+        logdir = os.path.abspath(logdir)
 
     fakeprefix = fakeroot + prefix
     shell(["mkdir -p", fakeprefix])
@@ -221,37 +280,34 @@ def make(
     build_pythonpath = pypaths(fakeprefix, pkgs.get("python"))
     bin_path = ":".join([os.path.join(fakeprefix, "bin"), os.environ["PATH"]])
 
-    pkgpaths = [f"{package_name}-{pkgs[package_name]}" for package_name in pkgorder]
-    if dlprefix:
-        pkgpaths = [os.path.join(dlprefix, path) for path in pkgpaths]
-
     def resolve(input_str):
         return input_str.replace("$(prefix)", prefix)
 
-    for package_name, path in zip(pkgorder, pkgpaths):
+    resolved_makeopts = {}
+    for package_name, ver in pkgs.items():
+        makeopts = repo[package_name][ver].get("makeopts", "")
+        if extra_makeopts:
+            makeopts = f"{makeopts} {extra_makeopts}"
+        resolved_makeopts[package_name] = resolve(makeopts)
+
+    def source_path(package_name):
+        path = f"{package_name}-{pkgs[package_name]}"
+        if dlprefix:
+            path = os.path.join(dlprefix, path)
+        return os.path.abspath(path)
+
+    def install_package(package_name, install_context=None):
         ver = pkgs[package_name]
         current = repo[package_name][ver]
         make = current["make"]
-        pkgpath = os.path.abspath(path)
-
-        download_keys = ["url", "destination", "hash"]
-        if any(key in current for key in download_keys) and make != "download":
-            raise ValueError(
-                ", ".join(download_keys) + " only valid with 'make: download'",
-            )
-        if not all(key in current for key in download_keys) and make == "download":
-            raise ValueError(
-                ", ".join(download_keys) + " all required with 'make: download'",
-            )
-
-        if "pypi_package_name" in current and make != "pip":
-            msg = "pypi_package_name is only valid when building with pip"
-            raise ValueError(msg)
-
-        makeopts = current.get("makeopts", "")
-        if extra_makeopts:
-            makeopts = f"{makeopts} {extra_makeopts}"
-        makeopts = resolve(makeopts)
+        pkgpath = source_path(package_name)
+        makeopts = resolved_makeopts[package_name]
+        log_file = None
+        if logdir is not None:
+            log_file = os.path.join(logdir, f"{package_name}-{ver}.log")
+            # The steps of this build are appended to it, but not to an
+            # earlier build of the package
+            open(log_file, "wb").close()
 
         if make == "cmake":
             cmake(
@@ -266,9 +322,11 @@ def make(
                 ld_lib_path=ld_lib_path,
                 bin_path=bin_path,
                 cmake=cmk,
+                log_file=log_file,
+                install_context=install_context,
             )
         elif make == "pip":
-            continue
+            return
         elif make == "sh":
             sh(
                 package_name=package_name,
@@ -285,6 +343,7 @@ def make(
                 jobs=jobs,
                 cmake=cmk,
                 makeopts=makeopts,
+                log_file=log_file,
             )
         elif make == "rsync":
             rsync(
@@ -294,6 +353,7 @@ def make(
                 prefix=prefix,
                 fakeroot=fakeroot,
                 makeopts=makeopts,
+                log_file=log_file,
             )
         elif make == "noop":
             noop(package_name=package_name, ver=ver)
@@ -307,5 +367,53 @@ def make(
                 fakeroot=fakeroot,
                 destination=current.get("destination"),
             )
-        else:
-            raise ValueError(f"Non-supported make: {make}")
+
+    if build_cache is not None:
+        cache_keys = build_keys(
+            pkgs,
+            repo,
+            graph=graph,
+            order=build_order(graph),
+            makeopts=resolved_makeopts,
+            build_scripts={
+                package_name: data.get(repo[package_name][ver].get("makefile"))
+                for package_name, ver in pkgs.items()
+                if repo[package_name][ver]["make"] == "sh"
+            },
+            prefix=prefix,
+            sources={
+                package_name: source_digest(source_path(package_name))
+                for package_name, ver in pkgs.items()
+                if repo[package_name][ver]["make"] in ("cmake", "sh")
+            },
+        )
+
+    def build_package(package_name):
+        ver = pkgs[package_name]
+        make = repo[package_name][ver]["make"]
+        with span(f"{package_name} ({ver})", "package", make=make):
+            if build_cache is None:
+                install_package(package_name)
+                return
+            key = cache_keys[package_name]
+            if make not in ("cmake", "sh"):
+                with build_cache.shared():
+                    install_package(package_name)
+            elif key in build_cache:
+                print(f"Using cached build of {package_name} ({ver})")
+                with build_cache.shared(), span("unpack cached build", "cache"):
+                    build_cache.unpack(key, fakeprefix)
+            elif make == "cmake":
+                install_package(
+                    package_name,
+                    install_context=lambda: build_cache.capture(key, fakeprefix),
+                )
+            else:
+                # An sh script both compiles and installs, so all of it is
+                # captured
+                with build_cache.capture(key, fakeprefix):
+                    install_package(package_name)
+
+    run_in_dependency_order(
+        graph, build_package, workers=workers, capture_output=logdir is None
+    )
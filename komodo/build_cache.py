@@ -0,0 +1,228 @@
+"""A cache of the files each package installs into the fakeroot.
+
+A package's files are found by comparing the fakeroot before and after its
+installation. That is only correct if nothing else writes to the fakeroot in
+the meantime, so installations which are captured hold the fakeroot
+exclusively, while everything else (cache hits, downloads, ...) shares it.
+For cmake packages only the install step is captured, but an sh build script
+compiles and installs in one go, so the cache serializes the sh packages it
+does not have with all other writers to the fakeroot.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import stat
+import tarfile
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, Mapping, Optional, Set, Tuple, Union
+
+from komodo.package_version import get_git_revision_hash
+from komodo.tracing import span
+
+Snapshot = Dict[str, Tuple[int, int, int]]
+
+
+def snapshot(root: Union[str, Path]) -> Snapshot:
+    """Map every path below root, relative to root, to its mode, size and
+    modification time.
+    """
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            stat = os.lstat(path)
+            result[os.path.relpath(path, root)] = (
+                stat.st_mode,
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+    return result
+
+
+def _file_hash(path: Optional[str]) -> Optional[str]:
+    if path is None:
+        return None
+    with open(path, "rb") as file_handle:
+        return hashlib.sha256(file_handle.read()).hexdigest()
+
+
+def source_digest(path: Union[str, Path]) -> str:
+    """Identify the source a package is built from: the commit checked out
+    for a git clone, otherwise a hash of the names, modes and contents of
+    everything in the source tree.
+    """
+    if os.path.exists(os.path.join(path, ".git")):
+        return get_git_revision_hash(path)
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            entry = os.path.join(dirpath, name)
+            info = os.lstat(entry)
+            relative = os.path.relpath(entry, path)
+            digest.update(f"{relative}\0{stat.S_IMODE(info.st_mode)}\0".encode())
+            if stat.S_ISLNK(info.st_mode):
+                digest.update(os.readlink(entry).encode())
+            elif stat.S_ISREG(info.st_mode):
+                with open(entry, "rb") as file_handle:
+                    for chunk in iter(lambda: file_handle.read(1 << 20), b""):
+                        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_keys(
+    pkgs: Mapping[str, str],
+    repo: Mapping[str, Mapping[str, dict]],
+    *,
+    graph: Mapping[str, Set[str]],
+    order: list,
+    makeopts: Mapping[str, str],
+    build_scripts: Mapping[str, Optional[str]],
+    prefix: str,
+    sources: Optional[Mapping[str, str]] = None,
+) -> Dict[str, str]:
+    """Compute the cache key of every package in pkgs.
+
+    The key covers the repository entry of the package, its source, its
+    resolved makeopts, the content of its build script, the install prefix
+    and the keys of all the packages it depends on, so that a change to a
+    package invalidates everything built on top of it.
+
+    Args:
+        graph: Maps every package to the packages it is built after.
+        order: The packages of graph, dependencies before dependents.
+        build_scripts: Path to the build script of the package, if any.
+        sources: The source_digest of each package built from source, so
+            that e.g. a package pinned to a branch is rebuilt when the
+            branch moves.
+    """
+    sources = sources or {}
+    keys: Dict[str, str] = {}
+    for package_name in order:
+        ver = pkgs[package_name]
+        content = json.dumps(
+            {
+                "package": package_name,
+                "version": ver,
+                "entry": repo[package_name][ver],
+                "source": sources.get(package_name),
+                "makeopts": makeopts.get(package_name),
+                "build_script": _file_hash(build_scripts.get(package_name)),
+                "prefix": prefix,
+                "depends": sorted(keys[dep] for dep in graph[package_name]),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        keys[package_name] = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return keys
+
+
+class _SharedExclusiveLock:
+    """A readers-writer lock. Waiting exclusive holders are let in before
+    new shared holders, so a capture is not starved by a stream of cache hits.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting_exclusive = 0
+
+    @contextlib.contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(
+                lambda: not self._exclusive and not self._waiting_exclusive
+            )
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._shared -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_exclusive += 1
+            self._condition.wait_for(lambda: not self._exclusive and not self._shared)
+            self._waiting_exclusive -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+class BuildCache:
+    def __init__(self, path: Union[str, Path]) -> None:
+        """A persistent cache of built packages, stored as one tar file per
+        cache key in path.
+        """
+        self.path = Path(path).absolute()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = _SharedExclusiveLock()
+
+    def shared(self):
+        """Hold the fakeroot together with other writers which are not being
+        captured.
+        """
+        return self._lock.shared()
+
+    def exclusive(self):
+        """Hold the fakeroot alone, while a build is being captured."""
+        return self._lock.exclusive()
+
+    @contextlib.contextmanager
+    def capture(self, key: str, root: Union[str, Path]) -> Iterator[None]:
+        """Hold the fakeroot alone, and store what is installed below root
+        while the context is entered under key.
+        """
+        with self.exclusive():
+            before = snapshot(root)
+            yield
+            with span("store build in cache", "cache"):
+                self.store(key, root, before)
+
+    def _artifact(self, key: str) -> Path:
+        return self.path / f"{key}.tar"
+
+    def __contains__(self, key: str) -> bool:
+        return self._artifact(key).exists()
+
+    def unpack(self, key: str, destination: Union[str, Path]) -> None:
+        with tarfile.open(self._artifact(key)) as tar:
+            if hasattr(tarfile, "tar_filter"):
+                tar.extractall(destination, filter="tar")
+            else:
+                tar.extractall(destination)
+
+    def store(self, key: str, root: Union[str, Path], before: Snapshot) -> int:
+        """Store everything below root that was added or changed since the
+        snapshot before was taken.
+
+        Returns:
+            The number of paths stored.
+        """
+        after = snapshot(root)
+        changed = sorted(
+            path for path, info in after.items() if before.get(path) != info
+        )
+        staging = self.path / f".{key}.{uuid.uuid4().hex}"
+        try:
+            with tarfile.open(staging, "w") as tar:
+                for path in changed:
+                    tar.add(os.path.join(root, path), arcname=path, recursive=False)
+            staging.rename(self._artifact(key))
+        finally:
+            if staging.exists():
+                staging.unlink()
+        return len(changed)
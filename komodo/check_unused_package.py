@@ -43,6 +43,7 @@ def check_for_unused_package(
     package_status: dict[str, Any],
     repository: RepositoryFile,
     builtin_python_versions: dict[str, str],
+    cachefile: str | None = None,
 ) -> CheckResult:
     def get_visibility(pkg):
         try:
@@ -80,11 +81,15 @@ def check_for_unused_package(
             release_file,
             repository,
             builtin_python_versions[release_file.content["python"]],
+            cachefile,
         )
     except (NoSuchPackageStatus, NoSuchRepository) as err:
         return CheckResult(message=str(err), exitcode=err.exit_code)
 
-    used_packages = dependencies.used_packages(public_packages)
+    try:
+        used_packages = dependencies.used_packages(public_packages)
+    finally:
+        dependencies.close()
 
     if unused_private_packages := private_packages.difference(used_packages):
         return CheckResult(
@@ -99,15 +104,19 @@ def check_for_unused_package(
         return CheckResult(message="Everything seems fine.", exitcode=0)
 
 
-def _extract_dependencies(release_file, repository, full_python_version):
+def _extract_dependencies(
+    release_file, repository, full_python_version, cachefile=None
+):
     dependencies = PypiDependencies(
         release_file.content,
         python_version=full_python_version,
+        cachefile=cachefile,
     )
     for name, version in release_file.content.items():
         try:
             metadata = repository.content[name][version]
         except KeyError as err:
+            dependencies.close()
             raise NoSuchRepository(
                 f"Could not find package-version: {name}:{version} in the repository file"
             ) from err
@@ -138,13 +147,23 @@ def main():
         type=RepositoryFile(),
         help="Repository file wich lists where to get the package from.",
     )
+    parser.add_argument(
+        "--cachefile",
+        help="Where to keep package metadata fetched from pypi, e.g. the "
+        "pypi_dependencies.sqlite written by komodo-lint "
+        "--check-pypi-dependencies. None means no cache.",
+    )
 
     args = parser.parse_args()
     with open("builtin_python_versions.yml", encoding="utf-8") as f:
         builtin_python_versions = yaml.safe_load(f)
     package_status = load_yaml(args.status_file)
     result = check_for_unused_package(
-        args.release_file, package_status, args.repo, builtin_python_versions
+        args.release_file,
+        package_status,
+        args.repo,
+        builtin_python_versions,
+        args.cachefile,
     )
     print(result.message)
     sys.exit(result.exitcode)
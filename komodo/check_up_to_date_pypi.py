@@ -1,18 +1,42 @@
 import argparse
 import copy
+import json
+import os
 import pathlib
 import re
 import sys
-from typing import Dict, List
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import chain
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
 
 import requests
 import ruamel.yaml
 from packaging import version as get_version
 from packaging.specifiers import InvalidSpecifier, SpecifierSet
-
+from packaging.tags import Tag, compatible_tags, cpython_tags
+from packaging.utils import (
+    InvalidSdistFilename,
+    InvalidWheelFilename,
+    canonicalize_name,
+    parse_sdist_filename,
+    parse_wheel_filename,
+)
+from packaging.version import InvalidVersion
+
+from komodo.matrix import get_python_version
 from komodo.package_version import strip_version
 from komodo.prettier import write_to_file
-from komodo.yaml_file_types import ReleaseFile, RepositoryFile
+from komodo.pypi_snapshot import PypiSnapshot
+from komodo.release_transpiler import get_concrete_releases
+from komodo.yaml_file_types import (
+    ReleaseDir,
+    ReleaseFile,
+    ReleaseMatrixFile,
+    RepositoryFile,
+    load_yaml_from_string,
+)
 
 
 class YankedException(Exception):
@@ -31,14 +55,99 @@ def load_from_file(yaml, fname):
         return yaml.load(fin)
 
 
-def get_pypi_info(package_names):
-    return [
-        (
-            package,
-            requests.get(f"https://pypi.python.org/pypi/{package}/json", timeout=60),
+PYPI_JSON_URL = "https://pypi.python.org/pypi/{package}/json"
+
+
+def default_cache_dir() -> pathlib.Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache_home) / "komodo" / "pypi-json"
+
+
+@dataclass(frozen=True)
+class _CachedResponse:
+    """Stands in for the requests.Response of a cached response which pypi
+    reported as not modified."""
+
+    text: str
+    ok = True
+    status_code = requests.codes.ok
+    reason = "OK"
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _read_cache(cache_file: Optional[pathlib.Path]) -> Optional[Dict[str, str]]:
+    """The ETag and content stored in cache_file, or None if there is no
+    usable cached response."""
+    if cache_file is None or not cache_file.exists():
+        return None
+    try:
+        cached = json.loads(cache_file.read_text(encoding="utf-8"))
+        if isinstance(cached["etag"], str) and isinstance(cached["content"], str):
+            return cached
+    except (ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _cached_get(
+    session: requests.Session, url: str, cache_file: Optional[pathlib.Path]
+) -> Union[requests.Response, _CachedResponse]:
+    """GET url, revalidating the response stored in cache_file with its ETag
+    so that an unchanged response is not sent again."""
+    cached = _read_cache(cache_file)
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+    response = session.get(url, headers=headers, timeout=60)
+
+    if cached and response.status_code == requests.codes.not_modified:
+        return _CachedResponse(cached["content"])
+    etag = response.headers.get("ETag")
+    if (
+        cache_file is not None
+        and response.status_code == requests.codes.ok
+        and isinstance(etag, str)
+    ):
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_name(f".{cache_file.name}.{uuid.uuid4().hex}")
+        tmp.write_text(
+            json.dumps({"etag": etag, "content": response.text}), encoding="utf-8"
         )
-        for package in package_names
-    ]
+        os.replace(tmp, cache_file)
+    return response
+
+
+def get_pypi_info(
+    package_names: Iterable[str],
+    cache_dir: Optional[pathlib.Path] = None,
+    workers: int = 16,
+) -> List[Tuple[str, Union[requests.Response, _CachedResponse]]]:
+    """Get the pypi JSON of each package, with workers requests at a time
+    over one pooled session.
+
+    Args:
+        cache_dir: Where responses are kept between runs, to be revalidated
+            with If-None-Match. None means no cache.
+    """
+    package_names = list(package_names)
+    if not package_names:
+        return []
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(max_retries=3, pool_maxsize=workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        def get(package: str) -> Tuple[str, Union[requests.Response, _CachedResponse]]:
+            cache_file = (
+                cache_dir / f"{canonicalize_name(package)}.json"
+                if cache_dir is not None
+                else None
+            )
+            url = PYPI_JSON_URL.format(package=package)
+            return package, _cached_get(session, url, cache_file)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(get, package_names))
 
 
 def get_python_requirement(sources: list):
@@ -71,28 +180,132 @@ def is_platform_compatible(build_info: List[Dict], platform: str) -> bool:
     return False
 
 
+# The platform tag prefixes of wheels for each sys.platform
+PLATFORM_TAG_PREFIXES = {
+    "linux": ("linux", "manylinux", "musllinux"),
+    "linux2": ("linux", "manylinux", "musllinux"),
+    "darwin": ("macosx",),
+    "win32": ("win",),
+}
+
+
+@dataclass(frozen=True)
+class _Release:
+    version: get_version.Version
+    requires_python: SpecifierSet
+    source: bool
+    wheel_tags: FrozenSet[Tag]
+    # Files that are neither sdists nor wheels, matched as in is_platform_compatible
+    other_files: Tuple[dict, ...]
+
+
+def _interpreters(python_version: str) -> Optional[Set[Tuple[str, str]]]:
+    """The (interpreter, abi) wheel tag pairs CPython python_version can use,
+    or None if the minor version is not given."""
+    major, _, minor = python_version.partition(".")
+    minor = minor.split(".")[0]
+    if not minor:
+        return None
+    version = (int(major), int(minor))
+    return {
+        (tag.interpreter, tag.abi)
+        for tag in chain(
+            cpython_tags(version, platforms=["any"]),
+            compatible_tags(version, platforms=["any"]),
+        )
+    }
+
+
+class CompatibilityIndex:
+    def __init__(self, releases: dict):
+        """The releases of a package with their python requirement and wheel
+        tags parsed, so that compatible versions can be looked up for any
+        python version and platform.
+
+        Args:
+            releases: The releases from the pypi JSON API, mapping version
+                to files. The index is built when it is first queried.
+        """
+        self._source = releases
+        self._releases: Optional[List[_Release]] = None
+        self._queries: Dict[Tuple[str, str], List[get_version.Version]] = {}
+
+    def _build(self) -> List[_Release]:
+        releases = []
+        for version_str, build_info in self._source.items():
+            try:
+                package_version = get_version.parse(version_str)
+            except get_version.InvalidVersion:  # presumably unparsable pre-release
+                continue
+            if package_version.is_prerelease:
+                continue
+            try:
+                required_python = SpecifierSet(get_python_requirement(build_info))
+            except (YankedException, InvalidSpecifier):
+                continue
+            source, wheel_tags, other_files = False, set(), []
+            for build in build_info:
+                filename = build.get("filename", "")
+                try:
+                    if filename.endswith(".whl"):
+                        wheel_tags.update(parse_wheel_filename(filename)[3])
+                        continue
+                    if filename.endswith((".tar.gz", ".zip")):
+                        parse_sdist_filename(filename)
+                        source = True
+                        continue
+                except (InvalidWheelFilename, InvalidSdistFilename, InvalidVersion):
+                    pass
+                other_files.append(build)
+            releases.append(
+                _Release(
+                    package_version,
+                    required_python,
+                    source,
+                    frozenset(wheel_tags),
+                    tuple(other_files),
+                )
+            )
+        return releases
+
+    def compatible_versions(
+        self, python_version: str, platform: str
+    ) -> List[get_version.Version]:
+        """The released versions with a source distribution, or a wheel for
+        python_version and platform, that allow python_version."""
+        key = (python_version, platform)
+        if key in self._queries:
+            return self._queries[key]
+        if self._releases is None:
+            self._releases = self._build()
+
+        interpreters = _interpreters(python_version)
+        prefixes = PLATFORM_TAG_PREFIXES.get(platform, (platform,))
+
+        def wheel_compatible(tag: Tag) -> bool:
+            if interpreters is not None and (tag.interpreter, tag.abi) not in (
+                interpreters
+            ):
+                return False
+            return tag.platform == "any" or tag.platform.startswith(prefixes)
+
+        self._queries[key] = [
+            release.version
+            for release in self._releases
+            if python_version in release.requires_python
+            and (
+                release.source
+                or any(wheel_compatible(tag) for tag in release.wheel_tags)
+                or is_platform_compatible(list(release.other_files), platform)
+            )
+        ]
+        return self._queries[key]
+
+
 def compatible_versions(
     releases: dict, python_version, platform: str
 ) -> List[get_version.Version]:
-    compatible_versions = []
-    for version_str, build_info in releases.items():
-        try:
-            package_version = get_version.parse(version_str)
-        except get_version.InvalidVersion:  # presumably unparsable pre-release
-            continue
-        if package_version.is_prerelease:
-            continue
-        try:
-            required_python = SpecifierSet(get_python_requirement(build_info))
-        except YankedException:
-            continue
-        except InvalidSpecifier:
-            continue
-        if python_version in required_python and is_platform_compatible(
-            build_info, platform
-        ):
-            compatible_versions.append(package_version)
-    return compatible_versions
+    return CompatibilityIndex(releases).compatible_versions(python_version, platform)
 
 
 def get_pypi_packages(release: dict, repository: dict) -> list:
@@ -109,6 +322,26 @@ def get_pypi_packages(release: dict, repository: dict) -> list:
     return pypi_packages
 
 
+def get_pypi_releases(
+    package_names: Iterable[str],
+    cache_dir: Optional[pathlib.Path] = None,
+    snapshot: Optional[PypiSnapshot] = None,
+) -> List[Tuple[str, dict]]:
+    """The releases of each package from the pypi JSON API, or from snapshot
+    if given."""
+    if snapshot is not None:
+        return [(package, snapshot.releases(package)) for package in package_names]
+    pypi_releases = []
+    for package, response in get_pypi_info(package_names, cache_dir=cache_dir):
+        if not response.ok:
+            msg = f"Response returned non valid return code: {response.reason}"
+            raise ValueError(
+                msg,
+            )
+        pypi_releases.append((package, response.json()["releases"]))
+    return pypi_releases
+
+
 def get_upgrade_proposals_from_pypi(
     releases: dict,
     repository: dict,
@@ -116,44 +349,54 @@ def get_upgrade_proposals_from_pypi(
     platform: str,
     minor_upgrade_only: bool = False,
     patch_upgrade_only: bool = False,
+    *,
+    cache_dir: Optional[pathlib.Path] = None,
+    snapshot: Optional[PypiSnapshot] = None,
+    indices: Optional[Dict[str, CompatibilityIndex]] = None,
 ) -> dict:
+    """The newest compatible version of each pypi package in releases that is
+    not the version in releases.
+
+    Args:
+        indices: Compatibility indices of packages from earlier calls, which
+            are used instead of fetching those packages again. The indices of
+            the other packages are added to it.
+    """
+    indices = {} if indices is None else indices
     pypi_packages = get_pypi_packages(releases, repository)
-    pypi_responses = get_pypi_info(pypi_packages)
+    missing = [package for package in pypi_packages if package not in indices]
+    if missing:
+        for package_name, package_releases in get_pypi_releases(
+            missing, cache_dir, snapshot
+        ):
+            indices[package_name] = CompatibilityIndex(package_releases)
 
     upgrade_proposals_from_pypi = {}
 
-    for package_name, response in pypi_responses:
+    for package_name in pypi_packages:
         komodo_version = get_version.parse(strip_version(releases[package_name]))
-        if response.ok:
-            pypi_versions = compatible_versions(
-                response.json()["releases"], python_version, platform
-            )
-            if not pypi_versions:
-                print(
-                    f"Could not process package '{package_name}'. Check package manually"
-                )
-                continue
-            if minor_upgrade_only:
-                pypi_versions = [
-                    ver for ver in pypi_versions if komodo_version.major == ver.major
-                ]
-            elif patch_upgrade_only:
-                pypi_versions = [
-                    ver
-                    for ver in pypi_versions
-                    if komodo_version.minor == ver.minor
-                    and komodo_version.major == ver.major
-                ]
-
-            if len(pypi_versions) > 0:
-                pypi_latest_version = max(pypi_versions)
-            else:
-                pypi_latest_version = komodo_version
+        pypi_versions = indices[package_name].compatible_versions(
+            python_version, platform
+        )
+        if not pypi_versions:
+            print(f"Could not process package '{package_name}'. Check package manually")
+            continue
+        if minor_upgrade_only:
+            pypi_versions = [
+                ver for ver in pypi_versions if komodo_version.major == ver.major
+            ]
+        elif patch_upgrade_only:
+            pypi_versions = [
+                ver
+                for ver in pypi_versions
+                if komodo_version.minor == ver.minor
+                and komodo_version.major == ver.major
+            ]
+
+        if len(pypi_versions) > 0:
+            pypi_latest_version = max(pypi_versions)
         else:
-            msg = f"Response returned non valid return code: {response.reason}"
-            raise ValueError(
-                msg,
-            )
+            pypi_latest_version = komodo_version
         if pypi_latest_version != komodo_version:
             upgrade_proposals_from_pypi[package_name] = {
                 "previous": releases[package_name],
@@ -163,6 +406,79 @@ def get_upgrade_proposals_from_pypi(
     return upgrade_proposals_from_pypi
 
 
+def get_upgrade_proposals_for_releases(
+    releases: Dict[str, Tuple[dict, str]],
+    repository: dict,
+    platform: str,
+    *,
+    minor_upgrade_only: bool = False,
+    patch_upgrade_only: bool = False,
+    cache_dir: Optional[pathlib.Path] = None,
+    snapshot: Optional[PypiSnapshot] = None,
+) -> Dict[str, dict]:
+    """The upgrade proposals of several releases, e.g. the concrete releases
+    of a matrix. Each pypi package is fetched once, however many releases
+    it is in.
+
+    Args:
+        releases: The content of each release by name, with the python
+            version to check it against.
+
+    Returns:
+        The upgrade proposals of each release, as given by
+        get_upgrade_proposals_from_pypi.
+    """
+    pypi_packages = dict.fromkeys(
+        chain.from_iterable(
+            get_pypi_packages(release, repository) for release, _ in releases.values()
+        )
+    )
+    indices = {
+        package_name: CompatibilityIndex(package_releases)
+        for package_name, package_releases in get_pypi_releases(
+            pypi_packages, cache_dir, snapshot
+        )
+    }
+    return {
+        release_name: get_upgrade_proposals_from_pypi(
+            release,
+            repository,
+            python_version,
+            platform,
+            minor_upgrade_only,
+            patch_upgrade_only,
+            indices=indices,
+        )
+        for release_name, (release, python_version) in releases.items()
+    }
+
+
+def load_release_folder(
+    release_folder: str, python_version: str
+) -> Dict[str, Tuple[dict, str]]:
+    """The releases in release_folder, with the python version of their py
+    coordinate, e.g. 3.11 for 2024.01.00-py311-rhel8, or python_version if
+    their name has none."""
+    releases = {}
+    for release_name, release in sorted(ReleaseDir()(release_folder).items()):
+        py_tag = re.search(r"-(py\d{2,3})(-|$)", release_name)
+        releases[release_name] = (
+            release,
+            get_python_version(py_tag.group(1)) if py_tag else python_version,
+        )
+    return releases
+
+
+def load_release_matrix(matrix_file: str, matrix: dict) -> Dict[str, Tuple[dict, str]]:
+    """The concrete releases of matrix_file for the matrix coordinates, with
+    the python version of their py coordinate."""
+    ReleaseMatrixFile()(matrix_file)
+    return {
+        release_name: (release, get_python_version(py_tag))
+        for release_name, py_tag, release in get_concrete_releases(matrix_file, matrix)
+    }
+
+
 def insert_upgrade_proposals(upgrade_proposals, repository, releases):
     for package, version in upgrade_proposals.items():
         suggested_version = version["suggested"]
@@ -178,6 +494,54 @@ def insert_upgrade_proposals(upgrade_proposals, repository, releases):
         releases[package] = suggested_version
 
 
+def print_upgrade_proposals(upgrade_proposals_from_pypi: dict) -> None:
+    if not upgrade_proposals_from_pypi:
+        print("All packages up to date!!!")
+        return
+
+    major_upgrades, minor_upgrades, patch_upgrades, other_upgrades = [], [], [], []
+    for name, versions in upgrade_proposals_from_pypi.items():
+        pypi_latest = get_version.Version(versions["suggested"])
+        try:
+            current_version = get_version.Version(versions["previous"])
+        except get_version.InvalidVersion:
+            print(f"Could not parse version {versions['previous']}")
+            continue
+        if pypi_latest.major > current_version.major:
+            major_upgrades.append(
+                f"{name} not at latest pypi version: {pypi_latest}, "
+                f"is at: {current_version}"
+            )
+        elif pypi_latest.minor > current_version.minor:
+            minor_upgrades.append(
+                f"{name} not at latest pypi version: {pypi_latest}, "
+                f"is at: {current_version}"
+            )
+        elif pypi_latest.micro > current_version.micro:
+            patch_upgrades.append(
+                f"{name} not at latest pypi version: {pypi_latest}, "
+                f"is at: {current_version}"
+            )
+        else:
+            other_upgrades.append(
+                f"{name} not at latest pypi version: {pypi_latest}, "
+                f"is at: {current_version}"
+            )
+    print(
+        "\n".join(
+            ["\nMajor upgrades:"]
+            + major_upgrades
+            + ["\nMinor upgrades:"]
+            + minor_upgrades
+            + ["\nPatch upgrades:"]
+            + patch_upgrades
+            + ["\nOTHER UPGRADES:"]
+            + other_upgrades
+        )
+        + "\n\n\nFound out of date packages!"
+    )
+
+
 def run_check_up_to_date(
     release_file,
     repository_file,
@@ -189,6 +553,9 @@ def run_check_up_to_date(
     platform=sys.platform,
     minor_upgrade_only=False,
     patch_upgrade_only=False,
+    *,
+    cache_dir=None,
+    snapshot=None,
 ):
     yaml = yaml_parser()
     releases: dict = load_from_file(yaml, release_file)
@@ -207,62 +574,57 @@ def run_check_up_to_date(
         platform,
         minor_upgrade_only,
         patch_upgrade_only,
+        cache_dir=cache_dir,
+        snapshot=snapshot,
     )
-    if upgrade_proposals_from_pypi:
-        if propose_upgrade:
-            insert_upgrade_proposals(upgrade_proposals_from_pypi, repository, releases)
-            print(
-                "Writing upgrade proposals from pypi, "
-                "assuming nothing has changed with dependencies..."
-            )
-            with open(propose_upgrade, mode="w", encoding="utf-8") as fout:
-                yaml.dump(releases, fout)
-            write_to_file(repository, repository_file)
-
-        major_upgrades, minor_upgrades, patch_upgrades, other_upgrades = [], [], [], []
-        for name, versions in upgrade_proposals_from_pypi.items():
-            pypi_latest = get_version.Version(versions["suggested"])
-            try:
-                current_version = get_version.Version(versions["previous"])
-            except get_version.InvalidVersion:
-                print(f"Could not parse version {versions['previous']}")
-                continue
-            if pypi_latest.major > current_version.major:
-                major_upgrades.append(
-                    f"{name} not at latest pypi version: {pypi_latest}, "
-                    f"is at: {current_version}"
-                )
-            elif pypi_latest.minor > current_version.minor:
-                minor_upgrades.append(
-                    f"{name} not at latest pypi version: {pypi_latest}, "
-                    f"is at: {current_version}"
-                )
-            elif pypi_latest.micro > current_version.micro:
-                patch_upgrades.append(
-                    f"{name} not at latest pypi version: {pypi_latest}, "
-                    f"is at: {current_version}"
-                )
-            else:
-                other_upgrades.append(
-                    f"{name} not at latest pypi version: {pypi_latest}, "
-                    f"is at: {current_version}"
-                )
+    if upgrade_proposals_from_pypi and propose_upgrade:
+        insert_upgrade_proposals(upgrade_proposals_from_pypi, repository, releases)
         print(
-            "\n".join(
-                ["\nMajor upgrades:"]
-                + major_upgrades
-                + ["\nMinor upgrades:"]
-                + minor_upgrades
-                + ["\nPatch upgrades:"]
-                + patch_upgrades
-                + ["\nOTHER UPGRADES:"]
-                + other_upgrades
-            )
-            + "\n\n\nFound out of date packages!"
+            "Writing upgrade proposals from pypi, "
+            "assuming nothing has changed with dependencies..."
         )
+        with open(propose_upgrade, mode="w", encoding="utf-8") as fout:
+            yaml.dump(releases, fout)
+        write_to_file(repository, repository_file)
+    print_upgrade_proposals(upgrade_proposals_from_pypi)
 
-    else:
-        print("All packages up to date!!!")
+
+def run_check_up_to_date_for_releases(
+    releases: Dict[str, Tuple[dict, str]],
+    repository_file,
+    *,
+    ignore=None,
+    platform=sys.platform,
+    minor_upgrade_only=False,
+    patch_upgrade_only=False,
+    cache_dir=None,
+    snapshot=None,
+):
+    if ignore:
+        releases = {
+            release_name: (
+                {
+                    package_name: package_version
+                    for package_name, package_version in release.items()
+                    if re.search(ignore, f"{package_name} {package_version}") is None
+                },
+                python_version,
+            )
+            for release_name, (release, python_version) in releases.items()
+        }
+    repository = load_from_file(yaml_parser(), repository_file)
+    upgrade_proposals = get_upgrade_proposals_for_releases(
+        releases,
+        repository,
+        platform,
+        minor_upgrade_only=minor_upgrade_only,
+        patch_upgrade_only=patch_upgrade_only,
+        cache_dir=cache_dir,
+        snapshot=snapshot,
+    )
+    for release_name, upgrade_proposals_from_pypi in upgrade_proposals.items():
+        print(f"\n{release_name} (python version: {releases[release_name][1]}):")
+        print_upgrade_proposals(upgrade_proposals_from_pypi)
 
 
 def get_args() -> argparse.Namespace:
@@ -273,11 +635,14 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "release_file",
         type=lambda arg: (
-            arg if pathlib.Path(arg).is_file() else parser.error(f"{arg} is not a file")
+            arg
+            if pathlib.Path(arg).is_file() or pathlib.Path(arg).is_dir()
+            else parser.error(f"{arg} is not a file or directory")
         ),
         help=(
             "Komodo release file you would like to check dependencies on, "
-            "in YAML format."
+            "in YAML format. If a folder, all releases in it are checked, "
+            "each against the python version of its py coordinate."
         ),
     )
     parser.add_argument(
@@ -327,6 +692,37 @@ def get_args() -> argparse.Namespace:
             " linux, linux2, or win32. Defaults to OS of host machine"
         ),
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=default_cache_dir(),
+        help=(
+            "Directory where responses from pypi are kept, so that later checks "
+            "only ask pypi whether they have changed."
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use or update the response cache.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=PypiSnapshot.load,
+        help=(
+            "Read pypi metadata from a snapshot made with komodo-snapshot-pypi "
+            "instead of from pypi."
+        ),
+    )
+    parser.add_argument(
+        "--matrix-coordinates",
+        type=load_yaml_from_string,
+        help=(
+            "Treat release_file as a release matrix file and check the concrete "
+            "releases for these coordinates, e.g. \"{rhel: ['8'], py: ['3.8', "
+            "'3.11']}\". Each package is fetched from pypi once for all releases."
+        ),
+    )
     specify_upgrade_mode_group = parser.add_mutually_exclusive_group()
     specify_upgrade_mode_group.add_argument(
         "--patch-upgrade",
@@ -346,6 +742,26 @@ def get_args() -> argparse.Namespace:
 def main():
     args = get_args()
 
+    if args.matrix_coordinates is not None or os.path.isdir(args.release_file):
+        if args.propose_upgrade:
+            sys.exit("--propose-upgrade can only be used with a single release file")
+        if args.matrix_coordinates is not None:
+            releases = load_release_matrix(args.release_file, args.matrix_coordinates)
+        else:
+            releases = load_release_folder(args.release_file, args.python_version)
+        validate_repository_file(args.repository_file)
+        run_check_up_to_date_for_releases(
+            releases,
+            args.repository_file,
+            ignore=args.ignore,
+            platform=args.target_platform,
+            minor_upgrade_only=args.minor_upgrade,
+            patch_upgrade_only=args.patch_upgrade,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            snapshot=args.snapshot,
+        )
+        return
+
     print(f"Checking against python version: {args.python_version}")
 
     validate_release_file(args.release_file)
@@ -360,7 +776,46 @@ def main():
         args.target_platform,
         args.minor_upgrade,
         args.patch_upgrade,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        snapshot=args.snapshot,
+    )
+
+
+def snapshot_main(args=None):
+    parser = argparse.ArgumentParser(
+        description=(
+            "Snapshots the pypi metadata of all pypi packages in a repository "
+            "file, for komodo-check-pypi --snapshot."
+        ),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "repository_file",
+        type=RepositoryFile(),
+        help="Komodo repository file, in YAML format.",
+    )
+    parser.add_argument("output", help="The snapshot file to write.")
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=default_cache_dir(),
+        help="Directory where responses from pypi are kept between runs.",
     )
+    args = parser.parse_args(args)
+
+    packages = sorted(
+        package
+        for package, versions in args.repository_file.content.items()
+        if any(config.get("source") == "pypi" for config in versions.values())
+    )
+    snapshot = PypiSnapshot()
+    for package, response in get_pypi_info(packages, cache_dir=args.cache_dir):
+        if response.ok:
+            snapshot.add(package, response.json()["releases"])
+        else:
+            print(f"Could not get {package} from pypi: {response.reason}")
+    snapshot.write(args.output)
+    print(f"Wrote pypi metadata of {len(snapshot.packages)} packages to {args.output}")
 
 
 def validate_release_file(file_path: str) -> None:
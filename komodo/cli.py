@@ -1,22 +1,30 @@
 import argparse
 import contextlib
 import datetime
+import functools
 import os
+import re
 import sys
 import uuid
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
 
-import jinja2
 from ruamel.yaml import YAML
 
 import komodo.switch
 from komodo.build import make
+from komodo.build_cache import BuildCache
 from komodo.data import Data
-from komodo.fetch import fetch
+from komodo.download_cache import DownloadCache, parse_size
+from komodo.fetch import FetchPlan, fetch, plan_fetch, run_fetch_plan
+from komodo.git_mirror import GitCloneOptions, GitMirrors
 from komodo.package_version import strip_version
+from komodo.permissions import fix_permissions
+from komodo.release_files import create_enable_scripts
 from komodo.shebang import fixup_python_shebangs
 from komodo.shell import pushd, shell
+from komodo.tracing import span, tracer
+from komodo.wheelhouse import Wheelhouse
 from komodo.yaml_file_types import ReleaseFile, RepositoryFile
 
 # If this package is included in a build, it will always
@@ -36,6 +44,21 @@ class KomodoNamespace(argparse.Namespace):
     tmp: str
     downloads: str
     jobs: int
+    build_workers: int
+    build_cache: Optional[str]
+    log_dir: Optional[str]
+    link_dest: Optional[str]
+    fetch_workers: int
+    fetch_limits: Dict[str, int]
+    download_cache: Optional[str]
+    download_cache_size: Optional[int]
+    git_mirrors: Optional[str]
+    git_shallow: bool
+    git_filter: Optional[str]
+    git_submodule_jobs: Optional[int]
+    wheelhouse: Optional[str]
+    write_fetch_plan: Optional[str]
+    fetch_plan: Optional[str]
     download: bool
     build: bool
     install: bool
@@ -49,14 +72,15 @@ class KomodoNamespace(argparse.Namespace):
 
 
 def profile_time(msg: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Trace calls to the decorated function as a build phase named msg."""
+
     def decorator(fun: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fun)
         def wrapper(*args: Any, **kwargs: Any) -> Any:
             start_time = datetime.datetime.now()
-            res = fun(*args, **kwargs)
-            timings.append(
-                (msg, datetime.datetime.now() - start_time),
-            )
-            _print_timing(timings[-1])
+            with span(msg):
+                res = fun(*args, **kwargs)
+            _print_timing((msg, datetime.datetime.now() - start_time))
             return res
 
         return wrapper
@@ -64,33 +88,6 @@ def profile_time(msg: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]
     return decorator
 
 
-def create_enable_scripts(komodo_prefix: str, komodo_release: str) -> None:
-    """Render enable scripts (user facing) for bash and csh to an existing
-    directory komodo_release (in current working directory).
-
-    Args:
-    ----
-        komodo_prefix: The filesystem path to where the release is to be
-            deployed.
-        komodo_release: The name of the release.
-    """
-    jinja_env = jinja2.Environment(
-        loader=jinja2.PackageLoader(package_name="komodo", package_path="data"),
-        keep_trailing_newline=True,
-    )
-    for tmpl, target in [
-        ("enable.jinja2", "enable"),
-        ("enable.csh.jinja2", "enable.csh"),
-    ]:
-        (Path(komodo_release) / target).write_text(
-            jinja_env.get_template(tmpl).render(
-                komodo_prefix=komodo_prefix,
-                komodo_release=komodo_release,
-            ),
-            encoding="utf-8",
-        )
-
-
 def _print_timing(
     timing_element: Tuple[str, datetime.timedelta],
     adjust: bool = False,
@@ -132,6 +129,13 @@ def download_packages(
     repository_file_content: Mapping[str, Mapping[str, Union[str, Sequence[str]]]],
     download_destination: str,
     pip_executable: str = "pip",
+    *,
+    workers: int = 1,
+    protocol_limits: Optional[Dict[str, int]] = None,
+    download_cache: Optional[DownloadCache] = None,
+    git_options: Optional[GitCloneOptions] = None,
+    wheelhouse: Optional[Wheelhouse] = None,
+    fetch_plan: Optional[str] = None,
 ) -> Dict[str, str]:
     """Downloads all PyPI packages to destination. Tries to download other
         packages to destination too.
@@ -146,16 +150,45 @@ def download_packages(
     download_destination: A string of the path where packages should
         be downloaded to
     pip_executable: A string of the pip executable to use. Defaults to 'pip'
+    workers: The number of packages to fetch at the same time.
+    protocol_limits: The largest number of concurrent fetches per protocol
+        group, e.g. {"git": 4, "http": 8}.
+    download_cache: A cache of archives and git checkouts shared between
+        builds.
+    git_options: How git packages are cloned.
+    wheelhouse: A persistent wheelhouse to download pypi packages into,
+        instead of download_destination.
+    fetch_plan: A fetch plan file, written by --write-fetch-plan, to share
+        with other kmd processes downloading to the same destination.
 
     Returns:
     --
     Dict of git hashes found
     """
+    if fetch_plan:
+        os.makedirs(download_destination, exist_ok=True)
+        return run_fetch_plan(
+            FetchPlan.read(fetch_plan),
+            download_destination,
+            pip=pip_executable,
+            workers=workers,
+            protocol_limits=protocol_limits,
+            download_cache=download_cache,
+            git_options=git_options,
+            wheelhouse=wheelhouse,
+            shared=True,
+        )
+
     git_hashes = fetch(
         release_file_content,
         repository_file_content,
         outdir=download_destination,
         pip=pip_executable,
+        workers=workers,
+        protocol_limits=protocol_limits,
+        download_cache=download_cache,
+        git_options=git_options,
+        wheelhouse=wheelhouse,
     )
 
     return git_hashes
@@ -181,6 +214,9 @@ def build_non_pypi_packages_and_move_to_release_path(
         cmk=args.cmake,
         pip=args.pip,
         fakeroot=str(fakeroot),
+        workers=args.build_workers,
+        build_cache=BuildCache(args.build_cache) if args.build_cache else None,
+        logdir=args.log_dir,
     )
 
     shell(f"mv {args.release + str(tmp_prefix)} {args.release}")
@@ -227,10 +263,58 @@ def generate_release_manifest(
         yaml.dump(release, filehandle)
 
 
+def parse_rsync_stats(output: str) -> Dict[str, int]:
+    """Extract the total size and the transferred size, in bytes, from the
+    output of rsync --stats."""
+    stats = {"total": 0, "transferred": 0}
+    for key, pattern in [
+        ("total", r"^Total file size: ([\d,.]+) bytes"),
+        ("transferred", r"^Total transferred file size: ([\d,.]+) bytes"),
+    ]:
+        match = re.search(pattern, output, flags=re.MULTILINE)
+        if match:
+            stats[key] = int(re.sub(r"\D", "", match.group(1)))
+    return stats
+
+
 @profile_time("Rsyncing partial komodo to destination")
-def rsync_komodo_to_destination(release_name: str, destination: str) -> None:
+def rsync_komodo_to_destination(
+    release_name: str, destination: str, link_dest: Optional[Path] = None
+) -> Dict[str, int]:
+    """Copy the release to destination.
+
+    If link_dest is given, files that are identical to the ones in that
+    release are hard linked from it instead of copied.
+
+    Returns:
+        The number of bytes transferred, and the number of bytes linked.
+    """
     shell(f"mv {release_name} .{release_name}")
-    shell(f"rsync -a .{release_name} {destination}")
+    link_option = f"--link-dest={link_dest.resolve()}" if link_dest else None
+    output = shell(
+        [
+            "rsync -a --stats",
+            link_option,
+            f".{release_name}/ {destination}/.{release_name}/",
+        ]
+    )
+    stats = parse_rsync_stats(output.decode("utf-8", errors="replace"))
+    return {
+        "transferred": stats["transferred"],
+        "linked": stats["total"] - stats["transferred"] if link_dest else 0,
+    }
+
+
+def link_dest_path(prefix_path: Path, link_dest: Optional[str]) -> Optional[Path]:
+    """Find the release to hard link unchanged files from, a release name is
+    looked up in the prefix. Returns None if it does not exist (yet)."""
+    if not link_dest:
+        return None
+    path = prefix_path / link_dest
+    if not path.is_dir():
+        print(f"Reference release {path} not found, copying all files")
+        return None
+    return path
 
 
 def move_old_release_from_release_path_if_exists(release_path: Path) -> None:
@@ -295,22 +379,35 @@ def install_previously_downloaded_pip_packages(
     downloads_directory: str,
     pip_executable: str,
     release_root: Path,
+    *,
+    wheelhouse: Optional[Wheelhouse] = None,
 ) -> None:
+    """Install the pip packages of the release from downloads_directory, or
+    from wheelhouse if given."""
+
     def pip_shell_command(
         package_name: str, ver: str, makeopts: Optional[str]
     ) -> List[Optional[str]]:
+        if wheelhouse is not None:
+            # Distributions whose version pip accepts but which are not valid
+            # PEP 440 versions are not on the index, see Wheelhouse.missing
+            source_options = [
+                f"--index-url {wheelhouse.index_url}",
+                f"--find-links {wheelhouse.files}",
+            ]
+        else:
+            # assuming fetch.py has done "pip download" to this directory:
+            source_options = ["--no-index", f"--find-links {downloads_directory}"]
         return [
             pip_executable,
             f"install {package_name}=={strip_version(ver)}",
             "--prefix",
             str(release_root),
-            "--no-index",
             "--no-deps",
             "--ignore-installed",
             "--no-compile",
-            # assuming fetch.py has done "pip download" to this directory:
             f"--cache-dir {downloads_directory}",
-            f"--find-links {downloads_directory}",
+            *source_options,
             makeopts,
         ]
 
@@ -332,8 +429,8 @@ def run_post_installation_scripts_if_set(
     postinst: Optional[str], release_path: Path
 ) -> None:
     if postinst:
-        timing_func = profile_time("Running post-install scripts")
-        timing_func(shell([postinst, str(release_path)]))
+        with span("Running post-install scripts"):
+            shell([postinst, str(release_path)])
 
 
 @profile_time("Compile python bytecode files")
@@ -350,19 +447,25 @@ def compile_python_bytecode_files(release_root: Path) -> None:
 
 
 @profile_time("set permissions")
-def set_permissions(set_permissions_script: Path, release_path: Path) -> None:
-    print("Setting permissions", [set_permissions_script, release_path])
-    shell([str(set_permissions_script), str(release_path)])
+def set_permissions(release_path: Path) -> None:
+    print("Setting permissions", release_path)
+    changed = fix_permissions(release_path)
+    print(f"Changed permissions of {changed} files and directories")
 
 
 def compile_python_bytecode_files_and_fix_permissions(
-    release_root: Path, set_permissions_script_path, release_path: Path
+    release_root: Path, release_path: Path
 ):
-    set_permissions(set_permissions_script_path, release_path)
+    set_permissions(release_path)
     compile_python_bytecode_files(release_root)
 
 
-timings: List[Tuple[str, datetime.timedelta]] = []
+def write_trace(release_dir: Path, release_name: str) -> Path:
+    """Write the trace of the build next to the release manifest."""
+    trace_path = Path(release_dir) / f"{release_name}.trace.json"
+    tracer.write(trace_path)
+    print(f"Wrote build trace to {trace_path}")
+    return trace_path
 
 
 def _main(args: KomodoNamespace) -> None:
@@ -372,90 +475,131 @@ def _main(args: KomodoNamespace) -> None:
     ----
         args: KomodoNamespace instance with configuration
     """
-    data = Data(extra_data_dirs=args.extra_data_dirs)
-    git_hashes = None
-    if args.download or (not args.build and not args.install):
-        git_hashes = download_packages(
-            args.pkgs.content,
-            args.repo.content,
-            download_destination=args.downloads,
-            pip_executable=args.pip,
-        )
-        if is_download_only(args):
-            sys.exit(0)
+    tracer.reset()
+    if args.write_fetch_plan:
+        plan_fetch(args.pkgs.content, args.repo.content).write(args.write_fetch_plan)
+        print(f"Wrote fetch plan to {args.write_fetch_plan}")
+        return
+    # The trace is also written when the build fails, next to the release
+    # as far as it got
+    trace_dir = Path()
+    try:
+        data = Data(extra_data_dirs=args.extra_data_dirs)
+        git_hashes = None
+        if args.download or (not args.build and not args.install):
+            git_hashes = download_packages(
+                args.pkgs.content,
+                args.repo.content,
+                download_destination=args.downloads,
+                pip_executable=args.pip,
+                workers=args.fetch_workers,
+                protocol_limits=args.fetch_limits,
+                download_cache=(
+                    DownloadCache(args.download_cache, args.download_cache_size)
+                    if args.download_cache
+                    else None
+                ),
+                git_options=GitCloneOptions(
+                    mirrors=GitMirrors(args.git_mirrors) if args.git_mirrors else None,
+                    shallow=args.git_shallow,
+                    filter=args.git_filter,
+                    submodule_jobs=args.git_submodule_jobs,
+                ),
+                wheelhouse=Wheelhouse(args.wheelhouse) if args.wheelhouse else None,
+                fetch_plan=args.fetch_plan,
+            )
+            if is_download_only(args):
+                sys.exit(0)
 
-    prefix_path = Path(args.prefix)
-    release_path = prefix_path / args.release
-    check_for_possible_build_overwrite(
-        release_path=release_path, overwrite_enabled=args.overwrite
-    )
+        prefix_path = Path(args.prefix)
+        release_path = prefix_path / args.release
+        check_for_possible_build_overwrite(
+            release_path=release_path, overwrite_enabled=args.overwrite
+        )
 
-    release_root = generate_release_root(release_path)
+        release_root = generate_release_root(release_path)
+        trace_dir = Path(args.release)
 
-    if args.build or not args.install:
-        build_non_pypi_packages_and_move_to_release_path(args, data, release_root)
-        if is_build_only(args):
-            sys.exit(0)
+        if args.build or not args.install:
+            build_non_pypi_packages_and_move_to_release_path(args, data, release_root)
+            if is_build_only(args):
+                sys.exit(0)
 
-    create_enable_scripts(komodo_prefix=release_root, komodo_release=args.release)
+        create_enable_scripts(komodo_prefix=release_root, komodo_release=args.release)
 
-    generate_release_manifest(
-        args.release, args.pkgs.content, args.repo.content, git_hashes
-    )
+        generate_release_manifest(
+            args.release, args.pkgs.content, args.repo.content, git_hashes
+        )
 
-    if args.dry_run:
-        return
+        if args.dry_run:
+            return
 
-    print(f"Installing {args.release} to {args.prefix}")
+        print(f"Installing {args.release} to {args.prefix}")
 
-    rsync_komodo_to_destination(args.release, destination=prefix_path)
+        deploy_stats = rsync_komodo_to_destination(
+            args.release,
+            destination=prefix_path,
+            link_dest=link_dest_path(prefix_path, args.link_dest),
+        )
 
-    move_old_release_from_release_path_if_exists(release_path)
-    move_new_release_to_release_path(args, release_path)
-    delete_old_previously_moved_releases(prefix_path, args.release)
+        move_old_release_from_release_path_if_exists(release_path)
+        move_new_release_to_release_path(args, release_path)
+        trace_dir = release_path
+        delete_old_previously_moved_releases(prefix_path, args.release)
 
-    apply_fallback_tmpdir_for_pip_if_set(args.tmp)
+        apply_fallback_tmpdir_for_pip_if_set(args.tmp)
 
-    install_previously_downloaded_pip_packages(
-        args.pkgs.content,
-        args.repo.content,
-        downloads_directory=args.downloads,
-        pip_executable=args.pip,
-        release_root=release_root,
-    )
-
-    komodo_shims_version = args.pkgs.content.get(LAST_PACKAGE_TO_INSTALL)
-    if komodo_shims_version:
-        assert (
-            args.repo.content[LAST_PACKAGE_TO_INSTALL][komodo_shims_version]["fetch"]
-            == "git"
-        ), "komodo-shims install is only supported with git as fetch method"
-        assert (
-            args.repo.content[LAST_PACKAGE_TO_INSTALL][komodo_shims_version]["make"]
-            == "sh"
-        ), "komodo-shims install is only supported with sh as make method"
-        install_komodo_shims(
-            LAST_PACKAGE_TO_INSTALL,
-            komodo_shims_version,
+        install_previously_downloaded_pip_packages(
+            args.pkgs.content,
+            args.repo.content,
             downloads_directory=args.downloads,
             pip_executable=args.pip,
             release_root=release_root,
+            wheelhouse=Wheelhouse(args.wheelhouse) if args.wheelhouse else None,
         )
 
-    fixup_python_shebangs(args.prefix, args.release)
+        komodo_shims_version = args.pkgs.content.get(LAST_PACKAGE_TO_INSTALL)
+        if komodo_shims_version:
+            assert (
+                args.repo.content[LAST_PACKAGE_TO_INSTALL][komodo_shims_version][
+                    "fetch"
+                ]
+                == "git"
+            ), "komodo-shims install is only supported with git as fetch method"
+            assert (
+                args.repo.content[LAST_PACKAGE_TO_INSTALL][komodo_shims_version]["make"]
+                == "sh"
+            ), "komodo-shims install is only supported with sh as make method"
+            install_komodo_shims(
+                LAST_PACKAGE_TO_INSTALL,
+                komodo_shims_version,
+                downloads_directory=args.downloads,
+                pip_executable=args.pip,
+                release_root=release_root,
+            )
 
-    komodo.switch.create_activator_switch(data, args.prefix, args.release)
+        fixup_python_shebangs(args.prefix, args.release)
 
-    run_post_installation_scripts_if_set(args.postinst, release_path)
-    compile_python_bytecode_files_and_fix_permissions(
-        release_root,
-        set_permissions_script_path=data.get("set_permissions.sh"),
-        release_path=release_path,
-    )
+        komodo.switch.create_activator_switch(data, args.prefix, args.release)
+
+        run_post_installation_scripts_if_set(args.postinst, release_path)
+        compile_python_bytecode_files_and_fix_permissions(
+            release_root,
+            release_path=release_path,
+        )
 
-    print("Time report:")
-    for timing_element in timings:
-        _print_timing(timing_element, adjust=True)
+        print("Time report:")
+        for timing_element in tracer.durations("phase"):
+            _print_timing(timing_element, adjust=True)
+        print(
+            f" * {'Bytes transferred to destination':50} {deploy_stats['transferred']}"
+        )
+        if args.link_dest:
+            print(
+                f" * {'Bytes linked from ' + args.link_dest:50} {deploy_stats['linked']}"
+            )
+    finally:
+        write_trace(trace_dir if trace_dir.is_dir() else Path(), args.release)
 
 
 def cli_main():
@@ -469,6 +613,21 @@ def cli_main():
         _main(args)
 
 
+def parse_fetch_limit(value: str) -> Tuple[str, int]:
+    """Parse a PROTOCOL=LIMIT pair given to --fetch-limit.
+
+    >>> parse_fetch_limit("git=4")
+    ('git', 4)
+    """
+    protocol, _, limit = value.partition("=")
+    try:
+        return protocol, int(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Expected PROTOCOL=LIMIT, e.g. git=4, got {value}"
+        ) from None
+
+
 def parse_args(args: List[str]) -> KomodoNamespace:
     """Parse the arguments from the command line into an `argparse.Namespace`.
     Having a separated function makes it easier to test the CLI.
@@ -567,6 +726,161 @@ def parse_args(args: List[str]) -> KomodoNamespace:
         default=1,
         help="The number of parallel jobs to use for builds by cmake.",
     )
+    optional_args.add_argument(
+        "--build-workers",
+        type=int,
+        default=1,
+        help=(
+            "The number of packages to build at the same time. Packages are "
+            "only built in parallel when they do not depend on each other "
+            "through the `depends` lists in the repository."
+        ),
+    )
+    optional_args.add_argument(
+        "--log-dir",
+        type=str,
+        default=None,
+        help=(
+            "Write the output of the cmake, sh and rsync builds of each package "
+            "to <package>-<version>.log in this directory instead of the "
+            "console. None means print to the console."
+        ),
+    )
+    optional_args.add_argument(
+        "--link-dest",
+        type=str,
+        default=None,
+        help=(
+            "A deployed release, by name in the prefix or by path, to compare "
+            "against when installing. Unchanged files are hard linked from it "
+            "instead of copied, so they must not be modified in place "
+            "afterwards, e.g. by --postinst. None means copy all files."
+        ),
+    )
+    optional_args.add_argument(
+        "--build-cache",
+        type=str,
+        default=None,
+        help=(
+            "A directory in which the files installed by each cmake and sh "
+            "package are kept, and reused by later builds of the same package "
+            "from the same source, with the same makeopts, build script and "
+            "dependencies. Building an sh package which is not in the cache "
+            "holds up all other packages until it is done. "
+            "None means no cache."
+        ),
+    )
+    optional_args.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=1,
+        help="The number of packages to download at the same time.",
+    )
+    optional_args.add_argument(
+        "--fetch-limit",
+        dest="fetch_limits",
+        action="append",
+        type=parse_fetch_limit,
+        default=[],
+        metavar="PROTOCOL=LIMIT",
+        help=(
+            "Limit the number of concurrent downloads using one protocol, e.g. "
+            "git=4 or http=8 (http also covers https and ftp). "
+            "Can be given several times."
+        ),
+    )
+    optional_args.add_argument(
+        "--download-cache",
+        type=str,
+        default=None,
+        help=(
+            "A directory in which downloaded archives and git checkouts are "
+            "kept between builds, and can be shared by builds running at the "
+            "same time. None means no cache."
+        ),
+    )
+    optional_args.add_argument(
+        "--download-cache-size",
+        type=parse_size,
+        default=None,
+        help=(
+            "The size the download cache is trimmed to after downloading, "
+            "removing the least recently used entries first, e.g. 50G. "
+            "None means no limit."
+        ),
+    )
+    optional_args.add_argument(
+        "--git-mirrors",
+        type=str,
+        default=None,
+        help=(
+            "A directory of bare mirrors of the git repositories of fetch: git "
+            "packages. Mirrors are updated before cloning, and clones borrow "
+            "objects from them, so only new objects are downloaded. "
+            "None means no mirrors."
+        ),
+    )
+    optional_args.add_argument(
+        "--git-shallow",
+        action="store_true",
+        help=(
+            "Only clone the commit that is checked out of git packages, and of "
+            "their submodules. Packages that derive their version from the git "
+            "history need full clones."
+        ),
+    )
+    optional_args.add_argument(
+        "--git-filter",
+        type=str,
+        default=None,
+        help=(
+            "Make partial clones of git packages with this filter, "
+            "e.g. blob:none. None means full clones."
+        ),
+    )
+    optional_args.add_argument(
+        "--git-submodule-jobs",
+        type=int,
+        default=None,
+        help="The number of submodules of a git package fetched at the same time.",
+    )
+    optional_args.add_argument(
+        "--wheelhouse",
+        type=str,
+        default=None,
+        help=(
+            "A directory in which pypi packages are kept between builds, with "
+            "a generated simple index that pip installs from. Only packages "
+            "that are not in it are downloaded. None means download pypi "
+            "packages to the downloads directory on every build."
+        ),
+    )
+    optional_args.add_argument(
+        "--write-fetch-plan",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help=(
+            "Write the list of sources to fetch, with their source templates "
+            "rendered, to this file and exit. The file is only readable by its "
+            "owner, as sources may contain credentials."
+        ),
+    )
+    optional_args.add_argument(
+        "--fetch-plan",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help=(
+            "Download the sources listed in a file written by "
+            "--write-fetch-plan. Several kmd processes, also on different hosts "
+            "sharing the filesystem, can use the same plan and downloads "
+            "directory at the same time, each fetching the sources it claims "
+            "first, and all waiting until every source is fetched. Sources "
+            "claimed by a process on the same host which has died are fetched "
+            "again, and waiting for other hosts gives up after 6 hours."
+        ),
+    )
     optional_args.add_argument(
         "--download",
         "-d",
@@ -650,6 +964,7 @@ def parse_args(args: List[str]) -> KomodoNamespace:
     )
 
     args: KomodoNamespace = parser.parse_args(args, namespace=KomodoNamespace())
+    args.fetch_limits = dict(args.fetch_limits)
 
     return args
 
@@ -0,0 +1,167 @@
+"""Copy local source trees in-process, in parallel.
+
+Files are cloned with a reflink where the filesystem supports it, which
+shares the data blocks of the source until either copy is changed. Otherwise
+copy_file_range lets the kernel (or an NFS server) copy the data without it
+passing through komodo. Files whose size and modification time already
+match the source are skipped.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+_FALLBACK_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+}
+
+
+def _copy_data(source: str, destination: str) -> None:
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError as err:
+            if err.errno not in _FALLBACK_ERRNOS:
+                raise
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError as err:
+                if err.errno not in _FALLBACK_ERRNOS:
+                    raise
+                # Nothing may have been written, but start over to be sure
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst, 1024**2)
+
+
+def copy_file(
+    source: str, destination: str, source_stat: Optional[os.stat_result] = None
+) -> bool:
+    """Copy the file at source to destination with its mode and modification
+    time, unless destination already has the same size and modification time.
+
+    Returns:
+        Whether the file was copied.
+    """
+    source_stat = source_stat or os.stat(source)
+    try:
+        existing = os.lstat(destination)
+        if not stat.S_ISREG(existing.st_mode):
+            os.unlink(destination)
+        elif (
+            existing.st_size == source_stat.st_size
+            and existing.st_mtime_ns == source_stat.st_mtime_ns
+        ):
+            return False
+    except FileNotFoundError:
+        pass
+    _copy_data(source, destination)
+    os.chmod(destination, stat.S_IMODE(source_stat.st_mode))
+    # Set last, so that an interrupted copy is not mistaken for a complete one
+    os.utime(destination, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    return True
+
+
+def _walk(
+    source: str,
+    destination: str,
+    symlink: bool,
+    directories: List[Tuple[str, str]],
+) -> List[Tuple[str, str, os.stat_result]]:
+    files = []
+    os.makedirs(destination, exist_ok=True)
+    with os.scandir(source) as entries:
+        for entry in entries:
+            target = os.path.join(destination, entry.name)
+            if entry.is_symlink():
+                if os.path.lexists(target):
+                    os.unlink(target)
+                os.symlink(os.readlink(entry.path), target)
+                continue
+            if entry.is_dir():
+                files += _walk(entry.path, target, symlink, directories)
+                continue
+            entry_stat = entry.stat(follow_symlinks=False)
+            if not stat.S_ISREG(entry_stat.st_mode):
+                # Opening a FIFO would block, and devices and sockets
+                # have no content to copy
+                print(
+                    f"Warning: skipping {entry.path}, which is not a regular file",
+                    file=sys.stderr,
+                )
+            elif symlink:
+                if not os.path.lexists(target):
+                    os.symlink(entry.path, target)
+            else:
+                files.append((entry.path, target, entry_stat))
+    directories.append((source, destination))
+    return files
+
+
+def copy_tree(
+    source: Union[str, os.PathLike],
+    destination: Union[str, os.PathLike],
+    symlink: bool = False,
+    workers: Optional[int] = None,
+) -> Dict[str, int]:
+    """Copy the directory tree at source into destination.
+
+    Directories are created and symlinks recreated as they are found, and
+    files are copied by a pool of threads. Directories get the mode and
+    times of their source once everything in them is copied. Special files,
+    like FIFOs, sockets and devices, are skipped with a warning.
+
+    Args:
+        source: The directory to copy.
+        destination: The directory to copy to. Created if it does not exist.
+        symlink: Instead of copying files, make absolute symlinks to them,
+            like cp --recursive --symbolic-link.
+        workers: The number of threads copying files.
+
+    Returns:
+        The number of files copied and skipped, and the bytes copied.
+    """
+    source = os.path.abspath(source)
+    destination = os.fspath(destination)
+    if not os.path.isdir(source):
+        if symlink:
+            os.symlink(source, destination)
+            return {"copied": 0, "skipped": 0, "bytes": 0}
+        copied = copy_file(source, destination)
+        size = os.path.getsize(source) if copied else 0
+        return {"copied": int(copied), "skipped": int(not copied), "bytes": size}
+    directories: List[Tuple[str, str]] = []
+    files = _walk(source, destination, symlink, directories)
+    stats = {"copied": 0, "skipped": 0, "bytes": 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        copied = pool.map(lambda item: copy_file(*item), files)
+        for (_, _, source_stat), was_copied in zip(files, copied):
+            if was_copied:
+                stats["copied"] += 1
+                stats["bytes"] += source_stat.st_size
+            else:
+                stats["skipped"] += 1
+    # Subdirectories come before their parents, so that copying the times of
+    # a directory is not undone by changes to its contents
+    for source_dir, destination_dir in directories:
+        shutil.copystat(source_dir, destination_dir)
+    return stats
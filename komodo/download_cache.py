@@ -0,0 +1,166 @@
+"""A download cache which is shared between komodo builds.
+
+Every entry is stored under a key made from the package name, its version,
+the resolved source url and, for git sources, the commit that is checked
+out. Entries are written to a temporary location and renamed into place, so
+builds running at the same time never see a partial entry, and eviction
+takes an exclusive lock that waits for builds which are copying out of the
+cache.
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+_SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(value: str) -> int:
+    """Parse a size in bytes with an optional K, M, G or T suffix.
+
+    >>> parse_size("512"), parse_size("2K"), parse_size("1.5G")
+    (512, 2048, 1610612736)
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", value.upper())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    number, suffix = match.groups()
+    return int(float(number) * _SIZE_SUFFIXES[suffix])
+
+
+def _tree_size(path: Path) -> int:
+    if not path.is_dir() or path.is_symlink():
+        return path.lstat().st_size
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            total += os.lstat(os.path.join(root, filename)).st_size
+    return total
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    try:
+        os.link(source, destination)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, destination)
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+class DownloadCache:
+    def __init__(self, path: Union[str, Path], max_size: Optional[int] = None):
+        """A persistent cache of fetched sources.
+
+        Args:
+            path: The directory holding the cache. Created if it does not exist.
+            max_size: The number of bytes the cache may hold after evict().
+                None means no limit.
+        """
+        self.path = Path(path).absolute()
+        self.max_size = max_size
+        self._entries = self.path / "entries"
+        self._tmp = self.path / "tmp"
+        self._entries.mkdir(parents=True, exist_ok=True)
+        self._tmp.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(package: str, version: str, url: str, commit: Optional[str] = None) -> str:
+        content = json.dumps([package, version, url, commit])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @contextlib.contextmanager
+    def _lock(self, operation: int) -> Iterator[None]:
+        with open(self.path / "lock", "a", encoding="utf-8") as lockfile:
+            fcntl.flock(lockfile, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def restore(self, key: str, destination: Union[str, Path]) -> bool:
+        """Put the entry for key at destination, if there is one.
+
+        Files are hard linked into place when possible. Directories, such as
+        git checkouts, are copied since builds may write to them.
+
+        Returns:
+            Whether there was an entry for key.
+        """
+        entry = self._entries / key
+        with self._lock(fcntl.LOCK_SH):
+            artifact = entry / "artifact"
+            if not (artifact.exists() or artifact.is_symlink()):
+                return False
+            if artifact.is_dir() and not artifact.is_symlink():
+                shutil.copytree(artifact, destination, symlinks=True)
+            else:
+                _link_or_copy(str(artifact), str(destination))
+            (entry / "last-used").touch()
+        return True
+
+    def store(self, key: str, source: Union[str, Path]) -> None:
+        """Add a copy of source to the cache under key, unless another build
+        has already done so.
+        """
+        staging = self._tmp / uuid.uuid4().hex
+        staging.mkdir()
+        try:
+            artifact = staging / "artifact"
+            source = Path(source)
+            if source.is_dir() and not source.is_symlink():
+                shutil.copytree(source, artifact, symlinks=True)
+            else:
+                _link_or_copy(str(source), str(artifact))
+            (staging / "size").write_text(str(_tree_size(artifact)), encoding="utf-8")
+            (staging / "last-used").touch()
+            with self._lock(fcntl.LOCK_SH):
+                try:
+                    staging.rename(self._entries / key)
+                except OSError as err:
+                    if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+        finally:
+            _remove(staging)
+
+    def evict(self) -> int:
+        """Remove the least recently used entries until the cache holds at
+        most max_size bytes.
+
+        Returns:
+            The number of bytes removed.
+        """
+        if self.max_size is None:
+            return 0
+        with self._lock(fcntl.LOCK_EX):
+            entries = []
+            for entry in self._entries.iterdir():
+                try:
+                    size = int((entry / "size").read_text(encoding="utf-8"))
+                    last_used = (entry / "last-used").stat().st_mtime
+                except (OSError, ValueError):
+                    # Left behind by an interrupted build
+                    size, last_used = 0, 0.0
+                entries.append((last_used, size, entry))
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, entry in sorted(entries, key=lambda e: e[0]):
+                if total - removed <= self.max_size:
+                    break
+                _remove(entry)
+                removed += size
+        return removed
@@ -0,0 +1,239 @@
+"""Download large files over http(s) with resume and parallel segments.
+
+Files are written to ``<destination>.part`` and renamed into place once
+complete and verified. If a transfer is interrupted, the download continues
+from where it stopped using an HTTP Range request, also when a later build
+finds a ``.part`` file left behind. Large files are fetched in several
+segments at the same time when the server supports ranges. The SHA-256 of
+the file is computed while it is downloaded.
+"""
+
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import requests
+
+from komodo.tracing import span
+
+BUFFER_SIZE = 1024**2
+SEGMENT_THRESHOLD = 64 * 1024**2
+
+
+class Downloader:
+    """Download files using one shared session, so that connections are
+    reused between packages.
+
+    Args:
+        segments: The number of parallel segments for large files.
+        segment_threshold: Files of at least this many bytes are downloaded
+            in segments, if the server supports ranges.
+        retries: How many times an interrupted transfer is resumed.
+        buffer_size: The number of bytes read from the network at a time.
+    """
+
+    def __init__(
+        self,
+        segments: int = 4,
+        segment_threshold: int = SEGMENT_THRESHOLD,
+        retries: int = 5,
+        buffer_size: int = BUFFER_SIZE,
+    ) -> None:
+        self.segments = max(segments, 1)
+        self.segment_threshold = segment_threshold
+        self.retries = retries
+        self.buffer_size = buffer_size
+        self._session: Optional[requests.Session] = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    max_retries=20, pool_maxsize=max(self.segments, 10)
+                )
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+            return self._session
+
+    def _get(self, url: str, start: int = 0, end: Optional[int] = None):
+        headers = {}
+        if start or end is not None:
+            headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+        response = self.session.get(url, stream=True, headers=headers, timeout=60)
+        if response.status_code not in {requests.codes.ok, requests.codes.partial}:
+            response.close()
+            msg = f"GET request to {url} returned status code {response.status_code}"
+            raise RuntimeError(msg)
+        return response
+
+    def download(
+        self,
+        url: str,
+        destination: Union[str, os.PathLike],
+        sha256: Optional[str] = None,
+    ) -> str:
+        """Download url to destination and return the SHA-256 of the file.
+
+        Raises:
+            RuntimeError: If the server does not return the file.
+            ValueError: If sha256 is given and does not match the file.
+        """
+        destination = Path(destination)
+        part = destination.with_name(destination.name + ".part")
+        with span("download", category="download", url=url.split("?", 1)[0]):
+            digest, resumed = self._fetch(url, part)
+            if sha256 is not None and digest != sha256 and resumed:
+                # The partial file may be left from a different file at url
+                part.unlink()
+                digest, _ = self._fetch(url, part)
+            if sha256 is not None and digest != sha256:
+                part.unlink()
+                msg = f"Hash of downloaded file ({digest}) not equal to expected hash."
+                raise ValueError(msg)
+            os.replace(part, destination)
+        return digest
+
+    def _fetch(self, url: str, part: Path) -> Tuple[str, bool]:
+        """Download url to part, continuing what is already in part.
+
+        Returns:
+            The SHA-256 of the file, and whether an earlier partial file was
+            continued.
+        """
+        hasher = hashlib.sha256()
+        offset = _hash_file(part, hasher, self.buffer_size) if part.exists() else 0
+        try:
+            response = self._get(url, start=offset)
+        except RuntimeError:
+            if not offset:
+                raise
+            # E.g. 416 if the partial file is complete, or stale
+            part.unlink()
+            offset = 0
+            response = self._get(url)
+        size = _content_length(response)
+        if response.status_code != requests.codes.partial:
+            # The server ignored the range, start over
+            offset = 0
+            hasher = hashlib.sha256()
+        if (
+            offset == 0
+            and self.segments > 1
+            and size is not None
+            and size >= self.segment_threshold
+            and response.headers.get("Accept-Ranges") == "bytes"
+        ):
+            response.close()
+            self._download_segments(url, part, size, hasher)
+        else:
+            hasher = self._download_stream(url, part, response, offset, hasher)
+        return hasher.hexdigest(), offset > 0
+
+    def _download_stream(self, url, part, response, offset, hasher):
+        attempt = 0
+        with open(part, "r+b" if offset else "wb") as file_handle:
+            file_handle.truncate(offset)
+            file_handle.seek(offset)
+            while True:
+                try:
+                    with response:
+                        for chunk in response.iter_content(self.buffer_size):
+                            file_handle.write(chunk)
+                            hasher.update(chunk)
+                            offset += len(chunk)
+                    return hasher
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                ):
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+                response = self._get(url, start=offset)
+                if response.status_code != requests.codes.partial:
+                    offset = 0
+                    hasher = hashlib.sha256()
+                    file_handle.seek(0)
+                    file_handle.truncate()
+
+    def _download_segment(self, url, part, start, end) -> None:
+        attempt = 0
+        fd = os.open(part, os.O_WRONLY)
+        try:
+            while start <= end:
+                try:
+                    with self._get(url, start=start, end=end) as response:
+                        if response.status_code != requests.codes.partial:
+                            msg = f"{url} does not support range requests"
+                            raise RuntimeError(msg)
+                        for chunk in response.iter_content(self.buffer_size):
+                            os.pwrite(fd, chunk, start)
+                            start += len(chunk)
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                ):
+                    if attempt >= self.retries:
+                        raise
+                if start <= end:
+                    attempt += 1
+                    if attempt > self.retries:
+                        msg = f"Download of {url} stopped at byte {start} of {end}"
+                        raise RuntimeError(msg)
+        finally:
+            os.close(fd)
+
+    def _download_segments(self, url, part, size, hasher) -> None:
+        with open(part, "wb") as file_handle:
+            file_handle.truncate(size)
+        segment_size = -(-size // self.segments)
+        bounds = [
+            (start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)
+        ]
+        try:
+            with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+                futures = [
+                    pool.submit(self._download_segment, url, part, start, end)
+                    for start, end in bounds
+                ]
+                # Hash each segment as soon as it and all before it are complete
+                with open(part, "rb") as file_handle:
+                    for future, (start, end) in zip(futures, bounds):
+                        future.result()
+                        remaining = end - start + 1
+                        while remaining:
+                            chunk = file_handle.read(min(self.buffer_size, remaining))
+                            hasher.update(chunk)
+                            remaining -= len(chunk)
+        except BaseException:
+            # The file has holes, it cannot be resumed from its size
+            part.unlink()
+            raise
+
+
+def _content_length(response) -> Optional[int]:
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("*"):
+        return int(content_range.rsplit("/", 1)[1])
+    length = response.headers.get("Content-Length")
+    return int(length) if length is not None else None
+
+
+def _hash_file(path: Path, hasher, buffer_size: int) -> int:
+    size = 0
+    with open(path, "rb") as file_handle:
+        while chunk := file_handle.read(buffer_size):
+            hasher.update(chunk)
+            size += len(chunk)
+    return size
+
+
+# Shared by all download packages, so that connections are reused
+downloader = Downloader()
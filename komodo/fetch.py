@@ -2,16 +2,36 @@
 
 
 import argparse
+import contextlib
+import json
 import os
+import shutil
+import socket
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional, Union
 
 import jinja2
+import requests
+import urllib3
 
+from komodo.copier import copy_tree
+from komodo.download_cache import DownloadCache
+from komodo.downloader import downloader
+from komodo.git_mirror import GitCloneOptions
 from komodo.package_version import (
+    get_git_remote_hash,
     get_git_revision_hash,
     strip_version,
 )
-from komodo.shell import pushd, shell
+from komodo.scheduler import run_in_dependency_order
+from komodo.shell import shell
+from komodo.tracing import span
+from komodo.wheelhouse import Wheelhouse, pip_compatible_tags
 from komodo.yaml_file_types import ReleaseFile, RepositoryFile
 
 
@@ -19,42 +39,191 @@ def eprint(*args, **kwargs):
     return print(*args, file=sys.stderr, **kwargs)
 
 
-def grab(path, filename=None, version=None, protocol=None):
-    # guess protocol if it's obvious from the url (usually is)
-    if protocol is None:
-        protocol = path.split(":")[0]
+def protocol_group(protocol: str) -> str:
+    """The name under which a fetch protocol is rate limited.
 
+    >>> protocol_group("https"), protocol_group("git"), protocol_group("fs-cp")
+    ('http', 'git', 'fs-cp')
+    """
     if protocol in ("http", "https", "ftp"):
-        shell(f"wget --quiet {path} -O {filename}")
-    elif protocol in ("git"):
+        return "http"
+    return protocol
+
+
+def _git_clone(path, filename, version, cwd, git_options):
+    def clone(reference=None):
+        arguments = " ".join(git_options.clone_arguments(reference))
         shell(
             "git clone "
             f"-b {strip_version(version)} "
             "--quiet "
             "--recurse-submodules "
+            f"{arguments + ' ' if arguments else ''}"
             f"-- {path} {filename}",
+            cwd=cwd,
         )
 
+    if git_options.mirrors is None:
+        clone()
+    else:
+        with git_options.mirrors.reference(path) as mirror:
+            clone(mirror)
+
+
+ARCHIVE_EXTENSIONS = ("tgz", "tar.gz", "tar.bz2", "tar.xz")
+
+# How many times an interrupted download of an archive is started over
+EXTRACT_RETRIES = 3
+
+
+def extract_archive(fileobj, outdir) -> Optional[str]:
+    """Extract the tar archive read from fileobj into outdir, one member at a
+    time as the archive is read, so that fileobj can be a download.
+
+    Returns:
+        The top-level directory of the first member of the archive.
+    """
+    topdir = None
+
+    def members(archive):
+        nonlocal topdir
+        for member in archive:
+            if topdir is None:
+                parts = [part for part in member.name.split("/") if part != "."]
+                topdir = next(filter(None, parts), None)
+            yield member
+
+    # Refuse absolute paths and paths outside outdir, where supported
+    kwargs = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        archive.extractall(outdir, members=members(archive), **kwargs)
+    return topdir
+
+
+def _stream_and_extract(url, outdir) -> Optional[str]:
+    response = downloader.session.get(url, stream=True, timeout=60)
+    with response:
+        if response.status_code != requests.codes.ok:
+            msg = f"GET request to {url} returned status code {response.status_code}"
+            raise RuntimeError(msg)
+        # The compression is handled by tarfile, also if the server claims a
+        # Content-Encoding for the archive
+        response.raw.decode_content = False
+        return extract_archive(response.raw, outdir)
+
+
+def download_and_extract(url, outdir, retries=EXTRACT_RETRIES) -> Optional[str]:
+    """Extract the tar archive at url into outdir while it downloads, without
+    writing the archive to disk.
+
+    The archive is extracted into a temporary directory in outdir and moved
+    into place when complete. If the download is interrupted, the partial
+    extraction is removed and the download started over, up to `retries`
+    times.
+    """
+    for attempt in range(retries + 1):
+        staging = tempfile.mkdtemp(prefix=".extract-", dir=outdir)
+        try:
+            topdir = _stream_and_extract(url, staging)
+            for name in os.listdir(staging):
+                target = os.path.join(outdir, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                elif os.path.lexists(target):
+                    os.unlink(target)
+                os.replace(os.path.join(staging, name), target)
+            return topdir
+        except (
+            requests.exceptions.RequestException,
+            urllib3.exceptions.HTTPError,
+            ConnectionError,
+            tarfile.ReadError,
+            EOFError,
+        ) as err:
+            if attempt == retries:
+                raise
+            eprint(f"Download interrupted, starting over: {err}")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    return None
+
+
+def is_remote_path(path: str) -> bool:
+    """Whether rsync would read path from another host.
+
+    >>> is_remote_path("host:/src"), is_remote_path("rsync://host/src")
+    (True, True)
+    >>> is_remote_path("/nfs/src"), is_remote_path("../src:1.0")
+    (False, False)
+    """
+    return path.startswith("rsync://") or ":" in path.split("/", 1)[0]
+
+
+def grab(
+    path, filename=None, version=None, protocol=None, *, cwd=None, git_options=None
+):
+    # guess protocol if it's obvious from the url (usually is)
+    if protocol is None:
+        protocol = path.split(":")[0]
+
+    if protocol in ("http", "https", "ftp"):
+        shell(f"wget --quiet {path} -O {filename}", cwd=cwd)
+    elif protocol in ("git"):
+        _git_clone(path, filename, version, cwd, git_options or GitCloneOptions())
+
     elif protocol in ("nfs", "fs-ln"):
-        if sys.platform == "darwin":
-            shell(f"cp -Rs {path} {filename}")
-        else:
-            shell(f"cp --recursive --symbolic-link {path} {filename}")
+        copy_tree(
+            os.path.join(cwd or ".", path),
+            os.path.join(cwd or ".", filename),
+            symlink=True,
+        )
 
     elif protocol in ("fs-cp"):
-        if sys.platform == "darwin":
-            shell(f"cp -R {path} {filename}")
-        else:
-            shell(f"cp --recursive {path} {filename}")
+        copy_tree(os.path.join(cwd or ".", path), os.path.join(cwd or ".", filename))
 
     elif protocol in ("rsync"):
-        shell(f"rsync -a {path}/ {filename}")
+        if is_remote_path(path):
+            shell(f"rsync -a {path}/ {filename}", cwd=cwd)
+        else:
+            copy_tree(
+                os.path.join(cwd or ".", path), os.path.join(cwd or ".", filename)
+            )
     else:
         msg = f"Unknown protocol {protocol}"
         raise NotImplementedError(msg)
 
 
-def fetch(pkgs, repo, outdir, pip="pip") -> dict:
+def fetch(
+    pkgs,
+    repo,
+    outdir,
+    pip="pip",
+    *,
+    workers: int = 1,
+    protocol_limits: Optional[Dict[str, int]] = None,
+    download_cache: Optional[DownloadCache] = None,
+    git_options: Optional[GitCloneOptions] = None,
+    wheelhouse: Optional[Wheelhouse] = None,
+) -> dict:
+    """Fetch the sources of all packages in pkgs into outdir.
+
+    Up to `workers` packages are fetched at the same time. protocol_limits
+    maps a protocol group (see protocol_group(), e.g. "git" or "http") to the
+    largest number of concurrent fetches using that protocol.
+
+    Archives and git checkouts found in download_cache are linked or copied
+    from there instead of being downloaded, and new ones are added to it.
+
+    git_options controls how git packages are cloned, e.g. from local mirrors
+    or as shallow clones.
+
+    If wheelhouse is given, pypi packages are downloaded into it instead of
+    outdir, unless it already has them.
+
+    Returns:
+        A mapping from the name of every package fetched with git to the
+        commit that was checked out.
+    """
     missingpkg = [pkg for pkg in pkgs if pkg not in repo]
     missingver = [
         pkg for pkg, ver in pkgs.items() if pkg in repo and ver not in repo[pkg]
@@ -73,6 +242,8 @@ def fetch(pkgs, repo, outdir, pip="pip") -> dict:
     if missingpkg or missingver:
         return {}
 
+    plan = plan_fetch(pkgs, repo)
+
     if not outdir:
         msg = "The value of `outdir`, the download destination location cannot be None or the empty string."
         raise ValueError(
@@ -86,43 +257,98 @@ def fetch(pkgs, repo, outdir, pip="pip") -> dict:
     if not os.path.exists(outdir):
         os.mkdir(outdir)
 
-    pypi_packages = []
+    return run_fetch_plan(
+        plan,
+        outdir,
+        pip=pip,
+        workers=workers,
+        protocol_limits=protocol_limits,
+        download_cache=download_cache,
+        git_options=git_options,
+        wheelhouse=wheelhouse,
+    )
 
-    git_hashes = {}
-    with pushd(outdir):
-        for pkg, ver in pkgs.items():
-            current = repo[pkg][ver]
-            if "pypi_package_name" in current and current["make"] != "pip":
-                msg = "pypi_package_name is only valid when building with pip"
-                raise ValueError(
-                    msg,
-                )
 
-            if "source" in current:
-                templater = jinja2.Environment(loader=jinja2.BaseLoader).from_string(
-                    current.get("source"),
-                )
-                url = templater.render(os.environ)
-            else:
-                url = None
+@dataclass
+class FetchItem:
+    """One source to fetch.
+
+    Args:
+        package: The name of the package in the repository.
+        version: The version of the package.
+        name: A description of the item for the log.
+        artifact: The directory the build expects in the download directory,
+            <package>-<version>.
+        url: The rendered source, None if there is nothing to fetch.
+        protocol: The fetch protocol, None to guess it from the url.
+        destination: The file or directory the source is fetched to.
+        extension: The archive extension of the url, if any.
+    """
+
+    package: str
+    version: str
+    name: str
+    artifact: str
+    url: Optional[str]
+    protocol: Optional[str]
+    destination: str
+    extension: str
+
+
+@dataclass
+class FetchPlan:
+    """Everything fetch() downloads, with the source templates rendered."""
+
+    items: List[FetchItem] = field(default_factory=list)
+    pypi_packages: List[str] = field(default_factory=list)
+
+    def write(self, path: Union[str, os.PathLike]) -> None:
+        """Write the plan as JSON. The file is only readable by the owner,
+        since rendered sources may contain credentials."""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with open(fd, "w", encoding="utf-8") as plan_file:
+            json.dump(asdict(self), plan_file, indent=2)
+
+    @classmethod
+    def read(cls, path: Union[str, os.PathLike]) -> "FetchPlan":
+        with open(path, encoding="utf-8") as plan_file:
+            content = json.load(plan_file)
+        return cls(
+            items=[FetchItem(**item) for item in content["items"]],
+            pypi_packages=content["pypi_packages"],
+        )
 
-            protocol = current.get("fetch")
-            pkg_alias = current.get("pypi_package_name", pkg)
 
-            name = f"{pkg_alias} ({ver}): {url}"
-            pkgname = f"{pkg_alias}-{ver}"
+def plan_fetch(pkgs, repo) -> FetchPlan:
+    """Work out what fetch() downloads for the packages in pkgs, rendering
+    the source templates with the environment."""
+    plan = FetchPlan()
+    for pkg, ver in pkgs.items():
+        current = repo[pkg][ver]
+        if "pypi_package_name" in current and current["make"] != "pip":
+            msg = "pypi_package_name is only valid when building with pip"
+            raise ValueError(
+                msg,
+            )
+
+        if "source" in current:
+            templater = jinja2.Environment(loader=jinja2.BaseLoader).from_string(
+                current.get("source"),
+            )
+            url = templater.render(os.environ)
+        else:
+            url = None
 
-            if url is None and protocol is None:
-                package_folder = os.path.abspath(pkgname)
-                print(
-                    f"Nothing to fetch for {pkgname}, "
-                    f"but created folder {package_folder}",
-                )
-                os.mkdir(pkgname)
-                continue
+        protocol = current.get("fetch")
+        pkg_alias = current.get("pypi_package_name", pkg)
 
-            dst = pkgname
+        name = f"{pkg_alias} ({ver}): {url}"
+        pkgname = f"{pkg_alias}-{ver}"
 
+        dst = pkgname
+        ext = ""
+        if url is not None:
             spliturl = url.split("?")[0].split(".")
             ext = spliturl[-1]
 
@@ -132,30 +358,301 @@ def fetch(pkgs, repo, outdir, pip="pip") -> dict:
             if ext in ["tar", "gz", "tgz", "tar.gz", "tar.bz2", "tar.xz"]:
                 dst = f"{dst}.{ext}"
 
-            if url == "pypi":
-                print(f"Deferring download of {name}")
-                pypi_packages.append(f"{pkg_alias}=={ver.split('+')[0]}")
+        if url == "pypi":
+            print(f"Deferring download of {name}")
+            plan.pypi_packages.append(f"{pkg_alias}=={ver.split('+')[0]}")
+            continue
+
+        plan.items.append(FetchItem(pkg, ver, name, pkgname, url, protocol, dst, ext))
+    return plan
+
+
+class _Claims:
+    """Claim files which let several processes, possibly on different hosts
+    sharing a filesystem, split the items of a fetch plan between them.
+
+    A claim holds the host name and process id of its owner. If the owner
+    ran on this host and is gone, e.g. because it was killed, its claim is
+    stale and is taken over by a waiting process.
+    """
+
+    POLL_INTERVAL = 2.0
+    # How long to wait for other processes before giving up
+    TIMEOUT = 6 * 60 * 60.0
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _owner() -> str:
+        return f"{socket.gethostname()} {os.getpid()}"
+
+    def claim(self, key: str) -> bool:
+        try:
+            fd = os.open(
+                os.path.join(self.path, key), os.O_WRONLY | os.O_CREAT | os.O_EXCL
+            )
+        except FileExistsError:
+            return False
+        with open(fd, "w", encoding="utf-8") as claim_file:
+            claim_file.write(f"{self._owner()}\n")
+        return True
+
+    def finish(self, key: str, succeeded: bool) -> None:
+        suffix = "done" if succeeded else "failed"
+        with open(os.path.join(self.path, f"{key}.{suffix}"), "w", encoding="utf-8"):
+            pass
+
+    def _stale_owner(self, key: str) -> Optional[str]:
+        """The owner of the claim on key if it ran on this host and has
+        exited, otherwise None."""
+        try:
+            with open(os.path.join(self.path, key), encoding="utf-8") as claim_file:
+                owner = claim_file.read().strip()
+        except FileNotFoundError:
+            return None
+        host, _, pid = owner.partition(" ")
+        if host != socket.gethostname() or not pid.isdigit():
+            return None
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return owner
+        except PermissionError:
+            pass  # running as another user
+        return None
+
+    def take_over(self, key: str) -> bool:
+        """Claim key if its claim is stale. Of the processes finding the
+        same stale claim, only one takes it over."""
+        owner = self._stale_owner(key)
+        if owner is None:
+            return False
+        marker = os.path.join(self.path, f"{key}.taken-from-{owner.replace(' ', '-')}")
+        try:
+            os.close(os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return False
+        tmp = os.path.join(self.path, f".{key}.{os.getpid()}")
+        with open(tmp, "w", encoding="utf-8") as claim_file:
+            claim_file.write(f"{self._owner()}\n")
+        os.replace(tmp, os.path.join(self.path, key))
+        print(f"Taking over {key} from {owner}, which is no longer running")
+        return True
+
+    def wait(self, keys: List[str], take_over: Callable[[str], None]) -> None:
+        """Wait until the items of keys are fetched, calling take_over with
+        the key of each item whose claim is stale.
+
+        Raises:
+            RuntimeError: If fetching an item failed in another process.
+            TimeoutError: If the items are not fetched within TIMEOUT seconds.
+        """
+        deadline = time.monotonic() + self.TIMEOUT
+        pending = list(keys)
+        while True:
+            for key in pending:
+                if os.path.exists(os.path.join(self.path, f"{key}.failed")):
+                    msg = f"Fetching {key} failed in another process"
+                    raise RuntimeError(msg)
+            pending = [
+                key
+                for key in pending
+                if not os.path.exists(os.path.join(self.path, f"{key}.done"))
+            ]
+            if not pending:
+                return
+            taken = [key for key in pending if self.take_over(key)]
+            for key in taken:
+                take_over(key)
+            if taken:
                 continue
+            if time.monotonic() > deadline:
+                msg = (
+                    "Timed out waiting for other processes to fetch "
+                    f"{', '.join(pending)}"
+                )
+                raise TimeoutError(msg)
+            print(f"Waiting for other processes to fetch {', '.join(pending)}")
+            time.sleep(self.POLL_INTERVAL)
+
+
+def run_fetch_plan(
+    plan: FetchPlan,
+    outdir,
+    pip="pip",
+    *,
+    workers: int = 1,
+    protocol_limits: Optional[Dict[str, int]] = None,
+    download_cache: Optional[DownloadCache] = None,
+    git_options: Optional[GitCloneOptions] = None,
+    wheelhouse: Optional[Wheelhouse] = None,
+    shared: bool = False,
+) -> Dict[str, str]:
+    """Fetch the items of plan into outdir, see fetch().
+
+    If shared is set, several processes can run the same plan into the same
+    outdir at the same time. Each item is fetched by the process that claims
+    it first, and every process waits until all items are fetched.
+
+    Returns:
+        A mapping from the name of every package fetched with git to the
+        commit that was checked out.
+    """
+    claims = _Claims(os.path.join(outdir, ".fetch-claims")) if shared else None
+
+    def create_folder(item):
+        package_folder = os.path.abspath(os.path.join(outdir, item.artifact))
+        print(
+            f"Nothing to fetch for {item.artifact}, but created folder {package_folder}",
+        )
+        os.mkdir(package_folder)
+        if claims is not None:
+            claims.finish(item.artifact, succeeded=True)
+
+    downloads = {}
+    for item in plan.items:
+        if claims is not None and not claims.claim(item.artifact):
+            continue
+        if item.url is None and item.protocol is None:
+            create_folder(item)
+            continue
+        downloads[item.package] = item
+
+    limits = {
+        group: threading.BoundedSemaphore(limit)
+        for group, limit in (protocol_limits or {}).items()
+    }
+
+    def cache_key(pkg, url, protocol, ver):
+        if download_cache is None:
+            return None
+        if protocol == "git":
+            commit = get_git_remote_hash(url, strip_version(ver))
+            if commit is None:
+                return None
+            return DownloadCache.key(pkg, ver, url, commit)
+        if protocol_group(protocol or url.split(":")[0]) == "http":
+            return DownloadCache.key(pkg, ver, url)
+        return None
+
+    def fetch_package(item):
+        with span(f"{item.package} ({item.version})", "fetch"):
+            try:
+                _fetch_package(item)
+            except BaseException:
+                if claims is not None:
+                    claims.finish(item.artifact, succeeded=False)
+                raise
+        if claims is not None:
+            claims.finish(item.artifact, succeeded=True)
+
+    def _fetch_package(item):
+        name, pkgname, url, protocol = item.name, item.artifact, item.url, item.protocol
+        dst, ext = item.destination, item.extension
+        key = cache_key(item.package, url, protocol, item.version)
+        limit = limits.get(protocol_group(protocol or url.split(":")[0]))
+        topdir = None
+        if key is not None and download_cache.restore(key, os.path.join(outdir, dst)):
+            print(f"Using cached download of {name}")
+        elif (
+            key is None
+            and ext in ARCHIVE_EXTENSIONS
+            and (protocol or url.split(":")[0]) in ("http", "https")
+        ):
+            # Only the download cache needs the archive itself
+            with limit or contextlib.nullcontext():
+                print(f"Downloading and extracting {name}")
+                topdir = download_and_extract(url, outdir)
+        else:
+            with limit or contextlib.nullcontext():
+                print(f"Downloading {name}")
+                grab(
+                    url,
+                    filename=dst,
+                    version=item.version,
+                    protocol=protocol,
+                    cwd=outdir,
+                    git_options=git_options,
+                )
+            if key is not None:
+                download_cache.store(key, os.path.join(outdir, dst))
 
-            print(f"Downloading {name}")
-            grab(url, filename=dst, version=ver, protocol=protocol)
+        if ext in ARCHIVE_EXTENSIONS:
+            if topdir is None:
+                print(f"Extracting {dst} ...")
+                with open(os.path.join(outdir, dst), "rb") as archive:
+                    topdir = extract_archive(archive, outdir)
 
-            if protocol == "git":
-                git_hashes[pkg] = get_git_revision_hash(path=dst)
+            if not os.path.exists(os.path.join(outdir, pkgname)):
+                print(f"Creating symlink {topdir} -> {pkgname}")
+                os.symlink(topdir, os.path.join(outdir, pkgname))
 
-            if ext in ["tgz", "tar.gz", "tar.bz2", "tar.xz"]:
-                print(f"Extracting {dst} ...")
-                topdir = shell(f"tar -xvf {dst}").decode("utf-8").split()[0]
-                normalised_dir = topdir.split("/")[0]
+    run_in_dependency_order(
+        {pkg: set() for pkg in downloads},
+        lambda pkg: fetch_package(downloads[pkg]),
+        workers=workers,
+    )
+    if download_cache is not None:
+        download_cache.evict()
 
-                if not os.path.exists(pkgname):
-                    print(f"Creating symlink {normalised_dir} -> {pkgname}")
-                    os.symlink(normalised_dir, pkgname)
+    def fetch_pypi_packages():
+        pypi_packages = plan.pypi_packages
+        if wheelhouse is not None:
+            pypi_packages = wheelhouse.missing(pypi_packages, pip_compatible_tags(pip))
 
         print(f"Downloading {len(pypi_packages)} pypi packages")
-        shell([pip, "download", "--no-deps", "--dest .", " ".join(pypi_packages)])
+        with span(f"{len(pypi_packages)} pypi packages", "fetch"):
+            try:
+                if wheelhouse is None:
+                    shell(
+                        [
+                            pip,
+                            "download",
+                            "--no-deps",
+                            "--dest .",
+                            " ".join(pypi_packages),
+                        ],
+                        cwd=outdir,
+                    )
+                elif pypi_packages:
+                    wheelhouse.download(pypi_packages, pip=pip)
+            except BaseException:
+                if claims is not None:
+                    claims.finish("pypi", succeeded=False)
+                raise
+        if claims is not None:
+            claims.finish("pypi", succeeded=True)
+
+    if claims is None or claims.claim("pypi"):
+        fetch_pypi_packages()
+
+    def take_over(key):
+        """Fetch an item claimed by a process which died, starting over."""
+        if key == "pypi":
+            fetch_pypi_packages()
+            return
+        item = next(item for item in plan.items if item.artifact == key)
+        for name in {item.destination, item.artifact}:
+            path = os.path.join(outdir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+        if item.url is None and item.protocol is None:
+            create_folder(item)
+        else:
+            fetch_package(item)
+
+    if claims is not None:
+        claims.wait([item.artifact for item in plan.items] + ["pypi"], take_over)
 
-    return git_hashes
+    return {
+        item.package: get_git_revision_hash(path=os.path.join(outdir, item.destination))
+        for item in plan.items
+        if item.protocol == "git"
+    }
 
 
 if __name__ == "__main__":
@@ -7,12 +7,17 @@ import logging
 import sys
 import warnings
 from collections import namedtuple
+from itertools import product
 
 import yaml
 from packaging.version import parse
 
 from .komodo_error import KomodoError, KomodoException
-from .pypi_dependencies import PypiDependencies
+from .pypi_dependencies import (
+    DEFAULT_CACHEFILE,
+    TargetEnvironment,
+    failed_requirements_per_environment,
+)
 from .yaml_file_types import ReleaseFile, RepositoryFile
 
 Report = namedtuple(
@@ -90,13 +95,20 @@ def lint(
 
 
 def check_dependencies(
-    release_file: ReleaseFile, repository_file: RepositoryFile, full_python_version: str
+    release_file: ReleaseFile,
+    repository_file: RepositoryFile,
+    full_python_version: str | None,
+    targets: list[TargetEnvironment] | None = None,
+    cachefile: str | None = None,
 ) -> list[KomodoError]:
+    """Check that the pypi dependencies of the release are satisfied, for
+    full_python_version on this platform, or for each of targets.
+
+    Package metadata fetched from pypi is kept in cachefile, if given."""
     all_dependencies = dict(release_file.content.items())
+    targets = targets or [TargetEnvironment(full_python_version)]
 
-    dependencies = PypiDependencies(
-        all_dependencies, python_version=full_python_version
-    )
+    user_specified = {}
     for name, version in release_file.content.items():
         if (
             name not in repository_file.content
@@ -105,22 +117,24 @@ def check_dependencies(
             raise ValueError(f"Missing package in repository file: {name}=={version}")
         package_repo = repository_file.content[name][version]
         if package_repo.get("source") != "pypi":
-            dependencies.add_user_specified(name, package_repo.get("depends", []))
-
-    failed_requirements = dependencies.failed_requirements()
-    if failed_requirements:
-        package_set = sorted(set(failed_requirements.values()))
-        deps = [
-            KomodoError(
-                err="Failed requirements:",
-                depends=[str(r) for r in failed_requirements],
-                package=", ".join(package_set),
-            )
-        ]
-    else:
-        deps = []
-    dependencies.dump_cache()
+            user_specified[name] = package_repo.get("depends", [])
 
+    deps = []
+    failed_per_target = failed_requirements_per_environment(
+        all_dependencies, targets, user_specified, cachefile=cachefile
+    )
+    for target, failed_requirements in failed_per_target.items():
+        if failed_requirements:
+            package_set = sorted(set(failed_requirements.values()))
+            deps.append(
+                KomodoError(
+                    err="Failed requirements:"
+                    if len(targets) == 1
+                    else f"Failed requirements for {target}:",
+                    depends=[str(r) for r in failed_requirements],
+                    package=", ".join(package_set),
+                )
+            )
     return deps
 
 
@@ -153,6 +167,27 @@ def get_args(args=None):
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--python-versions",
+        nargs="+",
+        metavar="VERSION",
+        help="Check pypi dependencies for each of these full python versions, "
+        "e.g. 3.11.9, instead of the python version of the release.",
+    )
+    parser.add_argument(
+        "--platforms",
+        nargs="+",
+        metavar="PLATFORM",
+        default=[sys.platform],
+        help="Check pypi dependencies for each of these values of sys.platform, "
+        "together with each python version.",
+    )
+    parser.add_argument(
+        "--cachefile",
+        default=DEFAULT_CACHEFILE,
+        help="Where to keep package metadata fetched from pypi for "
+        "--check-pypi-dependencies.",
+    )
     return parser.parse_args(args)
 
 
@@ -161,10 +196,25 @@ def lint_main(args=None):
     logging.basicConfig(format="%(message)s", level=args.loglevel)
 
     if args.check_pypi_dependencies:
-        python_version = args.packagefile.content["python"]
-        with open("builtin_python_versions.yml", encoding="utf-8") as f:
-            full_python_version = yaml.safe_load(f)[python_version]
-        deps = check_dependencies(args.packagefile, args.repofile, full_python_version)
+        if args.python_versions:
+            full_python_version = None
+            python_versions = args.python_versions
+        else:
+            python_version = args.packagefile.content["python"]
+            with open("builtin_python_versions.yml", encoding="utf-8") as f:
+                full_python_version = yaml.safe_load(f)[python_version]
+            python_versions = [full_python_version]
+        targets = [
+            TargetEnvironment(version, platform)
+            for version, platform in product(python_versions, args.platforms)
+        ]
+        deps = check_dependencies(
+            args.packagefile,
+            args.repofile,
+            full_python_version,
+            targets,
+            cachefile=args.cachefile,
+        )
     else:
         full_python_version = None
         deps = []
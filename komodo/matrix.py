@@ -56,3 +56,9 @@ def get_matrix_base(release_name: str) -> str:
     if re.search(r"-py\d{2,3}-rhel[0-9]", release_name):
         return release_name.split("-py")[0]
     return release_name
+
+
+def get_python_version(py_tag: str) -> str:
+    """Return the Python version of a Python coordinate, e.g. 3.11 for py311."""
+    digits = py_tag.replace("py", "").replace(".", "")
+    return f"{digits[0]}.{digits[1:]}"
@@ -1,4 +1,5 @@
 import os
+import re
 import subprocess
 import sys
 
@@ -22,3 +23,23 @@ def get_git_revision_hash(path):
         .decode(sys.getfilesystemencoding())
         .strip()
     )
+
+
+def get_git_remote_hash(url, ref):
+    """Return the commit that ref points to in the remote repository at url,
+    or None if ref is not a branch or tag there.
+    """
+    if re.fullmatch(r"[0-9a-f]{40}", ref):
+        return ref
+    output = subprocess.check_output(
+        ["git", "ls-remote", "--", url, ref, f"{ref}^{{}}"]
+    ).decode(sys.getfilesystemencoding())
+    refs = {}
+    for line in output.splitlines():
+        commit, _, name = line.partition("\t")
+        refs[name] = commit
+    # Annotated tags are listed twice, the peeled ^{} entry is the commit
+    for name in (f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}", f"refs/heads/{ref}"):
+        if name in refs:
+            return refs[name]
+    return None
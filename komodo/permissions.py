@@ -0,0 +1,91 @@
+"""Make a release readable, and its directories and executables usable, by
+everyone.
+"""
+
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union
+
+_READ = stat.S_IROTH
+_READ_EXECUTE = stat.S_IROTH | stat.S_IXOTH
+
+
+def _required_bits(path: str, mode: int, is_dir: bool) -> int:
+    if is_dir:
+        return _READ_EXECUTE
+    # Same as `find -executable`: executable by the user running komodo
+    if mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH) and os.access(path, os.X_OK):
+        return _READ_EXECUTE
+    return _READ
+
+
+def fix_permissions(
+    path: Union[str, os.PathLike], workers: Optional[int] = None
+) -> int:
+    """Give others read access to every file below path, and read and execute
+    access to every directory and executable file. Symlinks are left alone.
+
+    Directories are scanned in parallel, and chmod is only called on the
+    entries that are missing permissions.
+
+    Args:
+        path: The root of the tree to fix.
+        workers: The number of threads to use, defaults to the number of
+            CPUs.
+
+    Returns:
+        The number of files and directories whose mode was changed.
+    """
+    workers = workers or os.cpu_count() or 1
+    path = os.fspath(path)
+    changed = 0
+    pending = 0
+    errors: List[BaseException] = []
+    lock = threading.Condition()
+
+    def fix(entry_path: str, mode: int, is_dir: bool) -> int:
+        required = _required_bits(entry_path, mode, is_dir)
+        if mode & required == required:
+            return 0
+        os.chmod(entry_path, stat.S_IMODE(mode) | required)
+        return 1
+
+    def scan(directory: str) -> None:
+        nonlocal changed, pending
+        count = 0
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        count += fix(entry.path, entry.stat().st_mode, True)
+                        submit(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        mode = entry.stat(follow_symlinks=False).st_mode
+                        count += fix(entry.path, mode, False)
+        except BaseException as err:
+            with lock:
+                errors.append(err)
+        with lock:
+            changed += count
+            pending -= 1
+            lock.notify_all()
+
+    def submit(directory: str) -> None:
+        nonlocal pending
+        with lock:
+            if errors:
+                return
+            pending += 1
+        executor.submit(scan, directory)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if os.path.isdir(path) and not os.path.islink(path):
+            changed += fix(path, os.stat(path).st_mode, True)
+            submit(path)
+        with lock:
+            lock.wait_for(lambda: pending == 0)
+    if errors:
+        raise errors[0]
+    return changed
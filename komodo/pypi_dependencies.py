@@ -1,18 +1,23 @@
 from __future__ import annotations
 
+import contextlib
 import os
 import platform
 import subprocess
 import sys
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from tempfile import TemporaryDirectory
 
 import pkginfo
-import yaml
 from packaging.requirements import Requirement
 from packaging.utils import canonicalize_name
 from packaging.version import InvalidVersion
 
+from .pypi_metadata import PYPI_SIMPLE_URL, requires_dist
+from .requirements_cache import RequirementsCache
+
 
 # From Pep 508
 def format_full_version(info) -> str:
@@ -38,6 +43,44 @@ environment = {
 }
 
 
+@dataclass(frozen=True)
+class TargetEnvironment:
+    """A python version and platform to check dependencies for.
+
+    Args:
+        python_version: The python version string, e.g. 3.11.5.
+        sys_platform: The value of sys.platform, e.g. linux or darwin.
+    """
+
+    python_version: str
+    sys_platform: str = sys.platform
+
+    def marker_environment(self) -> dict[str, str]:
+        """The PEP 508 marker environment of the target, where what is not
+        given by python version and platform is taken from this machine."""
+        target = {
+            **environment,
+            "python_full_version": self.python_version,
+            "python_version": ".".join(self.python_version.split(".")[0:2]),
+        }
+        if self.sys_platform != sys.platform:
+            target["sys_platform"] = self.sys_platform
+            target["os_name"] = "nt" if self.sys_platform == "win32" else "posix"
+            target["platform_system"] = _PLATFORM_SYSTEMS.get(
+                self.sys_platform, self.sys_platform.capitalize()
+            )
+        return target
+
+    def __str__(self) -> str:
+        return f"python {self.python_version} on {self.sys_platform}"
+
+
+_PLATFORM_SYSTEMS = {"linux": "Linux", "darwin": "Darwin", "win32": "Windows"}
+
+# Where komodo-lint --check-pypi-dependencies keeps fetched package metadata
+DEFAULT_CACHEFILE = "./pypi_dependencies.sqlite"
+
+
 def version_list_to_requirements(
     version_list: Iterable[tuple[str, str | None, list[str]]],
 ) -> list[Requirement]:
@@ -57,7 +100,11 @@ class PypiDependencies:
         self,
         to_install: dict[str, str],
         python_version: str,
-        cachefile: str | None = "./pypi_dependencies.yml",
+        cachefile: str | None = None,
+        *,
+        workers: int = 8,
+        index_url: str | None = PYPI_SIMPLE_URL,
+        sys_platform: str | None = None,
     ) -> None:
         """A dependency checker for pypi packages.
 
@@ -67,13 +114,29 @@ class PypiDependencies:
             python_version:
                 the python version string, e.g. 3.8.11
             cachefile:
-                filename to use for package metadata fetched from pypi. None means no cache.
+                filename of the database caching package metadata fetched from
+                pypi, per python version. None means no cache.
+            workers:
+                how many packages to fetch metadata for from pypi at the same time.
+            index_url:
+                simple index to read package metadata from without downloading
+                the package. None means always download with pip.
+            sys_platform:
+                the platform to evaluate environment markers for, by default
+                this one.
 
         """
         self.python_version = python_version
-        environment["python_full_version"] = python_version
-        environment["python_version"] = ".".join(python_version.split(".")[0:2])
-        self._satisfied_requirements = set()
+        self.environment = TargetEnvironment(
+            python_version, sys_platform or sys.platform
+        ).marker_environment()
+        # Requirements are interned, so that each is parsed once, and can be
+        # told apart by id() when traversing the dependency graph
+        self._interned: dict[str, Requirement] = {}
+        self._graph: dict[tuple[str, str], list[Requirement]] = {}
+        self._marker_results: dict[tuple[int, frozenset[str]], bool] = {}
+        self._satisfied_requirements: set[int] = set()
+        self._failed_ids: set[int] = set()
         self._failed_requirements: dict[Requirement, str] = {}
         self._used_packages = set()
 
@@ -81,15 +144,15 @@ class PypiDependencies:
         self._to_install = {
             canonicalize_name(name): version for name, version in to_install.items()
         }
-        self._cachefile = cachefile
-        if self._cachefile is not None and os.path.exists(self._cachefile):
-            with open(self._cachefile, encoding="utf-8") as f:
-                self.requirements = yaml.safe_load(f)
-                self.requirements = {
-                    canonicalize_name(name): r for name, r in self.requirements.items()
-                }
-        else:
-            self.requirements = {}
+        self._workers = workers
+        self._index_url = index_url
+        self._cache = (
+            RequirementsCache(cachefile, python_version)
+            if cachefile is not None
+            else None
+        )
+        # Requirements looked up so far, by package and version
+        self.requirements: dict[str, dict[str, list[str]]] = {}
 
         self._user_specified = {}
 
@@ -119,12 +182,38 @@ class PypiDependencies:
         >>> dependencies.failed_requirements() # doctest: +ELLIPSIS
         Not installed: aiosignal...
         """
+        self.prefetch()
         for package_name, version in self._to_install.items():
             requirements = self._get_requirements(package_name, version)
             for r in requirements:
                 _ = self.satisfied(r, package_name)
         return self._failed_requirements
 
+    def prefetch(self) -> None:
+        """Fetch the requirements of all packages to be installed that are
+        neither user specified nor cached, in parallel.
+
+        Failures are ignored here, the package is fetched again when its
+        requirements are needed, and the error raised then.
+        """
+        missing = []
+        for canonical, version in self._to_install.items():
+            if canonical in self._user_specified or canonical == "python":
+                continue
+            if self._cached(canonical, version) is None:
+                missing.append((self._install_names[canonical], version))
+        if not missing:
+            return
+
+        def fetch(item: tuple[str, str]) -> None:
+            name, version = item
+            with contextlib.suppress(Exception):
+                requirements = self._get_requirements_from_pypi(name, version)
+                self._remember(canonicalize_name(name), version, requirements)
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            list(executor.map(fetch, missing))
+
     def used_packages(self, top_level_requirements: Iterable[Requirement]) -> set[str]:
         """Given you want to install top_level_requirements, returns list of
         all packages that must be installed to satisfy dependencies.
@@ -153,13 +242,75 @@ class PypiDependencies:
             for name in depends
             if name != "python"
         ]
-        self._user_specified[canonical] = version_list_to_requirements(depends_versions)
+        self._user_specified[canonical] = [
+            self._intern(r) for r in version_list_to_requirements(depends_versions)
+        ]
         self._install_names[canonical] = package_name
 
-    def dump_cache(self):
-        if self._cachefile is not None:
-            with open(self._cachefile, "w", encoding="utf-8") as f:
-                yaml.safe_dump(self.requirements, f)
+    def cached_requirements(
+        self, package_name: str, package_version: str
+    ) -> list[Requirement] | None:
+        """The requirements of a user specified package, or of a package
+        whose metadata has been fetched or is in the cache, and otherwise
+        None. Does not fetch anything."""
+        canonical = canonicalize_name(package_name)
+        if canonical in self._user_specified:
+            return self._user_specified[canonical]
+
+        key = (canonical, package_version)
+        if key not in self._graph:
+            requires_dist = self._cached(canonical, package_version)
+            if requires_dist is None:
+                return None
+            self._graph[key] = [self._intern(r) for r in requires_dist]
+        return self._graph[key]
+
+    def required_by_environment(
+        self, requirement: Requirement, extras: Iterable[str] = ()
+    ) -> bool:
+        """Whether the markers of requirement hold in the environment, when
+        the package having the requirement is installed with extras."""
+        return self._is_required_by_environment(
+            self._intern(requirement), frozenset(extras)
+        )
+
+    def close(self) -> None:
+        """Close the cache. Entries are stored as soon as they are fetched."""
+        if self._cache is not None:
+            self._cache.close()
+
+    def _share_metadata(self, other: PypiDependencies) -> None:
+        """Use the requirements fetched by other, which must be for the same
+        python version, so that they are only fetched and parsed once."""
+        self.requirements = other.requirements
+        self._interned = other._interned
+        self._graph = other._graph
+
+    def _intern(self, requirement: Requirement | str) -> Requirement:
+        key = requirement if isinstance(requirement, str) else str(requirement)
+        interned = self._interned.get(key)
+        if interned is None:
+            parsed = Requirement(key) if isinstance(requirement, str) else requirement
+            # Spellings of the same requirement share one object
+            interned = self._interned.setdefault(str(parsed), parsed)
+            self._interned[key] = interned
+        return interned
+
+    def _cached(self, canonical: str, version: str) -> list[str] | None:
+        requirements = self.requirements.setdefault(canonical, {})
+        if version not in requirements and self._cache is not None:
+            cached = self._cache.get(canonical, version)
+            if cached is not None:
+                requirements[version] = cached
+        return requirements.get(version)
+
+    def _remember(
+        self, canonical: str, version: str, requirements: list[Requirement]
+    ) -> None:
+        requires_dist = [str(r) for r in requirements]
+        self.requirements.setdefault(canonical, {})[version] = requires_dist
+        if self._cache is not None:
+            self._cache.put(canonical, version, requires_dist)
 
     def _get_requirements(
         self, package_name: str, package_version: str
@@ -176,65 +327,69 @@ class PypiDependencies:
         ... )
         [<Requirement('grpcio')>, <Requirement('protobuf')>, <Requirement('wheel')>]
         """
-        canonical = canonicalize_name(package_name)
-        if canonical in self._user_specified:
-            return self._user_specified[canonical]
-
-        if canonical not in self.requirements:
-            self.requirements[canonical] = {}
-
-        return self._get_requirements_from_pypi(package_name, package_version)
+        requirements = self.cached_requirements(package_name, package_version)
+        if requirements is None:
+            canonical = canonicalize_name(package_name)
+            self._remember(
+                canonical,
+                package_version,
+                self._get_requirements_from_pypi(package_name, package_version),
+            )
+            requirements = self.cached_requirements(package_name, package_version)
+        return requirements
 
     def _get_requirements_from_pypi(
         self, package_name: str, package_version: str
     ) -> list[Requirement]:
-        canonical = canonicalize_name(package_name)
-        if package_version not in self.requirements[canonical]:
-            with TemporaryDirectory() as tmpdir:
-                try:
-                    subprocess.check_output(
-                        [
-                            "pip",
-                            "download",
-                            f"{package_name}=={package_version}",
-                            f"--python-version={self.python_version}",
-                            "--no-deps",
-                        ],
-                        cwd=tmpdir,
-                    )
-                except Exception as err:
-                    raise ValueError(
-                        f"Could not install {package_name} {package_version} from pypi "
-                        f"With python version {self.python_version} "
-                        "in order to determine dependencies. "
-                        "This may be because no wheel exists for this python version."
-                    ) from err
-
-                files = os.listdir(tmpdir)
-                if len(files) != 1:
-                    raise ValueError(
-                        f"Did not get one wheel for download {package_name}=={package_version}."
-                        f"Got: {files}"
-                    )
-                file = files[0]
-                if not file.endswith(".whl"):
-                    subprocess.check_output(
-                        [
-                            "pip",
-                            "wheel",
-                            "--use-pep517",
-                            "--no-verify",
-                            "--no-deps",
-                            "--disable-pip-version-check",
-                            file,
-                        ],
-                        cwd=tmpdir,
-                    )
-                    file = [f for f in os.listdir(tmpdir) if f.endswith(".whl")][0]
-                dist = pkginfo.Wheel(os.path.join(tmpdir, file))
-                self.requirements[canonical][package_version] = dist.requires_dist
-
-        return [Requirement(r) for r in self.requirements[canonical][package_version]]
+        if self._index_url:
+            metadata = requires_dist(
+                package_name, package_version, self.python_version, self._index_url
+            )
+            if metadata is not None:
+                return [Requirement(r) for r in metadata]
+        with TemporaryDirectory() as tmpdir:
+            try:
+                subprocess.check_output(
+                    [
+                        "pip",
+                        "download",
+                        f"{package_name}=={package_version}",
+                        f"--python-version={self.python_version}",
+                        "--no-deps",
+                    ],
+                    cwd=tmpdir,
+                )
+            except Exception as err:
+                raise ValueError(
+                    f"Could not install {package_name} {package_version} from pypi "
+                    f"With python version {self.python_version} "
+                    "in order to determine dependencies. "
+                    "This may be because no wheel exists for this python version."
+                ) from err
+
+            files = os.listdir(tmpdir)
+            if len(files) != 1:
+                raise ValueError(
+                    f"Did not get one wheel for download {package_name}=={package_version}."
+                    f"Got: {files}"
+                )
+            file = files[0]
+            if not file.endswith(".whl"):
+                subprocess.check_output(
+                    [
+                        "pip",
+                        "wheel",
+                        "--use-pep517",
+                        "--no-verify",
+                        "--no-deps",
+                        "--disable-pip-version-check",
+                        file,
+                    ],
+                    cwd=tmpdir,
+                )
+                file = [f for f in os.listdir(tmpdir) if f.endswith(".whl")][0]
+            dist = pkginfo.Wheel(os.path.join(tmpdir, file))
+            return [Requirement(r) for r in dist.requires_dist]
 
     def _version_satisfies_requirement(
         self, version: str, requirement: Requirement
@@ -251,36 +406,50 @@ class PypiDependencies:
             return True
 
     def _is_required_by_environment(
-        self, requirement: Requirement, extras: Iterable[str]
+        self, requirement: Requirement, extras: frozenset[str]
     ) -> bool:
-        """Is the requirement necessary for the environment"""
-        environment["extra"] = ",".join(extras)
-        return requirement.marker is None or requirement.marker.evaluate(environment)
-
-    def _satisfied(
-        self,
-        requirements: list[Requirement],
-    ) -> tuple[bool, list[tuple[list[Requirement], set[str]]]]:
-        installed = self._to_install
-        transient_requirements = []
-        for requirement in requirements:
-            name = canonicalize_name(requirement.name)
-            if name not in installed:
-                print(f"Not installed: {name}")
-                return False, []
-            self._used_packages.add(self._install_names[name])
-            installed_version = installed[name]
+        """Is the (interned) requirement necessary for the environment"""
+        if requirement.marker is None:
+            return True
+        key = (id(requirement), extras)
+        if key not in self._marker_results:
+            self.environment["extra"] = ",".join(extras)
+            self._marker_results[key] = requirement.marker.evaluate(self.environment)
+        return self._marker_results[key]
 
-            if not self._version_satisfies_requirement(installed_version, requirement):
-                return False, []
+    def _visit(
+        self, requirement: Requirement, package_name: str, extras: frozenset[str]
+    ) -> tuple[bool, list[Requirement], frozenset[str]]:
+        """Check the (interned) requirement itself, without its dependencies.
 
-            transient_requirements.append(
-                (
+        Returns:
+            Whether it is satisfied, and the requirements and extras to check
+            next, which are only given the first time it is satisfied.
+        """
+        if not self._is_required_by_environment(requirement, extras):
+            return True, [], extras
+        key = id(requirement)
+        if key in self._failed_ids:
+            return False, [], extras
+        if key in self._satisfied_requirements:
+            return True, [], extras
+
+        name = canonicalize_name(requirement.name)
+        if name not in self._to_install:
+            print(f"Not installed: {name}")
+        else:
+            self._used_packages.add(self._install_names[name])
+            installed_version = self._to_install[name]
+            if self._version_satisfies_requirement(installed_version, requirement):
+                self._satisfied_requirements.add(key)
+                return (
+                    True,
                     self._get_requirements(requirement.name, installed_version),
-                    requirement.extras,
+                    frozenset(requirement.extras),
                 )
-            )
-        return True, transient_requirements
+        self._failed_ids.add(key)
+        self._failed_requirements[requirement] = package_name
+        return False, [], extras
 
     def satisfied(
         self,
@@ -290,6 +459,9 @@ class PypiDependencies:
     ) -> bool:
         """Is the given requirement satisfied.
 
+        The dependencies of the requirement are checked depth first, and
+        the check stops at the first one that is not satisfied.
+
         Args:
             package_name:
                 The package that has the given requirement.
@@ -308,23 +480,78 @@ class PypiDependencies:
         ... )
         True
         """
-        extra = extra or set()
-        if not self._is_required_by_environment(requirement, extra):
-            return True
-        if requirement in self._failed_requirements:
-            return False
-        if requirement in self._satisfied_requirements:
-            return True
-
-        satisfied, transient_requirements = self._satisfied([requirement])
-        if satisfied:
-            self._satisfied_requirements.add(requirement)
-        elif requirement in self._failed_requirements:
-            self._failed_requirements[requirement] += f", {package_name}"
-        else:
-            self._failed_requirements[requirement] = package_name
-        return satisfied and all(
-            self.satisfied(transient, package_name, extra)
-            for (transients, extra) in transient_requirements
-            for transient in transients
+        satisfied, requirements, extras = self._visit(
+            self._intern(requirement), package_name, frozenset(extra or ())
+        )
+        stack = [(iter(requirements), extras)]
+        while satisfied and stack:
+            transients, extras = stack[-1]
+            transient = next(transients, None)
+            if transient is None:
+                stack.pop()
+                continue
+            satisfied, requirements, extras = self._visit(
+                transient, package_name, extras
+            )
+            stack.append((iter(requirements), extras))
+        return satisfied
+
+
+def failed_requirements_per_environment(
+    to_install: dict[str, str],
+    targets: Iterable[TargetEnvironment],
+    user_specified: dict[str, list[str]] | None = None,
+    **kwargs,
+) -> dict[TargetEnvironment, dict[Requirement, str]]:
+    """Check the requirements of the packages for several environments in
+    one pass.
+
+    Metadata is fetched once per python version, as it decides which wheel
+    is downloaded, and shared between all targets with that version. The
+    python versions are fetched at the same time. Markers are evaluated
+    separately for each target.
+
+    Args:
+        to_install:
+            All packages that are to be installed
+        targets:
+            The environments to check
+        user_specified:
+            The dependencies of packages that are not from pypi.
+        kwargs:
+            Passed on to PypiDependencies.
+
+    Returns:
+        The failed requirements for each target.
+    """
+    checkers: dict[TargetEnvironment, PypiDependencies] = {}
+    per_python_version: dict[str, PypiDependencies] = {}
+    for target in targets:
+        checker = PypiDependencies(
+            to_install,
+            python_version=target.python_version,
+            sys_platform=target.sys_platform,
+            **kwargs,
         )
+        first = per_python_version.setdefault(
+            checker.environment["python_version"], checker
+        )
+        if first is not checker:
+            checker._share_metadata(first)
+        for name, depends in (user_specified or {}).items():
+            checker.add_user_specified(name, depends)
+        checkers[target] = checker
+
+    try:
+        if per_python_version:
+            with ThreadPoolExecutor(len(per_python_version)) as executor:
+                list(
+                    executor.map(PypiDependencies.prefetch, per_python_version.values())
+                )
+        return {
+            target: checker.failed_requirements()
+            for target, checker in checkers.items()
+        }
+    finally:
+        for checker in checkers.values():
+            checker.close()
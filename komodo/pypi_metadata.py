@@ -0,0 +1,203 @@
+"""Read the dependencies of a pypi package without downloading it.
+
+The simple index is queried with the JSON API (PEP 691) for the files of a
+release. If the index serves the core metadata of the chosen wheel
+separately (PEP 658), only that file is fetched. Otherwise the METADATA file
+is read out of the wheel with HTTP range requests for the zip central
+directory and the one member, so that a large wheel is never downloaded in
+full. When neither is possible, e.g. for releases without a wheel, None is
+returned and the caller has to download the package instead.
+"""
+
+from __future__ import annotations
+
+import io
+import threading
+import zipfile
+from email.parser import HeaderParser
+
+import requests
+from packaging import tags
+from packaging.utils import (
+    InvalidWheelFilename,
+    canonicalize_name,
+    parse_wheel_filename,
+)
+from packaging.version import InvalidVersion, Version
+
+PYPI_SIMPLE_URL = "https://pypi.org/simple"
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+
+# Enough for the end of central directory record and the central directory
+# of most wheels, so that one request usually covers both
+TAIL_SIZE = 64 * 1024
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def _default_session() -> requests.Session:
+    global _session  # noqa: PLW0603
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(max_retries=5, pool_maxsize=16)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def supported_tags(python_version: str) -> list[tags.Tag]:
+    """The wheel tags pip accepts with --python-version, best first.
+
+    >>> tags = supported_tags("3.8.11")
+    >>> str(tags[-1])
+    'py30-none-any'
+    """
+    version = tuple(int(v) for v in python_version.split(".")[:2])
+    return [
+        *tags.cpython_tags(python_version=version),
+        *tags.compatible_tags(python_version=version),
+    ]
+
+
+class _RangeFile(io.RawIOBase):
+    """A read-only, seekable file over HTTP range requests."""
+
+    def __init__(self, session: requests.Session, url: str) -> None:
+        super().__init__()
+        self._session = session
+        self._url = url
+        self._position = 0
+        response = self._get(f"bytes=-{TAIL_SIZE}")
+        self._size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+        self._tail = response.content
+        self._tail_start = self._size - len(self._tail)
+
+    def _get(self, byte_range: str) -> requests.Response:
+        response = self._session.get(
+            self._url, headers={"Range": byte_range}, stream=True, timeout=60
+        )
+        if response.status_code != requests.codes.partial:
+            response.close()
+            msg = f"{self._url} does not support range requests"
+            raise OSError(msg)
+        return response
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(offset, 0)
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        end = self._size if size is None or size < 0 else self._position + size
+        end = min(end, self._size)
+        if end <= self._position:
+            return b""
+        if self._position >= self._tail_start:
+            data = self._tail[
+                self._position - self._tail_start : end - self._tail_start
+            ]
+        else:
+            data = self._get(f"bytes={self._position}-{end - 1}").content
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def _choose_wheel(files: list[dict], version: Version, python_version: str):
+    ranking = {tag: i for i, tag in enumerate(supported_tags(python_version))}
+    best, best_rank = None, len(ranking)
+    for file in files:
+        if file.get("yanked"):
+            continue
+        try:
+            _, file_version, _, file_tags = parse_wheel_filename(file["filename"])
+        except InvalidWheelFilename:
+            continue
+        if file_version != version:
+            continue
+        rank = min(ranking.get(tag, len(ranking)) for tag in file_tags)
+        if rank < best_rank:
+            best, best_rank = file, rank
+    return best
+
+
+def _requires_dist(metadata: bytes) -> list[str]:
+    message = HeaderParser().parsestr(metadata.decode("utf-8", errors="replace"))
+    return message.get_all("Requires-Dist") or []
+
+
+def _read_wheel_metadata(session: requests.Session, url: str) -> bytes:
+    with zipfile.ZipFile(_RangeFile(session, url)) as wheel:
+        names = [
+            name
+            for name in wheel.namelist()
+            if name.count("/") == 1 and name.endswith(".dist-info/METADATA")
+        ]
+        if len(names) != 1:
+            msg = f"Expected one METADATA file in {url}, got {names}"
+            raise ValueError(msg)
+        return wheel.read(names[0])
+
+
+def requires_dist(
+    package_name: str,
+    package_version: str,
+    python_version: str,
+    index_url: str = PYPI_SIMPLE_URL,
+    session: requests.Session | None = None,
+) -> list[str] | None:
+    """The Requires-Dist entries of the wheel pip would download for
+    package_name==package_version with --python-version=python_version.
+
+    Args:
+        index_url: A simple index serving JSON (PEP 691).
+        session: The session to use, by default one shared session.
+
+    Returns:
+        The requirement strings, or None if the metadata cannot be read
+        without downloading the package.
+    """
+    session = session or _default_session()
+    try:
+        version = Version(package_version)
+    except InvalidVersion:
+        return None
+    project_url = f"{index_url.rstrip('/')}/{canonicalize_name(package_name)}/"
+    try:
+        response = session.get(project_url, headers={"Accept": SIMPLE_JSON}, timeout=60)
+        if (
+            response.status_code != requests.codes.ok
+            or SIMPLE_JSON not in response.headers.get("Content-Type", "")
+        ):
+            return None
+        wheel = _choose_wheel(response.json()["files"], version, python_version)
+        if wheel is None:
+            return None
+        wheel_url = requests.compat.urljoin(project_url, wheel["url"])
+        # "dist-info-metadata" is the name used before PEP 714
+        if wheel.get("core-metadata", wheel.get("dist-info-metadata")):
+            response = session.get(f"{wheel_url.split('#')[0]}.metadata", timeout=60)
+            if response.status_code == requests.codes.ok:
+                return _requires_dist(response.content)
+        return _requires_dist(_read_wheel_metadata(session, wheel_url))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        # requests' exceptions are OSErrors
+        return None
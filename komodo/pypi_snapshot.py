@@ -0,0 +1,97 @@
+"""A local snapshot of the pypi metadata komodo-check-pypi uses.
+
+Only what is needed to find compatible versions is kept from the pypi JSON of
+each package: the filename, requires_python and yanked fields of the files of
+each release. The snapshot is one gzipped JSON file with sorted keys.
+"""
+
+import datetime
+import gzip
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from packaging.utils import canonicalize_name
+
+FILE_FIELDS = ("filename", "requires_python", "yanked")
+
+Releases = Dict[str, List[Dict[str, Any]]]
+
+
+def compact_releases(releases: Releases) -> Releases:
+    """The releases of a pypi JSON response with only the fields komodo uses."""
+    return {
+        version: [
+            {key: file[key] for key in FILE_FIELDS if file.get(key)} for file in files
+        ]
+        for version, files in releases.items()
+    }
+
+
+class PypiSnapshot:
+    def __init__(
+        self, packages: Optional[Dict[str, Releases]] = None, created: str = ""
+    ):
+        """The releases of pypi packages, as in the pypi JSON API.
+
+        Args:
+            packages: The releases of each package.
+            created: When the metadata was fetched, in ISO 8601 format.
+        """
+        self.packages = {
+            canonicalize_name(name): releases
+            for name, releases in (packages or {}).items()
+        }
+        self.created = created or datetime.datetime.now(
+            datetime.timezone.utc
+        ).isoformat(timespec="seconds")
+
+    def add(self, package: str, releases: Releases) -> None:
+        self.packages[canonicalize_name(package)] = compact_releases(releases)
+
+    def releases(self, package: str) -> Releases:
+        try:
+            return self.packages[canonicalize_name(package)]
+        except KeyError as err:
+            msg = (
+                f"{package} is not in the pypi snapshot taken {self.created}, "
+                "update it with komodo-snapshot-pypi"
+            )
+            raise ValueError(msg) from err
+
+    def __contains__(self, package: str) -> bool:
+        return canonicalize_name(package) in self.packages
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "PypiSnapshot":
+        with gzip.open(path, "rt", encoding="utf-8") as snapshot_file:
+            content = json.load(snapshot_file)
+        return cls(content["packages"], content["created"])
+
+    def write(self, path: Union[str, Path]) -> None:
+        """Write the snapshot to path. If path already holds a snapshot of the
+        same metadata, its creation time is kept, so that the file only
+        changes when the metadata does."""
+        path = Path(path)
+        created = self.created
+        try:
+            previous = self.load(path)
+            if previous.packages == self.packages:
+                created = previous.created
+        except (OSError, EOFError, ValueError, KeyError):
+            pass
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        # No name or mtime in the gzip header, which would change between runs
+        with open(tmp, "wb") as raw, gzip.GzipFile(
+            filename="", fileobj=raw, mode="wb", mtime=0
+        ) as snapshot_file:
+            snapshot_file.write(
+                json.dumps(
+                    {"created": created, "packages": self.packages},
+                    sort_keys=True,
+                    separators=(",", ":"),
+                ).encode("utf-8")
+            )
+        os.replace(tmp, path)
@@ -0,0 +1,60 @@
+"""Files written into a release after it is built, shared by kmd and
+komodo-relocate."""
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+import jinja2
+
+
+def create_enable_scripts(
+    komodo_prefix: str, komodo_release: str, release_dir: Optional[Path] = None
+) -> None:
+    """Render enable scripts (user facing) for bash and csh to an existing
+    directory komodo_release (in current working directory).
+
+    Args:
+    ----
+        komodo_prefix: The filesystem path to where the release is to be
+            deployed.
+        komodo_release: The name of the release.
+        release_dir: The directory to render the scripts to, if not
+            komodo_release.
+    """
+    jinja_env = jinja2.Environment(
+        loader=jinja2.PackageLoader(package_name="komodo", package_path="data"),
+        keep_trailing_newline=True,
+    )
+    for tmpl, target in [
+        ("enable.jinja2", "enable"),
+        ("enable.csh.jinja2", "enable.csh"),
+    ]:
+        (Path(release_dir or komodo_release) / target).write_text(
+            jinja_env.get_template(tmpl).render(
+                komodo_prefix=komodo_prefix,
+                komodo_release=komodo_release,
+            ),
+            encoding="utf-8",
+        )
+
+
+def write_preserving_mode(path: Union[str, os.PathLike], data: bytes) -> None:
+    """Replace the content of path with data, keeping its mode.
+
+    The new content is written to a temporary file which is renamed over
+    path, so files hard linked from a cache are left untouched.
+    """
+    path = os.fspath(path)
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        shutil.copystat(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -3,7 +3,7 @@
 import argparse
 import os
 import re
-from typing import Dict, List, Optional, Sequence, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import yaml
 
@@ -129,11 +129,11 @@ def _check_version_exists_for_coordinates(
     return None
 
 
-def transpile_releases(matrix_file: str, output_folder: str, matrix: dict) -> None:
-    """Transpile a matrix file possibly containing different os and framework
-    versions (e.g. rhel6 and rhel7, py3.6 and py3.8).
-    Write one dimension file for each element in the matrix
-    (e.g. rhel7 and py3.8, rhel6 and py3.6).
+def get_concrete_releases(
+    matrix_file: str, matrix: dict
+) -> Iterator[Tuple[str, str, dict]]:
+    """Yield the name, Python coordinate (e.g. py311) and content of each
+    concrete release in a matrix file for the given matrix coordinates.
     """
     if not isinstance(matrix, dict):
         raise TypeError("Matrix coordinates must be a dictionary")
@@ -160,11 +160,20 @@ def transpile_releases(matrix_file: str, output_folder: str, matrix: dict) -> No
             py_ver,
             other_ver,
         )
-        filename = f"{format_release(release_base, rhel_ver, py_ver)}"
+        release_name = format_release(release_base, rhel_ver, py_ver)
         if other_versions:
-            filename = filename + f"-{other_ver}"
-        filename = filename + ".yml"
-        write_to_file(release_dict, os.path.join(output_folder, filename))
+            release_name = release_name + f"-{other_ver}"
+        yield release_name, py_ver, release_dict
+
+
+def transpile_releases(matrix_file: str, output_folder: str, matrix: dict) -> None:
+    """Transpile a matrix file possibly containing different os and framework
+    versions (e.g. rhel6 and rhel7, py3.6 and py3.8).
+    Write one dimension file for each element in the matrix
+    (e.g. rhel7 and py3.8, rhel6 and py3.6).
+    """
+    for release_name, _, release_dict in get_concrete_releases(matrix_file, matrix):
+        write_to_file(release_dict, os.path.join(output_folder, f"{release_name}.yml"))
 
 
 def transpile_releases_for_pip(
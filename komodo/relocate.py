@@ -0,0 +1,239 @@
+"""Move a built release to another location without rebuilding it.
+
+A release embeds the path it was built for in scripts, pkg-config and CMake
+files, pip's RECORD files and various other text files. Relocating a
+release rewrites every such reference to the new path, so that e.g. a
+bleeding build can be promoted to a named release. Binary files, such as
+executables and shared libraries with an RPATH, are never modified, but the
+ones still referring to the old path are reported.
+"""
+
+import argparse
+import mmap
+import os
+import re
+import shutil
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from komodo.release_files import create_enable_scripts, write_preserving_mode
+from komodo.tracing import span
+
+TEXT_SUFFIXES = {
+    ".cfg",
+    ".cmake",
+    ".conf",
+    ".csh",
+    ".ini",
+    ".json",
+    ".la",
+    ".pc",
+    ".pth",
+    ".py",
+    ".sh",
+    ".toml",
+    ".txt",
+    ".yaml",
+    ".yml",
+}
+TEXT_NAMES = {"RECORD", "Makefile", "enable", "local"}
+
+
+def _prefix_pattern(old_prefix: str) -> "re.Pattern[bytes]":
+    # Do not match a sibling path sharing the same start, e.g. bleeding-py311
+    # when relocating bleeding.
+    return re.compile(re.escape(os.fsencode(old_prefix)) + rb"(?![\w.+-])")
+
+
+def _is_candidate(entry: os.DirEntry) -> bool:
+    name = entry.name
+    if name in TEXT_NAMES or os.path.splitext(name)[1] in TEXT_SUFFIXES:
+        return True
+    if not entry.stat(follow_symlinks=False).st_mode & stat.S_IXUSR:
+        return False
+    with open(entry.path, "rb") as file_stream:
+        return file_stream.read(2) == b"#!"
+
+
+def _find_candidates(root: str) -> Tuple[List[str], List[str], List[str]]:
+    files, others, links = [], [], []
+    pending = [root]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    links.append(entry.path)
+                elif entry.is_dir():
+                    pending.append(entry.path)
+                elif not entry.is_file():
+                    continue
+                elif _is_candidate(entry):
+                    files.append(entry.path)
+                else:
+                    others.append(entry.path)
+    return files, others, links
+
+
+def relocate(
+    root: Union[str, os.PathLike],
+    old_prefix: str,
+    new_prefix: str,
+    workers: Optional[int] = None,
+) -> Tuple[List[str], List[str]]:
+    """Rewrite references to old_prefix into new_prefix below root.
+
+    Text files and absolute symlinks are rewritten in parallel. Files
+    containing NUL bytes are considered binary and are never modified, as
+    changing the length of a path would corrupt them. All other files, e.g.
+    executables and shared libraries, are only searched for old_prefix.
+
+    Args:
+        root: The directory whose content is rewritten.
+        old_prefix: The path the files currently refer to.
+        new_prefix: The path the files should refer to.
+        workers: The number of threads to use, defaults to the number of
+            CPUs.
+
+    Returns:
+        The rewritten files and symlinks, and the binary files that still
+        refer to old_prefix.
+    """
+    old_prefix = old_prefix.rstrip("/")
+    new_prefix = new_prefix.rstrip("/")
+    pattern = _prefix_pattern(old_prefix)
+    replacement = os.fsencode(new_prefix).replace(b"\\", b"\\\\")
+
+    def rewrite_file(path: str) -> Optional[str]:
+        with open(path, "rb") as file_stream:
+            data = file_stream.read()
+        if pattern.search(data) is None:
+            return None
+        if b"\0" in data:
+            return "binary"
+        write_preserving_mode(path, pattern.sub(replacement, data))
+        return "rewritten"
+
+    def scan_file(path: str) -> Optional[str]:
+        with open(path, "rb") as file_stream:
+            if os.fstat(file_stream.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(file_stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return "binary" if pattern.search(data) is not None else None
+
+    def rewrite_link(path: str) -> Optional[str]:
+        target = os.readlink(path)
+        new_target = pattern.sub(replacement, os.fsencode(target), count=1)
+        if not target.startswith("/") or new_target == os.fsencode(target):
+            return None
+        os.unlink(path)
+        os.symlink(os.fsdecode(new_target), path)
+        return "rewritten"
+
+    with span("relocate", category="relocate", root=os.fspath(root)):
+        files, others, links = _find_candidates(os.fspath(root))
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            results = list(zip(files, pool.map(rewrite_file, files)))
+            results += zip(others, pool.map(scan_file, others))
+            results += zip(links, pool.map(rewrite_link, links))
+    rewritten = [path for path, result in results if result == "rewritten"]
+    binaries = sorted(path for path, result in results if result == "binary")
+    return rewritten, binaries
+
+
+def move_release(
+    source: Union[str, os.PathLike],
+    destination: Union[str, os.PathLike],
+    copy: bool = False,
+    workers: Optional[int] = None,
+) -> Tuple[List[str], List[str]]:
+    """Move (or copy) the release at source to destination and relocate it.
+
+    The release manifest and the enable scripts are renamed after the new
+    release name, i.e. the last component of destination. References to
+    source are rewritten both as given and with symlinks resolved, so source
+    should be the path the release was built under.
+    """
+    # The path the release was built under, which may run through symlinks
+    source = Path(os.path.abspath(source))
+    destination = Path(os.path.abspath(destination))
+    if destination.exists():
+        raise FileExistsError(f"{destination} already exists")
+    if not (source / source.name).is_file():
+        raise ValueError(f"{source} is not a komodo release, no manifest found")
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    if copy:
+        shutil.copytree(source, destination, symlinks=True)
+    else:
+        shutil.move(str(source), str(destination))
+
+    rewritten, binaries = relocate(
+        destination, str(source), str(destination), workers=workers
+    )
+    # Paths recorded with the symlinks resolved, e.g. by os.path.realpath
+    real_source = os.path.realpath(source)
+    if real_source != str(source):
+        more_rewritten, more_binaries = relocate(
+            destination, real_source, str(destination), workers=workers
+        )
+        rewritten = sorted(set(rewritten + more_rewritten))
+        binaries = sorted(set(binaries + more_binaries))
+
+    if source.name != destination.name:
+        (destination / source.name).rename(destination / destination.name)
+    create_enable_scripts(
+        komodo_prefix=str(destination / "root"),
+        komodo_release=destination.name,
+        release_dir=destination,
+    )
+    return rewritten, binaries
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Move a built komodo release to another location, rewriting the "
+            "paths embedded in the release instead of rebuilding it."
+        ),
+    )
+    parser.add_argument("source", type=Path, help="The release to move.")
+    parser.add_argument(
+        "destination",
+        type=Path,
+        help=(
+            "The new location of the release, its last component is the new "
+            "release name, e.g. /prefix/2024.01.00-py311."
+        ),
+    )
+    parser.add_argument(
+        "--copy",
+        action="store_true",
+        help="Keep the source release, and relocate a copy of it.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of threads rewriting files, defaults to the number of CPUs.",
+    )
+    return parser.parse_args(args)
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    args = parse_args(sys.argv[1:] if args is None else args)
+    rewritten, binaries = move_release(
+        args.source, args.destination, copy=args.copy, workers=args.workers
+    )
+    print(
+        f"Relocated {args.source} to {args.destination}, "
+        f"rewrote {len(rewritten)} files and symlinks"
+    )
+    for binary in binaries:
+        print(f"Warning: binary file {binary} refers to {args.source}")
+
+
+if __name__ == "__main__":
+    main()
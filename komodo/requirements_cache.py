@@ -0,0 +1,65 @@
+"""A persistent cache of the requirements of pypi packages.
+
+The requirements of a package can depend on the python version, because it
+decides which wheel is downloaded, so entries are keyed by python version
+as well as package and version. The cache is an SQLite database: each entry
+is written in its own transaction as soon as it is fetched, lookups only
+read the entry asked for, and several processes can use the same file at
+the same time.
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requirements (
+    python_version TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    requires_dist TEXT NOT NULL,
+    PRIMARY KEY (python_version, name, version)
+)
+"""
+
+
+class RequirementsCache:
+    def __init__(self, path: str, python_version: str) -> None:
+        """The cached requirements for one python version.
+
+        Args:
+            path: The database file. Created if it does not exist.
+            python_version: The python version string, e.g. 3.8.11. Only
+                major and minor version are part of the key.
+        """
+        self.path = path
+        self.python_version = ".".join(python_version.split(".")[:2])
+        self._lock = threading.Lock()
+        # Wait for other processes writing to the cache instead of failing
+        self._connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute(_SCHEMA)
+
+    def get(self, name: str, version: str) -> list[str] | None:
+        """The requires_dist of name==version, or None if it is not cached."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT requires_dist FROM requirements "
+                "WHERE python_version = ? AND name = ? AND version = ?",
+                (self.python_version, name, version),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, name: str, version: str, requires_dist: list[str]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO requirements VALUES (?, ?, ?, ?)",
+                (self.python_version, name, version, json.dumps(list(requires_dist))),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+Finds the packages in a release that depend, directly or transitively, on a
+given package, e.g. to see what an upgrade or a vulnerability affects.
+
+The dependencies are read from the depends lists in the repository file and,
+for pypi packages, from the metadata cache of komodo-lint
+--check-pypi-dependencies.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import deque
+from dataclasses import dataclass, field
+
+import yaml
+from packaging.requirements import Requirement
+from packaging.utils import canonicalize_name
+
+from komodo.yaml_file_types import ReleaseFile, RepositoryFile
+
+from .pypi_dependencies import PypiDependencies
+
+
+@dataclass
+class Impact:
+    """The packages affected by a change to a package.
+
+    Args:
+        affected: The packages that depend on the package, directly or
+            transitively.
+        incompatible: The packages whose requirement on the package is not
+            satisfied by the new version, with that requirement.
+    """
+
+    affected: set[str] = field(default_factory=set)
+    incompatible: dict[str, Requirement] = field(default_factory=dict)
+
+
+class ReverseDependencies:
+    def __init__(
+        self,
+        versions: dict[str, str],
+        requirements: dict[str, list[Requirement]],
+    ) -> None:
+        """An index from each package to the packages that depend on it.
+
+        Args:
+            versions:
+                The packages in the release, and their versions.
+            requirements:
+                The requirements of each package, on packages in the release.
+        """
+        self._names = {canonicalize_name(name): name for name in versions}
+        self._dependents: dict[str, dict[str, Requirement]] = {
+            canonical: {} for canonical in self._names
+        }
+        for package, package_requirements in requirements.items():
+            dependent = canonicalize_name(package)
+            for requirement in package_requirements:
+                dependency = canonicalize_name(requirement.name)
+                if dependency in self._dependents and dependency != dependent:
+                    self._dependents[dependency][dependent] = requirement
+        self._closures: dict[str, frozenset[str]] = {}
+
+    @classmethod
+    def from_release(
+        cls,
+        release: dict[str, str],
+        repository: dict[str, dict],
+        python_version: str,
+        cachefile: str | None = None,
+        fetch: bool = False,
+    ) -> ReverseDependencies:
+        """Build the index for a release.
+
+        Args:
+            python_version:
+                The full python version to evaluate environment markers for.
+            cachefile:
+                The pypi metadata cache, see PypiDependencies. None means
+                no cache.
+            fetch:
+                Fetch the metadata of pypi packages that are not cached. If
+                False, such packages are only given the dependencies in their
+                depends list.
+        """
+        dependencies = PypiDependencies(
+            release, python_version=python_version, cachefile=cachefile
+        )
+        try:
+            for name, version in release.items():
+                metadata = repository.get(name, {}).get(version, {})
+                if metadata.get("source") != "pypi":
+                    dependencies.add_user_specified(name, metadata.get("depends", []))
+            if fetch:
+                dependencies.prefetch()
+
+            in_release = {canonicalize_name(name) for name in release}
+            candidates: dict[str, list[Requirement]] = {}
+            for name, version in release.items():
+                metadata = repository.get(name, {}).get(version, {})
+                candidates[name] = [
+                    Requirement(depends)
+                    for depends in metadata.get("depends", [])
+                    if depends != "python"
+                ]
+                if metadata.get("source") == "pypi":
+                    candidates[name] += (
+                        dependencies.cached_requirements(name, version) or []
+                    )
+        finally:
+            dependencies.close()
+
+        # Optional dependencies count if some package asks for the extra
+        extras: dict[str, set[str]] = {}
+        for package_requirements in candidates.values():
+            for requirement in package_requirements:
+                extras.setdefault(canonicalize_name(requirement.name), set()).update(
+                    requirement.extras
+                )
+        requirements = {
+            name: [
+                requirement
+                for requirement in package_requirements
+                if canonicalize_name(requirement.name) in in_release
+                and any(
+                    dependencies.required_by_environment(requirement, extra)
+                    for extra in [
+                        (),
+                        *((e,) for e in extras.get(canonicalize_name(name), ())),
+                    ]
+                )
+            ]
+            for name, package_requirements in candidates.items()
+        }
+        return cls(release, requirements)
+
+    def dependents(self, package: str) -> frozenset[str]:
+        """The packages that depend on package, directly or transitively."""
+        start = canonicalize_name(package)
+        if start not in self._closures:
+            found = set()
+            queue = deque([start])
+            while queue:
+                for dependent in self._dependents.get(queue.popleft(), {}):
+                    if dependent not in found and dependent != start:
+                        found.add(dependent)
+                        queue.append(dependent)
+            self._closures[start] = frozenset(found)
+        return frozenset(self._names[name] for name in self._closures[start])
+
+    def impact(self, package: str, new_version: str | None = None) -> Impact:
+        """The packages affected by changing package to new_version."""
+        impact = Impact(affected=set(self.dependents(package)))
+        # Like PypiDependencies, branches satisfy any requirement
+        if new_version is not None and new_version not in {"main", "master"}:
+            for dependent, requirement in self._dependents.get(
+                canonicalize_name(package), {}
+            ).items():
+                if not requirement.specifier.contains(new_version, prereleases=True):
+                    impact.incompatible[self._names[dependent]] = requirement
+        return impact
+
+    def dot(self, package: str) -> str:
+        """The reverse dependency graph of package in dot format."""
+        nodes = {canonicalize_name(package)} | {
+            canonicalize_name(name) for name in self.dependents(package)
+        }
+        edges = [
+            f'  "{self._names[dependent]}" -> "{self._names[dependency]}";'
+            for dependency in sorted(nodes)
+            for dependent in sorted(self._dependents.get(dependency, {}))
+            if dependent in nodes
+        ]
+        return "\n".join([f'digraph "{package}" {{', *edges, "}"]) + "\n"
+
+
+def _python_version(release: ReleaseFile, builtin_python_versions: str) -> str:
+    if os.path.isfile(builtin_python_versions) and "python" in release.content:
+        with open(builtin_python_versions, encoding="utf-8") as f:
+            full_versions = yaml.safe_load(f)
+        if release.content["python"] in full_versions:
+            return full_versions[release.content["python"]]
+    return ".".join(str(v) for v in sys.version_info[:3])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Show the packages in a release that depend on a package.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "release_file",
+        type=ReleaseFile(),
+        help="A Komodo release file mapping package name to version, in YAML format.",
+    )
+    parser.add_argument(
+        "repository_file",
+        type=RepositoryFile(),
+        help="A Komodo repository file, in YAML format.",
+    )
+    parser.add_argument("--pkg", help="The package to find the dependents of.")
+    parser.add_argument(
+        "--version",
+        help="A new version of the package, to check whether the packages "
+        "depending on it directly allow it.",
+    )
+    parser.add_argument(
+        "--python-version",
+        help="The full python version to evaluate environment markers for. "
+        "By default the version of the release's python in "
+        "builtin_python_versions.yml.",
+    )
+    parser.add_argument(
+        "--cachefile",
+        default=None,
+        help="The pypi metadata cache to read, and with --fetch to add to, "
+        "e.g. ./pypi_dependencies.sqlite written by komodo-lint "
+        "--check-pypi-dependencies.",
+    )
+    parser.add_argument(
+        "--fetch",
+        action="store_true",
+        help="Fetch metadata of pypi packages that are not in the cache, or "
+        "of all pypi packages without --cachefile.",
+    )
+    parser.add_argument(
+        "--dot", action="store_true", help="Output the graph in dot format."
+    )
+    parser.add_argument(
+        "--display_dot",
+        action="store_true",
+        help="Render the graph with GraphViz and ImageMagick.",
+    )
+    args = parser.parse_args(args)
+
+    package = args.pkg or input("Package: ").strip()
+    if package not in args.release_file.content:
+        sys.exit(f"{package} is not in the release")
+    index = ReverseDependencies.from_release(
+        args.release_file.content,
+        args.repository_file.content,
+        args.python_version
+        or _python_version(args.release_file, "builtin_python_versions.yml"),
+        cachefile=args.cachefile,
+        fetch=args.fetch,
+    )
+
+    if args.dot or args.display_dot:
+        graph = index.dot(package)
+        if args.display_dot:
+            png = subprocess.run(
+                ["dot", "-Tpng"], input=graph.encode(), capture_output=True, check=True
+            ).stdout
+            subprocess.run(["display"], input=png, check=True)
+        else:
+            print(graph, end="")
+        return
+
+    impact = index.impact(package, args.version)
+    for name in sorted(impact.affected, key=str.lower):
+        if name in impact.incompatible:
+            print(f"{name} (requires {impact.incompatible[name]})")
+        else:
+            print(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Run jobs, e.g. package builds or fetches, in the order given by their
+dependencies, with several jobs at a time where the dependencies allow it.
+"""
+
+import contextlib
+import io
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Mapping, Set
+
+
+def build_order(graph: Mapping[str, Set[str]]) -> List[str]:
+    """Topologically sort graph, keeping the given order between packages
+    that do not depend on each other.
+
+    >>> build_order({"b": {"a"}, "c": set(), "a": set()})
+    ['c', 'a', 'b']
+    """
+    remaining = {name: set(deps) for name, deps in graph.items()}
+    order = []
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            msg = "Circular dependencies between " + ", ".join(sorted(remaining))
+            raise ValueError(msg)
+        for name in ready:
+            del remaining[name]
+            for deps in remaining.values():
+                deps.discard(name)
+        order.extend(ready)
+    return order
+
+
+class _ThreadOutput(io.TextIOBase):
+    """Stand-in for sys.stdout which holds back what a worker thread prints
+    while it builds a package, and writes it out in one piece when the
+    package is done. This keeps the output of packages that are built at the
+    same time from being interleaved.
+    """
+
+    def __init__(self, stream) -> None:
+        super().__init__()
+        self._stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is not None:
+            return buffer.write(text)
+        with self._lock:
+            return self._stream.write(text)
+
+    def flush(self):
+        with self._lock:
+            self._stream.flush()
+
+    @contextlib.contextmanager
+    def capture(self):
+        self._local.buffer = io.StringIO()
+        try:
+            yield
+        finally:
+            text = self._local.buffer.getvalue()
+            self._local.buffer = None
+            with self._lock:
+                self._stream.write(text)
+                self._stream.flush()
+
+
+def run_in_dependency_order(
+    graph: Mapping[str, Set[str]],
+    build_package: Callable[[str], None],
+    workers: int = 1,
+    capture_output: bool = True,
+) -> None:
+    """Call build_package for every package in graph, never before all of the
+    package's dependencies are done, with at most `workers` packages at a
+    time.
+
+    The first failure stops the scheduling of new packages. Packages that
+    are already running are allowed to finish before the error is raised.
+
+    With capture_output, what is printed while building a package is held
+    back and printed in one piece when the package is done.
+    """
+    order = build_order(graph)
+    if workers <= 1:
+        for package_name in order:
+            build_package(package_name)
+        return
+
+    remaining = {name: set(graph[name]) for name in order}
+    dependents: Dict[str, List[str]] = {name: [] for name in order}
+    for name in order:
+        for dep in graph[name]:
+            dependents[dep].append(name)
+    ready = [name for name in order if not remaining[name]]
+
+    output = _ThreadOutput(sys.stdout)
+
+    def _build(package_name):
+        if not capture_output:
+            build_package(package_name)
+            return
+        with output.capture():
+            build_package(package_name)
+
+    with contextlib.redirect_stdout(output), ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        running = {}
+        while ready or running:
+            while ready and len(running) < workers:
+                package_name = ready.pop(0)
+                running[executor.submit(_build, package_name)] = package_name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                package_name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    wait(running)
+                    raise error
+                for dependent in dependents[package_name]:
+                    remaining[dependent].discard(package_name)
+                    if not remaining[dependent]:
+                        ready.append(dependent)
@@ -1,6 +1,6 @@
 import os
 
-from komodo.shell import shell
+from komodo.release_files import write_preserving_mode
 
 
 def _is_shebang(input_str):
@@ -17,7 +17,7 @@ def fixup_python_shebangs(prefix, release):
     deploys.  This breaks the application since the corresponding Python modules
     won't be picked up correctly.
 
-    For now, we use sed to rewrite the first line in some executables.
+    For now, we rewrite the first line in some executables.
 
     This is a hack that should be fixed at some point.
 
@@ -47,4 +47,7 @@ def fixup_python_shebangs(prefix, release):
     for bin_ in bins_:
         binpath_ = os.path.join(prefix, release, "root", "bin", bin_)
         if os.path.exists(binpath_):
-            shell(f"""sed -i 1c#!{python_} {binpath_}""")
+            with open(binpath_, "rb") as script:
+                script.readline()
+                body = script.read()
+            write_preserving_mode(binpath_, os.fsencode(f"#!{python_}\n") + body)
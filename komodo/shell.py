@@ -1,8 +1,13 @@
+import collections
 import contextlib
 import os
 import subprocess
 import sys
-from typing import List, Optional, Union
+import threading
+import time
+from typing import List, Mapping, Optional, Union
+
+from komodo.tracing import span
 
 
 @contextlib.contextmanager
@@ -16,7 +21,87 @@ def pushd(path):
     os.chdir(prev)
 
 
-def shell(cmd: Union[str, List[Optional[str]]], allow_failure: bool = False) -> bytes:
+# The number of lines of output kept in memory from commands logged to file
+TAIL_LINES = 100
+# Seconds between the progress lines printed for commands logged to file
+PROGRESS_INTERVAL = 30.0
+_MAX_LINE_LENGTH = 64 * 1024
+
+
+def _run_logged(
+    cmdlist: List[str],
+    *,
+    prompt: str,
+    log_file: str,
+    allow_failure: bool,
+    cwd: Optional[str],
+    env: Optional[Mapping[str, str]],
+) -> bytes:
+    label = os.path.basename(log_file)
+    tail: collections.deque = collections.deque(maxlen=TAIL_LINES)
+    line_count = 0
+    with open(log_file, "ab") as log, subprocess.Popen(
+        cmdlist,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=cwd,
+        env=env,
+    ) as process:
+        log.write(f"{prompt} {' '.join(cmdlist)}\n".encode())
+
+        def read_output():
+            nonlocal line_count
+            for line in iter(lambda: process.stdout.readline(_MAX_LINE_LENGTH), b""):
+                log.write(line)
+                tail.append(line)
+                line_count += 1
+
+        # The output is read in a thread of its own, so that progress is
+        # also reported while the command is silent, e.g. while linking
+        reader = threading.Thread(target=read_output, daemon=True)
+        started = time.monotonic()
+        reader.start()
+        reader.join(PROGRESS_INTERVAL)
+        while reader.is_alive():
+            last_line = tail[-1].decode(errors="replace").strip()[:80] if tail else ""
+            elapsed = time.monotonic() - started
+            print(f"{label}: {line_count} lines after {elapsed:.0f}s, {last_line}")
+            reader.join(PROGRESS_INTERVAL)
+        returncode = process.wait()
+
+    output = b"".join(tail)
+    print(f"{label}: {cmdlist[0]} wrote {line_count} lines to {log_file}")
+    if returncode == 0:
+        return output
+    print(
+        f"{label}: {cmdlist[0]} failed, the last lines of {log_file} are:",
+        file=sys.stderr,
+    )
+    print(output.decode(errors="replace"), file=sys.stderr)
+    if allow_failure:
+        return output
+    raise subprocess.CalledProcessError(returncode, cmdlist, output=output)
+
+
+def shell(
+    cmd: Union[str, List[Optional[str]]],
+    allow_failure: bool = False,
+    cwd: Optional[str] = None,
+    env: Optional[Mapping[str, str]] = None,
+    log_file: Optional[str] = None,
+) -> bytes:
+    """Run cmd and return its output.
+
+    cwd and env are passed on to the subprocess instead of changing the
+    working directory or environment of the komodo process, so that several
+    commands can run from different threads at the same time.
+
+    If log_file is given, stdout and stderr of the command are appended to it
+    as they are produced, and only the last TAIL_LINES lines are kept in
+    memory and returned (or attached to the CalledProcessError). A short
+    progress line is printed every PROGRESS_INTERVAL seconds while the
+    command runs, also when it prints nothing.
+    """
     try:
         cmdlist = cmd.split(" ")
     except AttributeError:
@@ -24,11 +109,26 @@ def shell(cmd: Union[str, List[Optional[str]]], allow_failure: bool = False) ->
         # re-join and split
         cmdlist = " ".join(filter(None, cmd)).split(" ")
 
-    prompt = f"[{os.getcwd()}]>"
+    prompt = f"[{cwd or os.getcwd()}]>"
     print(prompt, " ".join(cmdlist))
 
+    # Only the program name is traced, the arguments may contain credentials
+    program = os.path.basename(next(filter(None, cmdlist), ""))
+    if log_file is not None:
+        with span(program, "subprocess", cwd=cwd or os.getcwd()):
+            return _run_logged(
+                list(filter(None, cmdlist)),
+                prompt=prompt,
+                log_file=log_file,
+                allow_failure=allow_failure,
+                cwd=cwd,
+                env=env,
+            )
     try:
-        return subprocess.check_output(tuple(filter(None, cmdlist)))
+        with span(program, "subprocess", cwd=cwd or os.getcwd()):
+            return subprocess.check_output(
+                tuple(filter(None, cmdlist)), cwd=cwd, env=env
+            )
     except subprocess.CalledProcessError as called_process_error:
         print(called_process_error.output, file=sys.stderr)
         if allow_failure:
@@ -0,0 +1,92 @@
+"""Records how long the phases of a build, each package, and each
+subprocess take, and writes them in the Chrome trace event format, which can
+be opened in https://ui.perfetto.dev or chrome://tracing.
+
+Spans started from the same thread nest in the viewer by their start time
+and duration, so a package span shows the subprocesses it ran.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._events: List[Dict[str, Any]] = []
+            self._thread_names: Dict[int, str] = {}
+            self._origin = time.perf_counter()
+
+    def _now(self) -> float:
+        """Microseconds since the tracer was reset."""
+        return (time.perf_counter() - self._origin) * 1e6
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "phase", **args: Any) -> Iterator[None]:
+        """Record the time spent in the with-block under name."""
+        start = self._now()
+        try:
+            yield
+        finally:
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": self._now() - start,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args,
+            }
+            with self._lock:
+                self._events.append(event)
+                self._thread_names[thread.ident] = thread.name
+
+    def durations(self, category: str) -> List[Tuple[str, datetime.timedelta]]:
+        """The name and duration of every finished span in category, in the
+        order they were started.
+        """
+        with self._lock:
+            events = sorted(
+                (e for e in self._events if e["cat"] == category),
+                key=lambda e: e["ts"],
+            )
+        return [
+            (event["name"], datetime.timedelta(microseconds=event["dur"]))
+            for event in events
+        ]
+
+    def write(self, path: Union[str, Path]) -> None:
+        with self._lock:
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self._thread_names.items()
+            ]
+            events = metadata + self._events
+        with open(path, mode="w", encoding="utf-8") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+tracer = Tracer()
+
+
+def span(name: str, category: str = "phase", **args: Any):
+    """Record a span with the global tracer, see Tracer.span()."""
+    return tracer.span(name, category, **args)
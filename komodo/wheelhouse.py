@@ -0,0 +1,189 @@
+"""A wheelhouse of pypi distributions shared between komodo builds.
+
+Downloaded wheels and sdists are kept in one flat directory, and a PEP 503
+simple index is generated over them, so that pip can install from the
+wheelhouse with --index-url file://... instead of scanning a --find-links
+directory for every package. Only the distributions that are not already
+in the wheelhouse are downloaded.
+"""
+
+import contextlib
+import fcntl
+import html
+import os
+import re
+import shutil
+import subprocess
+import uuid
+from pathlib import Path
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from packaging.tags import Tag, parse_tag
+from packaging.utils import (
+    InvalidSdistFilename,
+    InvalidWheelFilename,
+    canonicalize_name,
+    parse_sdist_filename,
+    parse_wheel_filename,
+)
+from packaging.version import InvalidVersion, Version
+
+from komodo.shell import shell
+
+
+def parse_distribution_filename(
+    filename: str,
+) -> Optional[Tuple[str, Version, Optional[FrozenSet[Tag]]]]:
+    """The normalized project name, version and, for wheels, tags of a
+    distribution file, or None if it is not one.
+
+    >>> parse_distribution_filename("PyYAML-6.0.1.tar.gz")[:2]
+    ('pyyaml', <Version('6.0.1')>)
+    """
+    try:
+        if filename.endswith(".whl"):
+            name, version, _, tags = parse_wheel_filename(filename)
+            return name, version, tags
+        name, version = parse_sdist_filename(filename)
+        return name, version, None
+    except (InvalidWheelFilename, InvalidSdistFilename, InvalidVersion):
+        return None
+
+
+def pip_compatible_tags(pip: str) -> Optional[Set[Tag]]:
+    """The wheel tags supported by the interpreter running pip, or None if
+    pip does not report them."""
+    try:
+        output = shell([pip, "debug --verbose"]).decode("utf-8", errors="replace")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r"^Compatible tags: \d+\n((?:[ \t]+\S+\n?)+)", output, re.M)
+    if not match:
+        return None
+    tags = set()
+    for line in match.group(1).split():
+        tags.update(parse_tag(line))
+    return tags
+
+
+class Wheelhouse:
+    def __init__(self, path: Union[str, Path]):
+        """A persistent directory of pypi distributions.
+
+        Args:
+            path: The directory holding the wheelhouse. Created if it does not
+                exist. Distributions are kept in files/, and the simple index
+                in simple/.
+        """
+        self.path = Path(path).absolute()
+        self.files = self.path / "files"
+        self.simple = self.path / "simple"
+        self._tmp = self.path / "tmp"
+        for directory in (self.files, self.simple, self._tmp):
+            directory.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def index_url(self) -> str:
+        return self.simple.as_uri() + "/"
+
+    @contextlib.contextmanager
+    def _lock(self, operation: int) -> Iterator[None]:
+        with open(self.path / "lock", "a", encoding="utf-8") as lockfile:
+            fcntl.flock(lockfile, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def missing(
+        self, requirements: Iterable[str], tags: Optional[Set[Tag]] = None
+    ) -> List[str]:
+        """The name==version requirements without a distribution in the
+        wheelhouse. If tags is given, wheels only count if they support one
+        of them. Requirements on versions which are not valid PEP 440
+        versions are always missing."""
+        available: Set[Tuple[str, Version]] = set()
+        for filename in os.listdir(self.files):
+            parsed = parse_distribution_filename(filename)
+            if parsed is None:
+                continue
+            name, version, wheel_tags = parsed
+            if tags is None or wheel_tags is None or wheel_tags & tags:
+                available.add((name, version))
+        missing = []
+        for requirement in requirements:
+            name, _, version = requirement.partition("==")
+            try:
+                parsed_version = Version(version)
+            except InvalidVersion:
+                # Files with such versions cannot be parsed, so they are not
+                # in available and are downloaded again every time. They are
+                # not on the simple index either, pip only finds them when
+                # also given the files directory with --find-links.
+                missing.append(requirement)
+                continue
+            if (canonicalize_name(name), parsed_version) not in available:
+                missing.append(requirement)
+        return missing
+
+    def download(self, requirements: List[str], pip: str = "pip") -> None:
+        """Download the requirements with pip into the wheelhouse, and update
+        the index."""
+        staging = self._tmp / uuid.uuid4().hex
+        staging.mkdir()
+        try:
+            shell(
+                [pip, "download", "--no-deps", f"--dest {staging}", *requirements],
+            )
+            with self._lock(fcntl.LOCK_EX):
+                for distribution in staging.iterdir():
+                    # Another build may have added the same file meanwhile
+                    if not (self.files / distribution.name).exists():
+                        os.replace(distribution, self.files / distribution.name)
+                self._write_index()
+        finally:
+            shutil.rmtree(staging)
+
+    def write_index(self) -> None:
+        """Generate the PEP 503 simple index over all distributions."""
+        with self._lock(fcntl.LOCK_EX):
+            self._write_index()
+
+    def _write_index(self) -> None:
+        # Files which parse_distribution_filename rejects, e.g. those with
+        # versions which are not valid PEP 440 versions, are left out
+        projects: Dict[str, List[str]] = {}
+        for filename in sorted(os.listdir(self.files)):
+            parsed = parse_distribution_filename(filename)
+            if parsed is not None:
+                projects.setdefault(parsed[0], []).append(filename)
+
+        for project, filenames in projects.items():
+            links = "".join(
+                f'<a href="../../files/{html.escape(name)}">{html.escape(name)}</a><br>\n'
+                for name in filenames
+            )
+            (self.simple / project).mkdir(exist_ok=True)
+            _write_page(self.simple / project / "index.html", links)
+        links = "".join(
+            f'<a href="{project}/">{project}</a><br>\n' for project in sorted(projects)
+        )
+        _write_page(self.simple / "index.html", links)
+
+
+def _write_page(path: Path, body: str) -> None:
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    tmp.write_text(
+        f"<!DOCTYPE html>\n<html><body>\n{body}</body></html>\n", encoding="utf-8"
+    )
+    os.replace(tmp, path)
@@ -88,7 +88,11 @@ def mock_release_file():
 @pytest.fixture()
 def captured_shell_commands(monkeypatch):
     commands = []
+
+    def capture(cmd, *args, **kwargs):
+        commands.append(cmd)
+
     with monkeypatch.context() as monkeypatch_context:
-        monkeypatch_context.setattr("komodo.build.shell", commands.append)
-        monkeypatch_context.setattr("komodo.fetch.shell", commands.append)
+        monkeypatch_context.setattr("komodo.build.shell", capture)
+        monkeypatch_context.setattr("komodo.fetch.shell", capture)
         yield commands
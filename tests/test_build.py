@@ -1,6 +1,7 @@
 import pytest
 
-from komodo.build import make
+from komodo.build import dependency_graph, make
+from komodo.scheduler import build_order
 
 
 def test_make_with_empty_pkgs(captured_shell_commands, tmpdir):
@@ -27,3 +28,40 @@ def test_make_sh_does_not_accept_pypi_package_name(tmpdir):
 
     with pytest.raises(ValueError, match=r"pypi_package_name"):
         make(packages, repositories, {}, str(tmpdir))
+
+
+@pytest.mark.usefixtures("captured_shell_commands")
+def test_rebuilt_package_starts_a_new_log(tmp_path):
+    repositories = {
+        "pkg": {"1.0": {"make": "rsync", "maintainer": "someone", "depends": []}}
+    }
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "logs" / "pkg-1.0.log").write_text("failed earlier", encoding="utf-8")
+
+    make({"pkg": "1.0"}, repositories, {}, str(tmp_path), logdir=tmp_path / "logs")
+
+    assert (tmp_path / "logs" / "pkg-1.0.log").read_text(encoding="utf-8") == ""
+
+
+def _repository(depends):
+    return {
+        name: {
+            "1.0": {
+                "make": "sh",
+                "makefile": "build.sh",
+                "maintainer": "someone",
+                "depends": deps,
+            }
+        }
+        for name, deps in depends.items()
+    }
+
+
+def test_dependency_graph_puts_python_first_and_ignores_packages_not_in_release():
+    repo = _repository(
+        {"python": [], "numpy": ["python", "setuptools"], "scipy": ["numpy"]}
+    )
+    pkgs = {"scipy": "1.0", "numpy": "1.0", "python": "1.0"}
+    graph = dependency_graph(pkgs, repo)
+    assert graph == {"scipy": {"numpy", "python"}, "numpy": {"python"}, "python": set()}
+    assert build_order(graph) == ["python", "numpy", "scipy"]
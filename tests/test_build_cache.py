@@ -0,0 +1,206 @@
+import os
+import subprocess
+import tarfile
+import threading
+
+import pytest
+
+from komodo import build
+from komodo.build import make
+from komodo.build_cache import BuildCache, _SharedExclusiveLock, snapshot
+from komodo.data import Data
+
+BUILD_SCRIPT = """\
+while test $# -gt 0; do
+    case "$1" in
+        --prefix) shift; PREFIX=$1 ;;
+        --fakeroot) shift; FAKEROOT=$1 ;;
+        --name) shift; NAME=$1 ;;
+    esac
+    shift
+done
+echo "$NAME" >> {log}
+mkdir -p "$FAKEROOT/$PREFIX/lib"
+echo "$NAME" > "$FAKEROOT/$PREFIX/lib/$NAME.so"
+ln -sf "$NAME.so" "$FAKEROOT/$PREFIX/lib/lib$NAME.so"
+"""
+
+
+@pytest.fixture()
+def build_setup(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    build_log = tmp_path / "built.log"
+    (data_dir / "build.sh").write_text(
+        BUILD_SCRIPT.format(log=build_log), encoding="utf-8"
+    )
+    downloads = tmp_path / "downloads"
+
+    def repository(versions):
+        repo = {}
+        for name, (version, depends) in versions.items():
+            (downloads / f"{name}-{version}").mkdir(parents=True, exist_ok=True)
+            repo[name] = {
+                version: {
+                    "make": "sh",
+                    "makefile": "build.sh",
+                    "makeopts": f"--name {name}",
+                    "maintainer": "someone",
+                    "depends": depends,
+                }
+            }
+        return repo
+
+    def build(versions, fakeroot):
+        make(
+            {name: version for name, (version, _) in versions.items()},
+            repository(versions),
+            Data(extra_data_dirs=[str(data_dir)]),
+            prefix="/prefix",
+            dlprefix=str(downloads),
+            fakeroot=str(tmp_path / fakeroot),
+            build_cache=BuildCache(tmp_path / "cache"),
+        )
+        built = build_log.read_text(encoding="utf-8").split()
+        build_log.write_text("", encoding="utf-8")
+        return built
+
+    return build
+
+
+def test_cached_packages_are_unpacked_instead_of_built(build_setup, tmp_path):
+    versions = {"base": ("1.0", []), "app": ("1.0", ["base"])}
+    assert build_setup(versions, "first") == ["base", "app"]
+    assert build_setup(versions, "second") == []
+
+    libdir = tmp_path / "second" / "prefix" / "lib"
+    assert (libdir / "app.so").read_text(encoding="utf-8") == "app\n"
+    assert (libdir / "libapp.so").is_symlink()
+    assert (
+        snapshot(libdir).keys()
+        == snapshot(tmp_path / "first" / "prefix" / "lib").keys()
+    )
+
+
+def test_changed_dependency_rebuilds_dependents(build_setup):
+    build_setup({"base": ("1.0", []), "app": ("1.0", ["base"]), "x": ("1.0", [])}, "a")
+    assert build_setup(
+        {"base": ("2.0", []), "app": ("1.0", ["base"]), "x": ("1.0", [])}, "b"
+    ) == ["base", "app"]
+
+
+def test_new_commit_of_the_same_version_is_rebuilt(build_setup, tmp_path):
+    source = tmp_path / "downloads" / "base-main"
+    source.mkdir(parents=True)
+
+    def commit():
+        subprocess.run(
+            [
+                "git",
+                "-c",
+                "user.name=komodo",
+                "-c",
+                "user.email=komodo@example.com",
+                "commit",
+                "--quiet",
+                "--allow-empty",
+                "-m",
+                "change",
+            ],
+            cwd=source,
+            check=True,
+        )
+
+    subprocess.run(["git", "init", "--quiet"], cwd=source, check=True)
+    commit()
+    versions = {"base": ("main", []), "app": ("1.0", ["base"])}
+    assert build_setup(versions, "first") == ["base", "app"]
+    assert build_setup(versions, "second") == []
+    commit()
+    assert build_setup(versions, "third") == ["base", "app"]
+
+
+def test_changed_source_tree_is_rebuilt(build_setup, tmp_path):
+    source = tmp_path / "downloads" / "base-1.0"
+    source.mkdir(parents=True)
+    (source / "setup.cfg").write_text("a", encoding="utf-8")
+    versions = {"base": ("1.0", [])}
+    assert build_setup(versions, "first") == ["base"]
+    (source / "setup.cfg").write_text("b", encoding="utf-8")
+    assert build_setup(versions, "second") == ["base"]
+
+
+def test_artifact_only_contains_files_installed_by_the_package(build_setup, tmp_path):
+    build_setup({"base": ("1.0", []), "app": ("1.0", ["base"])}, "first")
+    # Only base is in the release, so app's files must not appear
+    build_setup({"base": ("1.0", [])}, "second")
+    assert sorted(
+        p.name for p in (tmp_path / "second" / "prefix" / "lib").iterdir()
+    ) == [
+        "base.so",
+        "libbase.so",
+    ]
+
+
+def test_exclusive_holder_waits_for_shared_holders():
+    lock = _SharedExclusiveLock()
+    events = []
+    shared_entered = threading.Event()
+    release_shared = threading.Event()
+
+    def hold_shared():
+        with lock.shared():
+            shared_entered.set()
+            release_shared.wait(5)
+            events.append("shared done")
+
+    def hold_exclusive():
+        with lock.exclusive():
+            events.append("exclusive")
+
+    shared = threading.Thread(target=hold_shared)
+    shared.start()
+    shared_entered.wait(5)
+    exclusive = threading.Thread(target=hold_exclusive)
+    exclusive.start()
+    release_shared.set()
+    shared.join()
+    exclusive.join()
+    assert events == ["shared done", "exclusive"]
+
+
+def test_cmake_build_is_only_captured_while_installing(tmp_path, monkeypatch):
+    cache = BuildCache(tmp_path / "cache")
+    fakeprefix = tmp_path / "fakeroot" / "prefix"
+    exclusive = {}
+
+    def shell(cmd, **kwargs):
+        cmd = " ".join(cmd) if isinstance(cmd, list) else cmd
+        if cmd.startswith("mkdir -p"):
+            os.makedirs(cmd.split()[-1], exist_ok=True)
+            return ""
+        if cmd.endswith(" install"):
+            (fakeprefix / "lib").mkdir()
+            (fakeprefix / "lib" / "libbase.so").write_text("", encoding="utf-8")
+            exclusive["install"] = cache._lock._exclusive
+        elif cmd.startswith("make"):
+            exclusive["compile"] = cache._lock._exclusive
+        else:
+            exclusive["configure"] = cache._lock._exclusive
+        return ""
+
+    monkeypatch.setattr(build, "shell", shell)
+    make(
+        {"base": "1.0"},
+        {"base": {"1.0": {"make": "cmake", "maintainer": "someone"}}},
+        Data(),
+        prefix="/prefix",
+        dlprefix=str(tmp_path / "downloads"),
+        builddir=str(tmp_path / "build"),
+        fakeroot=str(tmp_path / "fakeroot"),
+        build_cache=cache,
+    )
+    assert exclusive == {"configure": False, "compile": False, "install": True}
+    (artifact,) = (tmp_path / "cache").glob("*.tar")
+    with tarfile.open(artifact) as tar:
+        assert "lib/libbase.so" in tar.getnames()
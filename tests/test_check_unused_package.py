@@ -2,6 +2,7 @@ import pytest
 from packaging.requirements import Requirement
 
 from komodo.check_unused_package import check_for_unused_package
+from komodo.requirements_cache import RequirementsCache
 from komodo.yaml_file_types import ReleaseFile, RepositoryFile
 
 from ._mock_get_pypi_requirements import patch_fetch_from_pypi
@@ -100,7 +101,7 @@ def test_check_unused_package(repo, release, package_status):
     assert "The following 1" in result.message and "package_f" in result.message
 
 
-def has_unused_packages(repo, release, package_status):
+def has_unused_packages(repo, release, package_status, cachefile=None):
     package_status["python"] = {"visibility": "public"}
     release["python"] = "3.8-builtin"
     repo["python"] = {"3.8-builtin": {"maintainer": "me", "make": "sh"}}
@@ -110,6 +111,7 @@ def has_unused_packages(repo, release, package_status):
         package_status=package_status,
         repository=RepositoryFile.from_dictionary(repo),
         builtin_python_versions={"3.8-builtin": "3.8.6"},
+        cachefile=cachefile,
     )
 
 
@@ -489,3 +491,19 @@ def test_specified_extras_are_required():
         result = has_unused_packages(repo, release, package_status)
 
         assert result.exitcode == 0  # No unused packages should be reported
+
+
+def test_metadata_is_only_cached_in_the_given_cachefile(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    repo = {"ert": {"13.0.0": {"source": "pypi", "make": "pip", "maintainer": "me"}}}
+    release = {"ert": "13.0.0"}
+    package_status = {"ert": {"visibility": "public"}}
+
+    with patch_fetch_from_pypi(lambda *_: []):
+        has_unused_packages(repo, release, package_status)
+    assert list(tmp_path.iterdir()) == []
+
+    cachefile = str(tmp_path / "cache.sqlite")
+    with patch_fetch_from_pypi(lambda *_: []):
+        has_unused_packages(repo, release, package_status, cachefile)
+    assert RequirementsCache(cachefile, "3.8").get("ert", "13.0.0") == []
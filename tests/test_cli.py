@@ -1,14 +1,18 @@
+import importlib.metadata
 import os
 import shutil
 import sys
+import zipfile
 from pathlib import Path
 from unittest.mock import Mock, patch
 
 import pytest
 import yaml
+from packaging.version import Version
 
 from komodo import build, cli
 from komodo.cli import cli_main
+from komodo.wheelhouse import Wheelhouse
 from tests import _get_test_root
 
 
@@ -153,6 +157,32 @@ def test_no_overwrite_by_default(tmpdir):
         cli_main()
 
 
+def test_trace_is_written_when_the_build_fails(tmpdir):
+    sys.argv = [
+        "kmd",
+        "--workspace",
+        str(tmpdir),
+        os.path.join(_get_test_root(), "data/cli/minimal_release.yml"),
+        os.path.join(_get_test_root(), "data/cli/minimal_repository.yml"),
+        "--prefix",
+        "prefix",
+        "--release",
+        "failing_release",
+        "--extra-data-dirs",
+        os.path.join(_get_test_root(), "data/cli"),
+    ]
+
+    def failing_build(args, data, release_root):
+        Path(args.release).mkdir()
+        raise RuntimeError("build failed")
+
+    with patch.object(
+        cli, "build_non_pypi_packages_and_move_to_release_path", failing_build
+    ), pytest.raises(RuntimeError, match="build failed"):
+        cli_main()
+    assert (Path(tmpdir) / "failing_release" / "failing_release.trace.json").exists()
+
+
 def test_bleeding_overwrite_by_default(tmpdir):
     sys.argv = [
         "kmd",
@@ -300,3 +330,104 @@ def test_komodo_shims_is_installed_at_the_end(tmpdir):
     ]
     assert len(pip_install_calls) == 3
     assert "komodo-shims" in str(pip_install_calls[-1])
+
+
+def test_parse_rsync_stats():
+    output = (
+        "Number of files: 1,234 (reg: 1,000, dir: 234)\n"
+        "Number of regular files transferred: 12\n"
+        "Total file size: 1,234,567 bytes\n"
+        "Total transferred file size: 4,567 bytes\n"
+        "Literal data: 4,567 bytes\n"
+    )
+    assert cli.parse_rsync_stats(output) == {"total": 1234567, "transferred": 4567}
+    assert cli.parse_rsync_stats("") == {"total": 0, "transferred": 0}
+
+
+def test_rsync_komodo_to_destination_links_from_reference(tmp_path):
+    reference = tmp_path / "prefix" / "previous"
+    reference.mkdir(parents=True)
+    mocked_shell = Mock(
+        return_value=b"Total file size: 100 bytes\nTotal transferred file size: 30 bytes\n"
+    )
+    with patch.object(cli, "shell", mocked_shell):
+        stats = cli.rsync_komodo_to_destination(
+            "release",
+            destination=str(tmp_path / "prefix"),
+            link_dest=cli.link_dest_path(tmp_path / "prefix", "previous"),
+        )
+
+    rsync_command = " ".join(filter(None, mocked_shell.mock_calls[-1].args[0]))
+    assert f"--link-dest={reference}" in rsync_command
+    assert rsync_command.endswith(f".release/ {tmp_path}/prefix/.release/")
+    assert stats == {"transferred": 30, "linked": 70}
+
+
+def test_link_dest_path_ignores_missing_reference(tmp_path):
+    assert cli.link_dest_path(tmp_path, None) is None
+    assert cli.link_dest_path(tmp_path, "no-such-release") is None
+    assert cli.link_dest_path(tmp_path, str(tmp_path)) == tmp_path
+
+
+def test_pip_packages_are_installed_from_wheelhouse(tmp_path):
+    repo = {"six": {"1.16.0": {"make": "pip", "maintainer": "someone"}}}
+    wheelhouse = Wheelhouse(tmp_path / "wheelhouse")
+    mocked_shell = Mock(return_value=b"")
+    with patch.object(cli, "shell", mocked_shell):
+        cli.install_previously_downloaded_pip_packages(
+            {"six": "1.16.0"},
+            repo,
+            downloads_directory="downloads",
+            pip_executable="pip",
+            release_root=tmp_path,
+            wheelhouse=wheelhouse,
+        )
+    command = " ".join(filter(None, mocked_shell.mock_calls[0].args[0]))
+    assert f"--index-url {wheelhouse.index_url}" in command
+    assert f"--find-links {wheelhouse.files}" in command
+    assert "--no-index" not in command
+
+
+def _legacy_version_wheel(directory: Path) -> None:
+    dist_info = "legacy-1.0_custom_build.dist-info"
+    files = {
+        "legacy/__init__.py": "",
+        f"{dist_info}/METADATA": (
+            "Metadata-Version: 2.1\nName: legacy\nVersion: 1.0-custom-build\n"
+        ),
+        f"{dist_info}/WHEEL": (
+            "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\n"
+            "Tag: py3-none-any\n"
+        ),
+    }
+    record = "".join(f"{name},,\n" for name in [*files, f"{dist_info}/RECORD"])
+    with zipfile.ZipFile(
+        directory / "legacy-1.0_custom_build-py3-none-any.whl", "w"
+    ) as wheel:
+        for name, content in files.items():
+            wheel.writestr(name, content)
+        wheel.writestr(f"{dist_info}/RECORD", record)
+
+
+@pytest.mark.skipif(
+    Version(importlib.metadata.version("pip")) >= Version("24.1"),
+    reason="pip 24.1 and later refuse versions which are not valid PEP 440",
+)
+def test_pip_installs_non_pep440_version_from_wheelhouse(tmp_path):
+    wheelhouse = Wheelhouse(tmp_path / "wheelhouse")
+    _legacy_version_wheel(wheelhouse.files)
+    wheelhouse.write_index()
+    assert wheelhouse.missing(["legacy==1.0-custom-build"]) == [
+        "legacy==1.0-custom-build"
+    ]
+
+    cli.install_previously_downloaded_pip_packages(
+        {"legacy": "1.0-custom-build"},
+        {"legacy": {"1.0-custom-build": {"make": "pip", "maintainer": "someone"}}},
+        downloads_directory=str(tmp_path / "downloads"),
+        pip_executable=f"{sys.executable} -m pip",
+        release_root=tmp_path / "root",
+        wheelhouse=wheelhouse,
+    )
+
+    assert list((tmp_path / "root").glob("lib/python*/site-packages/legacy"))
@@ -0,0 +1,98 @@
+import errno
+import os
+import stat
+from unittest.mock import patch
+
+from komodo import copier
+from komodo.copier import copy_file, copy_tree
+
+
+def _source_tree(tmp_path):
+    source = tmp_path / "source"
+    (source / "sub" / "deeper").mkdir(parents=True)
+    (source / "top.txt").write_text("top", encoding="utf-8")
+    (source / "sub" / "script.sh").write_text("#!/bin/sh\n", encoding="utf-8")
+    (source / "sub" / "script.sh").chmod(0o755)
+    (source / "sub" / "deeper" / "data.bin").write_bytes(os.urandom(100_000))
+    os.symlink("top.txt", source / "link")
+    return source
+
+
+def test_copy_tree_copies_files_modes_times_and_symlinks(tmp_path):
+    source = _source_tree(tmp_path)
+    destination = tmp_path / "destination"
+
+    stats = copy_tree(source, destination, workers=4)
+
+    assert stats["copied"] == 3
+    assert stats["bytes"] == 100_000 + len("top") + len("#!/bin/sh\n")
+    for name in ["top.txt", "sub/script.sh", "sub/deeper/data.bin"]:
+        assert (destination / name).read_bytes() == (source / name).read_bytes()
+        assert (destination / name).stat().st_mtime_ns == (
+            source / name
+        ).stat().st_mtime_ns
+    assert os.access(destination / "sub" / "script.sh", os.X_OK)
+    assert os.readlink(destination / "link") == "top.txt"
+
+
+def test_copy_tree_skips_unchanged_files(tmp_path):
+    source = _source_tree(tmp_path)
+    destination = tmp_path / "destination"
+    copy_tree(source, destination)
+    (source / "top.txt").write_text("changed", encoding="utf-8")
+
+    stats = copy_tree(source, destination)
+
+    assert stats == {"copied": 1, "skipped": 2, "bytes": len("changed")}
+    assert (destination / "top.txt").read_text(encoding="utf-8") == "changed"
+
+
+def test_copy_tree_with_symlinks(tmp_path):
+    source = _source_tree(tmp_path)
+    destination = tmp_path / "destination"
+
+    copy_tree(source, destination, symlink=True)
+
+    assert (destination / "sub").is_dir()
+    assert not (destination / "sub").is_symlink()
+    assert os.readlink(destination / "sub" / "script.sh") == str(
+        source / "sub" / "script.sh"
+    )
+
+
+def test_copy_file_falls_back_when_reflink_and_copy_file_range_fail(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"content")
+
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "unsupported")
+
+    with patch.object(copier.fcntl, "ioctl", unsupported), patch.object(
+        copier.os, "copy_file_range", unsupported, create=True
+    ):
+        assert copy_file(str(source), str(tmp_path / "destination"))
+    assert (tmp_path / "destination").read_bytes() == b"content"
+
+
+def test_copy_tree_skips_special_files(tmp_path, capsys):
+    source = _source_tree(tmp_path)
+    os.mkfifo(source / "sub" / "fifo")
+    destination = tmp_path / "destination"
+
+    stats = copy_tree(source, destination)
+
+    assert stats["copied"] == 3
+    assert not os.path.lexists(destination / "sub" / "fifo")
+    assert "fifo, which is not a regular file" in capsys.readouterr().err
+
+
+def test_copy_tree_copies_directory_modes_and_times(tmp_path):
+    source = _source_tree(tmp_path)
+    (source / "sub").chmod(0o750)
+    os.utime(source / "sub", ns=(1_000_000_000, 1_000_000_000))
+    destination = tmp_path / "destination"
+
+    copy_tree(source, destination)
+
+    assert stat.S_IMODE((destination / "sub").stat().st_mode) == 0o750
+    assert (destination / "sub").stat().st_mtime_ns == 1_000_000_000
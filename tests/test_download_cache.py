@@ -0,0 +1,148 @@
+import os
+import subprocess
+import threading
+
+import pytest
+
+from komodo.download_cache import DownloadCache
+from komodo.fetch import fetch
+from komodo.package_version import get_git_remote_hash
+
+
+def test_files_are_hard_linked_from_the_cache(tmp_path):
+    cache = DownloadCache(tmp_path / "cache")
+    archive = tmp_path / "pkg-1.0.tar.gz"
+    archive.write_bytes(b"archive")
+    key = DownloadCache.key("pkg", "1.0", "https://example.com/pkg-1.0.tar.gz")
+
+    assert not cache.restore(key, tmp_path / "miss")
+    cache.store(key, archive)
+    assert cache.restore(key, tmp_path / "hit.tar.gz")
+    assert (tmp_path / "hit.tar.gz").read_bytes() == b"archive"
+    assert os.path.samefile(tmp_path / "hit.tar.gz", archive)
+
+
+def test_directories_are_copied_from_the_cache(tmp_path):
+    cache = DownloadCache(tmp_path / "cache")
+    checkout = tmp_path / "checkout"
+    (checkout / "src").mkdir(parents=True)
+    (checkout / "src" / "main.py").write_text("pass", encoding="utf-8")
+    (checkout / "link").symlink_to("src")
+    key = DownloadCache.key("pkg", "main", "git://example.com/pkg", "a" * 40)
+
+    cache.store(key, checkout)
+    assert cache.restore(key, tmp_path / "restored")
+    assert (tmp_path / "restored" / "src" / "main.py").read_text(
+        encoding="utf-8"
+    ) == "pass"
+    assert os.readlink(tmp_path / "restored" / "link") == "src"
+    assert not os.path.samefile(
+        tmp_path / "restored" / "src" / "main.py", checkout / "src" / "main.py"
+    )
+
+
+def test_key_depends_on_git_commit():
+    url = "git://example.com/pkg"
+    assert DownloadCache.key("pkg", "main", url, "a" * 40) != DownloadCache.key(
+        "pkg", "main", url, "b" * 40
+    )
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = DownloadCache(tmp_path / "cache", max_size=250)
+    for name in ("old", "used", "new"):
+        source = tmp_path / name
+        source.write_bytes(b"x" * 100)
+        cache.store(name, source)
+    os.utime(cache.path / "entries" / "old" / "last-used", (1, 1))
+    os.utime(cache.path / "entries" / "used" / "last-used", (2, 2))
+    os.utime(cache.path / "entries" / "new" / "last-used", (3, 3))
+    assert cache.restore("used", tmp_path / "restored")
+
+    assert cache.evict() == 100
+    assert sorted(os.listdir(cache.path / "entries")) == ["new", "used"]
+
+
+def test_concurrent_stores_of_the_same_key_keep_one_entry(tmp_path):
+    cache = DownloadCache(tmp_path / "cache")
+    sources = []
+    for i in range(8):
+        source = tmp_path / f"source{i}"
+        source.mkdir()
+        (source / "file").write_text("content", encoding="utf-8")
+        sources.append(source)
+    threads = [
+        threading.Thread(target=cache.store, args=("key", source)) for source in sources
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert os.listdir(cache.path / "entries") == ["key"]
+    assert os.listdir(cache.path / "tmp") == []
+
+
+@pytest.fixture()
+def git_repository(tmp_path):
+    repository = tmp_path / "upstream"
+    repository.mkdir()
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": "a",
+        "GIT_AUTHOR_EMAIL": "a@b",
+        "GIT_COMMITTER_NAME": "a",
+        "GIT_COMMITTER_EMAIL": "a@b",
+    }
+    for cmd in (
+        ["git", "init", "--quiet", "-b", "main"],
+        ["git", "commit", "--quiet", "--allow-empty", "-m", "initial"],
+        ["git", "tag", "-a", "v1.0", "-m", "v1.0"],
+    ):
+        subprocess.check_call(cmd, cwd=repository, env=env)
+    commit = subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], cwd=repository, text=True
+    ).strip()
+    return repository, commit
+
+
+def test_get_git_remote_hash_resolves_branches_and_annotated_tags(git_repository):
+    repository, commit = git_repository
+    assert get_git_remote_hash(str(repository), "main") == commit
+    assert get_git_remote_hash(str(repository), "v1.0") == commit
+    assert get_git_remote_hash(str(repository), "missing") is None
+
+
+def test_second_fetch_uses_cached_git_checkout(git_repository, tmp_path, monkeypatch):
+    repository, commit = git_repository
+    packages = {"pkg": "v1.0"}
+    repositories = {
+        "pkg": {
+            "v1.0": {
+                "source": str(repository),
+                "fetch": "git",
+                "make": "sh",
+                "maintainer": "someone",
+                "makefile": "setup-py.sh",
+            },
+        },
+    }
+    cache = DownloadCache(tmp_path / "cache")
+    monkeypatch.setattr("komodo.fetch.shell", lambda *args, **kwargs: b"")
+    monkeypatch.setattr(
+        "komodo.fetch.grab",
+        lambda path, filename, cwd, **kwargs: subprocess.check_call(
+            ["git", "clone", "--quiet", "-b", "v1.0", path, filename], cwd=cwd
+        ),
+    )
+    assert fetch(
+        packages, repositories, str(tmp_path / "first"), download_cache=cache
+    ) == {"pkg": commit}
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Should have used the cache")
+
+    monkeypatch.setattr("komodo.fetch.grab", fail)
+    assert fetch(
+        packages, repositories, str(tmp_path / "second"), download_cache=cache
+    ) == {"pkg": commit}
@@ -0,0 +1,152 @@
+import hashlib
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from komodo.downloader import Downloader
+
+CONTENT = bytes(range(256)) * 4096  # 1 MiB
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.headers.get("Range"))
+            drop_after = server.drop_after.pop(0) if server.drop_after else None
+        if self.path != "/file":
+            self.send_error(404)
+            return
+        start, end = 0, len(CONTENT) - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match and server.ranges:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            if start >= len(CONTENT):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        body = CONTENT[start : end + 1]
+        if drop_after is not None:
+            self.wfile.write(body[:drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.drop_after = []
+    httpd.ranges = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_streams_and_hashes(server, tmp_path):
+    destination = tmp_path / "file"
+    digest = Downloader().download(f"{server.url}/file", destination, sha256=SHA256)
+
+    assert digest == SHA256
+    assert destination.read_bytes() == CONTENT
+    assert not (tmp_path / "file.part").exists()
+    assert server.requests == [None]
+
+
+def test_download_resumes_interrupted_transfer(server, tmp_path):
+    server.drop_after = [1000]
+    destination = tmp_path / "file"
+
+    downloader = Downloader(buffer_size=100)
+    downloader.download(f"{server.url}/file", destination, sha256=SHA256)
+
+    assert destination.read_bytes() == CONTENT
+    assert server.requests == [None, "bytes=1000-"]
+
+
+def test_download_restarts_if_server_ignores_ranges(server, tmp_path):
+    server.drop_after = [1000]
+    server.ranges = False
+    destination = tmp_path / "file"
+
+    Downloader().download(f"{server.url}/file", destination, sha256=SHA256)
+
+    assert destination.read_bytes() == CONTENT
+
+
+def test_download_continues_partial_file_from_earlier_run(server, tmp_path):
+    (tmp_path / "file.part").write_bytes(CONTENT[:5000])
+    destination = tmp_path / "file"
+
+    Downloader().download(f"{server.url}/file", destination, sha256=SHA256)
+
+    assert destination.read_bytes() == CONTENT
+    assert server.requests == ["bytes=5000-"]
+
+
+def test_download_starts_over_if_partial_file_is_stale(server, tmp_path):
+    (tmp_path / "file.part").write_bytes(b"x" * 5000)
+    destination = tmp_path / "file"
+
+    Downloader().download(f"{server.url}/file", destination, sha256=SHA256)
+
+    assert destination.read_bytes() == CONTENT
+    assert server.requests == ["bytes=5000-", None]
+
+
+def test_download_large_file_in_segments(server, tmp_path):
+    destination = tmp_path / "file"
+    downloader = Downloader(segments=4, segment_threshold=1024)
+
+    digest = downloader.download(f"{server.url}/file", destination)
+
+    assert digest == SHA256
+    assert destination.read_bytes() == CONTENT
+    quarter = len(CONTENT) // 4
+    assert sorted(server.requests[1:]) == [
+        f"bytes={i * quarter}-{(i + 1) * quarter - 1}" for i in range(4)
+    ]
+
+
+def test_download_resumes_interrupted_segment(server, tmp_path):
+    server.drop_after = [None, 100]
+    destination = tmp_path / "file"
+    downloader = Downloader(segments=2, segment_threshold=1024)
+
+    downloader.download(f"{server.url}/file", destination, sha256=SHA256)
+
+    assert destination.read_bytes() == CONTENT
+    assert len(server.requests) == 4
+
+
+def test_download_rejects_wrong_hash(server, tmp_path):
+    destination = tmp_path / "file"
+    with pytest.raises(ValueError, match="not equal to expected hash"):
+        Downloader().download(f"{server.url}/file", destination, sha256="0" * 64)
+    assert not destination.exists()
+    assert not (tmp_path / "file.part").exists()
+
+
+def test_download_raises_on_error_status(server, tmp_path):
+    with pytest.raises(RuntimeError, match="returned status code 404"):
+        Downloader().download(f"{server.url}/missing", tmp_path / "file")
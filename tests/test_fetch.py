@@ -1,9 +1,26 @@
+import functools
 import os
+import socket
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
 
 import pytest
 
-from komodo.fetch import fetch
+from komodo.fetch import (
+    FetchPlan,
+    _Claims,
+    download_and_extract,
+    extract_archive,
+    fetch,
+    plan_fetch,
+    run_fetch_plan,
+)
+from komodo.git_mirror import GitCloneOptions
 
 
 def test_make_one_pip_package(captured_shell_commands, tmpdir):
@@ -163,3 +180,286 @@ def test_expand_jinja2_templates_in_source(captured_shell_commands, tmpdir):
         fetch(packages, repositories, str(tmpdir))
         assert captured_shell_commands[0].startswith("git clone")
         assert "https://VERYSECRETTOKEN@github.com" in captured_shell_commands[0]
+
+
+def test_fetch_respects_protocol_limits(monkeypatch, tmpdir):
+    packages = {f"pkg{i}": "1.0" for i in range(6)}
+    repositories = {
+        name: {
+            "1.0": {
+                "source": f"git://github.com/equinor/{name}.git",
+                "fetch": "git",
+                "make": "sh",
+                "maintainer": "someone",
+                "makefile": "setup-py.sh",
+            },
+        }
+        for name in packages
+    }
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def slow_grab(*args, **kwargs):
+        with lock:
+            active.append(None)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.pop()
+
+    monkeypatch.setattr("komodo.fetch.grab", slow_grab)
+    monkeypatch.setattr("komodo.fetch.shell", lambda *args, **kwargs: b"")
+    monkeypatch.setattr(
+        "komodo.fetch.get_git_revision_hash", lambda path: path[-len("pkg0-1.0") :]
+    )
+    git_hashes = fetch(
+        packages, repositories, str(tmpdir), workers=6, protocol_limits={"git": 2}
+    )
+    assert git_hashes == {name: f"{name}-1.0" for name in packages}
+    assert max(peak) == 2
+
+
+def test_fetch_git_clone_options(captured_shell_commands, tmpdir):
+    packages = {"ert": "main"}
+    repositories = {
+        "ert": {
+            "main": {
+                "source": "git://github.com/equinor/ert.git",
+                "fetch": "git",
+                "make": "sh",
+                "maintainer": "someone",
+                "makefile": "setup-py.sh",
+                "depends": [],
+            },
+        },
+    }
+
+    with patch("komodo.fetch.get_git_revision_hash"):
+        fetch(
+            packages,
+            repositories,
+            str(tmpdir),
+            git_options=GitCloneOptions(
+                shallow=True, filter="blob:none", submodule_jobs=4
+            ),
+        )
+    assert captured_shell_commands[0] == (
+        "git clone -b main --quiet --recurse-submodules --depth 1 "
+        "--shallow-submodules --filter=blob:none --jobs 4 -- "
+        "git://github.com/equinor/ert.git ert-main"
+    )
+
+
+def _tarball(path, topdir):
+    source = path / "source" / topdir
+    source.mkdir(parents=True)
+    (source / "CMakeLists.txt").write_text("project(pkg)", encoding="utf-8")
+    archive = path / "pkg.tar.gz"
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(source, arcname=topdir)
+    return archive
+
+
+def test_extract_archive_finds_top_level_directory(tmp_path):
+    archive = _tarball(tmp_path, "pkg-1.0")
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+
+    with open(archive, "rb") as fileobj:
+        assert extract_archive(fileobj, str(outdir)) == "pkg-1.0"
+    assert (outdir / "pkg-1.0" / "CMakeLists.txt").exists()
+
+
+def test_fetch_extracts_archive_while_downloading(captured_shell_commands, tmp_path):
+    archive = _tarball(tmp_path, "pkg-1.0-src")
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(tmp_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/{archive.name}"
+    repositories = {
+        "pkg": {
+            "1.0": {
+                "source": url,
+                "make": "cmake",
+                "maintainer": "someone",
+                "depends": [],
+            },
+        },
+    }
+    outdir = tmp_path / "downloads"
+    try:
+        fetch({"pkg": "1.0"}, repositories, str(outdir))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert (outdir / "pkg-1.0" / "CMakeLists.txt").exists()
+    assert os.readlink(outdir / "pkg-1.0") == "pkg-1.0-src"
+    assert not (outdir / "pkg-1.0.tar.gz").exists()
+    # Only pip download is run in a shell
+    assert len(captured_shell_commands) == 1
+
+
+def test_interrupted_download_and_extract_is_started_over(tmp_path):
+    archive = _tarball(tmp_path, "pkg-1.0-src")
+    content = archive.read_bytes()
+    requests_served = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requests_served.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            # Cut the first response off in the middle of the archive
+            if len(requests_served) == 1:
+                self.wfile.write(content[: len(content) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(content)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/{archive.name}"
+    outdir = tmp_path / "downloads"
+    outdir.mkdir()
+    try:
+        assert download_and_extract(url, str(outdir)) == "pkg-1.0-src"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(requests_served) == 2
+    assert (outdir / "pkg-1.0-src" / "CMakeLists.txt").exists()
+    assert sorted(os.listdir(outdir)) == ["pkg-1.0-src"]
+
+
+@patch.dict(os.environ, {"ACCESS_TOKEN": "VERYSECRETTOKEN"})
+def test_fetch_plan_is_written_with_rendered_sources(tmp_path):
+    repositories = {
+        "secrettool": {
+            "10.0": {
+                "source": "https://{{ACCESS_TOKEN}}@example.com/secrettool.tar.gz",
+                "make": "sh",
+                "maintainer": "someone",
+            },
+        },
+        "pyaml": {"20.4.0": {"source": "pypi", "make": "pip", "maintainer": "me"}},
+    }
+    plan = plan_fetch({"secrettool": "10.0", "pyaml": "20.4.0"}, repositories)
+    plan.write(tmp_path / "plan.json")
+
+    assert (tmp_path / "plan.json").stat().st_mode & 0o777 == 0o600
+    read_plan = FetchPlan.read(tmp_path / "plan.json")
+    assert read_plan == plan
+    assert read_plan.pypi_packages == ["pyaml==20.4.0"]
+    (item,) = read_plan.items
+    assert item.url == "https://VERYSECRETTOKEN@example.com/secrettool.tar.gz"
+    assert item.destination == "secrettool-10.0.tar.gz"
+    assert item.artifact == "secrettool-10.0"
+    assert item.extension == "tar.gz"
+
+
+def _fs_cp_repository(names):
+    return {
+        name: {
+            "1.0": {
+                "source": f"/src/{name}",
+                "fetch": "fs-cp",
+                "make": "sh",
+                "maintainer": "someone",
+            }
+        }
+        for name in names
+    }
+
+
+def test_shared_fetch_plan_fetches_each_item_once(captured_shell_commands, tmp_path):
+    names = [f"pkg{i}" for i in range(8)]
+    plan = plan_fetch(dict.fromkeys(names, "1.0"), _fs_cp_repository(names))
+    grabbed = []
+
+    def grab(url, filename, cwd, **kwargs):
+        grabbed.append(filename)
+        time.sleep(0.01)
+        os.mkdir(os.path.join(cwd, filename))
+
+    with patch("komodo.fetch.grab", grab):
+        workers = [
+            threading.Thread(
+                target=run_fetch_plan,
+                args=(plan, str(tmp_path)),
+                kwargs={"shared": True},
+            )
+            for _ in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    assert sorted(grabbed) == [f"{name}-1.0" for name in names]
+    assert all((tmp_path / f"{name}-1.0").is_dir() for name in names)
+    # pip download runs once
+    assert len(captured_shell_commands) == 1
+
+
+def test_shared_fetch_plan_reports_failure_of_other_process(tmp_path):
+    plan = plan_fetch({"pkg": "1.0"}, _fs_cp_repository(["pkg"]))
+    claims = tmp_path / ".fetch-claims"
+    claims.mkdir()
+    (claims / "pkg-1.0").touch()
+    (claims / "pkg-1.0.failed").touch()
+    (claims / "pypi").touch()
+    (claims / "pypi.done").touch()
+
+    with pytest.raises(RuntimeError, match="Fetching pkg-1.0 failed in another"):
+        run_fetch_plan(plan, str(tmp_path), shared=True)
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_shared_fetch_plan_takes_over_claims_of_dead_processes(
+    captured_shell_commands, tmp_path
+):
+    plan = plan_fetch({"pkg": "1.0"}, _fs_cp_repository(["pkg"]))
+    claims = tmp_path / ".fetch-claims"
+    claims.mkdir()
+    owner = f"{socket.gethostname()} {_dead_pid()}\n"
+    (claims / "pkg-1.0").write_text(owner, encoding="utf-8")
+    (claims / "pypi").write_text(owner, encoding="utf-8")
+    # Left behind by the process that died
+    (tmp_path / "pkg-1.0").mkdir()
+    (tmp_path / "pkg-1.0" / "partial").touch()
+    grabbed = []
+
+    def grab(url, filename, cwd, **kwargs):
+        grabbed.append(filename)
+        os.mkdir(os.path.join(cwd, filename))
+
+    with patch("komodo.fetch.grab", grab):
+        run_fetch_plan(plan, str(tmp_path), shared=True)
+
+    assert grabbed == ["pkg-1.0"]
+    assert list((tmp_path / "pkg-1.0").iterdir()) == []
+    assert (claims / "pkg-1.0.done").exists()
+    assert (claims / "pypi.done").exists()
+    assert len(captured_shell_commands) == 1
+
+
+def test_shared_fetch_plan_times_out_waiting_for_other_hosts(tmp_path, monkeypatch):
+    plan = plan_fetch({"pkg": "1.0"}, _fs_cp_repository(["pkg"]))
+    claims = tmp_path / ".fetch-claims"
+    claims.mkdir()
+    (claims / "pkg-1.0").write_text("some-other-host 1\n", encoding="utf-8")
+    (claims / "pypi").write_text("some-other-host 1\n", encoding="utf-8")
+    monkeypatch.setattr(_Claims, "TIMEOUT", 0.0)
+    monkeypatch.setattr(_Claims, "POLL_INTERVAL", 0.0)
+
+    with pytest.raises(TimeoutError, match="pkg-1.0, pypi"):
+        run_fetch_plan(plan, str(tmp_path), shared=True)
@@ -11,7 +11,7 @@ from packaging.requirements import Requirement
 
 from komodo import lint as kmdlint
 from komodo.komodo_error import KomodoError
-from komodo.pypi_dependencies import PypiDependencies
+from komodo.pypi_dependencies import PypiDependencies, TargetEnvironment
 from komodo.yaml_file_types import ReleaseFile, RepositoryFile
 
 
@@ -507,3 +507,31 @@ def test_empty_depends_field_means_no_dependencies_in_transient():
             )
             == []
         )
+
+
+def test_dependencies_are_checked_for_each_target():
+    with patch_fetch_from_pypi(
+        lambda *_: [Requirement('numpy; python_version >= "3.12"')]
+    ):
+        errors = kmdlint.check_dependencies(
+            ReleaseFile.from_dictionary({"ert": "13.0.0"}),
+            RepositoryFile.from_dictionary(
+                {
+                    "ert": {
+                        "13.0.0": {
+                            "source": "pypi",
+                            "make": "pip",
+                            "maintainer": "scout",
+                        }
+                    }
+                }
+            ),
+            None,
+            [
+                TargetEnvironment("3.11.9", "linux"),
+                TargetEnvironment("3.12.4", "linux"),
+            ],
+        )
+    assert [(e.err, e.package) for e in errors] == [
+        ("Failed requirements for python 3.12.4 on linux:", "ert")
+    ]
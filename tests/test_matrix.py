@@ -55,3 +55,11 @@ def test_get_matrix_base(test_input, expected):
 def test_get_matrix(rhel_ver, py_ver, other_ver, expected_yield):
     yielded = list(matrix.get_matrix(rhel_ver, py_ver, other_ver))
     assert yielded == expected_yield
+
+
+@pytest.mark.parametrize(
+    ("py_tag", "expected"),
+    [("py27", "2.7"), ("py38", "3.8"), ("py311", "3.11"), ("py3.12", "3.12")],
+)
+def test_get_python_version(py_tag, expected):
+    assert matrix.get_python_version(py_tag) == expected
@@ -0,0 +1,43 @@
+import os
+import stat
+
+from komodo.permissions import fix_permissions
+
+
+def _mode(path):
+    return stat.S_IMODE(os.lstat(path).st_mode)
+
+
+def test_fix_permissions(tmp_path):
+    release = tmp_path / "release"
+    nested = release / "root" / "lib" / "python3.11"
+    nested.mkdir(parents=True)
+    (release / "root").chmod(0o700)
+    data_file = nested / "module.py"
+    data_file.write_text("", encoding="utf-8")
+    data_file.chmod(0o600)
+    executable = release / "root" / "python"
+    executable.write_text("", encoding="utf-8")
+    executable.chmod(0o700)
+    target = tmp_path / "outside"
+    target.write_text("", encoding="utf-8")
+    target.chmod(0o600)
+    (release / "link").symlink_to(target)
+
+    assert fix_permissions(release, workers=4) == 3
+
+    assert _mode(release / "root") == 0o705
+    assert _mode(data_file) == 0o604
+    assert _mode(executable) == 0o705
+    assert _mode(target) == 0o600
+    assert fix_permissions(release) == 0
+
+
+def test_fix_permissions_only_changes_what_is_needed(tmp_path):
+    for i in range(50):
+        directory = tmp_path / f"dir{i}"
+        directory.mkdir()
+        (directory / "file").write_text("", encoding="utf-8")
+        (directory / "file").chmod(0o644 if i % 2 else 0o640)
+    tmp_path.chmod(0o755)
+    assert fix_permissions(tmp_path, workers=8) == 25
@@ -1,9 +1,17 @@
 from __future__ import annotations
 
+import sys
+import threading
+
 import pytest
 from packaging.requirements import Requirement
 
-from komodo.pypi_dependencies import PypiDependencies
+from komodo.pypi_dependencies import (
+    PypiDependencies,
+    TargetEnvironment,
+    failed_requirements_per_environment,
+)
+from komodo.requirements_cache import RequirementsCache
 
 from ._mock_get_pypi_requirements import patch_fetch_from_pypi
 
@@ -58,3 +66,149 @@ def test_trunk_versions_satisfy_any_version_requirement(trunk_version):
         )
         dependencies.add_user_specified("semeio", [])
         assert dependencies.failed_requirements() == {}
+
+
+def test_requirements_are_fetched_concurrently_before_traversal():
+    from_pypi = {
+        ("ert", "13.0.0"): [Requirement("numpy==2.0.0")],
+        ("numpy", "2.0.0"): [],
+        ("scipy", "1.14.0"): [Requirement("numpy")],
+    }
+    barrier = threading.Barrier(len(from_pypi), timeout=10)
+    fetched = []
+
+    def fetch(*args):
+        fetched.append(args)
+        barrier.wait()
+        return from_pypi[tuple(args)]
+
+    with patch_fetch_from_pypi(fetch):
+        dependencies = PypiDependencies(
+            {"ert": "13.0.0", "numpy": "2.0.0", "scipy": "1.14.0"},
+            python_version="3.8",
+            cachefile=None,
+            workers=len(from_pypi),
+        )
+        dependencies.prefetch()
+    assert sorted(fetched) == sorted(from_pypi)
+
+    with patch_fetch_from_pypi():
+        assert dependencies.failed_requirements() == {}
+
+
+def test_prefetch_failures_are_raised_when_requirements_are_needed():
+    def fetch(*args):
+        raise ValueError(f"Could not install {args[0]}")
+
+    with patch_fetch_from_pypi(fetch):
+        dependencies = PypiDependencies(
+            {"ert": "13.0.0"}, python_version="3.8", cachefile=None
+        )
+        dependencies.prefetch()
+        with pytest.raises(ValueError, match="Could not install ert"):
+            dependencies.failed_requirements()
+
+
+def test_cached_requirements_are_per_python_version(tmp_path):
+    cachefile = str(tmp_path / "cache.sqlite")
+    with patch_fetch_from_pypi(lambda *args: [Requirement("numpy")]):
+        dependencies = PypiDependencies(
+            {"ert": "13.0.0"}, python_version="3.8.10", cachefile=cachefile
+        )
+        assert dependencies.failed_requirements() == {Requirement("numpy"): "ert"}
+        dependencies.close()
+
+    with patch_fetch_from_pypi():
+        dependencies = PypiDependencies(
+            {"ert": "13.0.0"}, python_version="3.8.18", cachefile=cachefile
+        )
+        assert dependencies.failed_requirements() == {Requirement("numpy"): "ert"}
+        dependencies.close()
+
+    with patch_fetch_from_pypi(lambda *args: []):
+        dependencies = PypiDependencies(
+            {"ert": "13.0.0"}, python_version="3.11", cachefile=cachefile
+        )
+        assert dependencies.failed_requirements() == {}
+        dependencies.close()
+
+
+def test_requirements_cache_is_shared_between_writers(tmp_path):
+    cachefile = str(tmp_path / "cache.sqlite")
+    first = RequirementsCache(cachefile, "3.11")
+    second = RequirementsCache(cachefile, "3.11")
+    first.put("ert", "13.0.0", ["numpy"])
+    second.put("numpy", "2.0.0", [])
+
+    assert second.get("ert", "13.0.0") == ["numpy"]
+    assert first.get("numpy", "2.0.0") == []
+    assert first.get("numpy", "1.0.0") is None
+    assert RequirementsCache(cachefile, "3.12").get("ert", "13.0.0") is None
+
+
+def test_deep_dependency_chains_do_not_hit_the_recursion_limit():
+    depth = 3 * sys.getrecursionlimit()
+    packages = {f"pkg{i}": "1.0.0" for i in range(depth)}
+    with patch_fetch_from_pypi(
+        lambda name, _: (
+            [Requirement(f"pkg{int(name[3:]) + 1}==1.0.0")]
+            if int(name[3:]) + 1 < depth
+            else [Requirement("missing")]
+        )
+    ):
+        dependencies = PypiDependencies(packages, python_version="3.11", cachefile=None)
+        assert not dependencies.satisfied(Requirement("pkg0"), "top")
+        assert dependencies.failed_requirements() == {Requirement("missing"): "top"}
+
+        dependencies = PypiDependencies(packages, python_version="3.11", cachefile=None)
+        assert len(dependencies.used_packages([Requirement("pkg0")])) == depth
+
+
+def test_markers_are_evaluated_for_the_instance_python_version():
+    from_pypi = {
+        ("ert", "13.0.0"): [
+            Requirement('tomli; python_version < "3.11"'),
+            Requirement('numpy[extra]; python_version >= "3.11"'),
+        ],
+        ("numpy", "2.0.0"): [Requirement('scipy; extra == "extra"')],
+    }
+    with patch_fetch_from_pypi(lambda *args: from_pypi[tuple(args)]):
+        old = PypiDependencies(
+            {"ert": "13.0.0", "numpy": "2.0.0"}, python_version="3.8", cachefile=None
+        )
+        new = PypiDependencies(
+            {"ert": "13.0.0", "numpy": "2.0.0"}, python_version="3.11", cachefile=None
+        )
+        assert new.failed_requirements() == {
+            Requirement('scipy; extra == "extra"'): "ert"
+        }
+        assert old.failed_requirements() == {
+            Requirement('tomli; python_version < "3.11"'): "ert"
+        }
+
+
+def test_environments_with_the_same_python_version_share_metadata():
+    fetched = []
+
+    def fetch(*args):
+        fetched.append(args)
+        return [
+            Requirement('pywin32; sys_platform == "win32"'),
+            Requirement('tomli; python_version < "3.11"'),
+        ]
+
+    targets = [
+        TargetEnvironment("3.8.18", "linux"),
+        TargetEnvironment("3.11.9", "linux"),
+        TargetEnvironment("3.11.9", "win32"),
+    ]
+    with patch_fetch_from_pypi(fetch):
+        failed = failed_requirements_per_environment(
+            {"ert": "13.0.0"}, targets, cachefile=None
+        )
+    assert sorted(fetched) == [("ert", "13.0.0"), ("ert", "13.0.0")]
+    assert failed == {
+        targets[0]: {Requirement('tomli; python_version < "3.11"'): "ert"},
+        targets[1]: {},
+        targets[2]: {Requirement('pywin32; sys_platform == "win32"'): "ert"},
+    }
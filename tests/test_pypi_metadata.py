@@ -0,0 +1,144 @@
+import io
+import json
+import os
+import re
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+
+from komodo.pypi_dependencies import PypiDependencies
+from komodo.pypi_metadata import SIMPLE_JSON, requires_dist
+
+METADATA = b"""Metadata-Version: 2.1
+Name: bigpkg
+Version: 1.0.0
+Requires-Dist: numpy>=1.20
+Requires-Dist: pytest; extra == "test"
+
+A description that is not a header.
+"""
+
+
+def _wheel(name):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as wheel:
+        # Incompressible and stored, so that the wheel is large
+        wheel.writestr(f"{name}/data.bin", os.urandom(2 * 1024**2))
+        wheel.writestr(f"{name}-1.0.0.dist-info/METADATA", METADATA)
+        wheel.writestr(f"{name}-1.0.0.dist-info/RECORD", b"")
+    return buffer.getvalue()
+
+
+FILES = {
+    "bigpkg-1.0.0-py3-none-any.whl": _wheel("bigpkg"),
+    "bigpkg-0.9.0-py3-none-any.whl": b"not a zip",
+    "pep658-1.0.0-py3-none-any.whl": _wheel("pep658"),
+    "pep658-1.0.0-py3-none-any.whl.metadata": b"Requires-Dist: attrs\n",
+}
+PROJECTS = {
+    "bigpkg": [
+        {"filename": "bigpkg-0.9.0-py3-none-any.whl"},
+        {"filename": "bigpkg-1.0.0.tar.gz"},
+        {"filename": "bigpkg-1.0.0-py3-none-any.whl"},
+    ],
+    "pep658": [
+        {"filename": "pep658-1.0.0-py3-none-any.whl", "core-metadata": True},
+    ],
+    "sdistonly": [{"filename": "sdistonly-1.0.0.tar.gz"}],
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        match = re.fullmatch(r"/simple/([^/]+)/", self.path)
+        if match and match.group(1) in PROJECTS:
+            files = [
+                {**file, "url": f"../../files/{file['filename']}", "hashes": {}}
+                for file in PROJECTS[match.group(1)]
+            ]
+            self._send(200, json.dumps({"files": files}).encode(), SIMPLE_JSON)
+            return
+        content = FILES.get(self.path[len("/files/") :])
+        if content is None:
+            self.send_error(404)
+            return
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range") or "")
+        if match is None or not self.server.ranges:
+            self._send(200, content)
+            return
+        start, end = match.groups()
+        if not start:
+            start, end = max(len(content) - int(end), 0), len(content) - 1
+        start, end = int(start), int(end or len(content) - 1)
+        self._send(
+            206,
+            content[start : end + 1],
+            headers={"Content-Range": f"bytes {start}-{end}/{len(content)}"},
+        )
+
+    def _send(
+        self, status, body, content_type="application/octet-stream", headers=None
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.sent += len(body)
+
+
+@pytest.fixture
+def index():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.lock = threading.Lock()
+    httpd.sent = 0
+    httpd.ranges = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/simple"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_core_metadata_file_is_used_when_available(index):
+    assert requires_dist("pep658", "1.0.0", "3.11", index.url) == ["attrs"]
+    assert index.sent < 1024
+
+
+def test_wheel_metadata_is_read_with_range_requests(index):
+    assert requires_dist("BigPkg", "1.0.0", "3.11", index.url) == [
+        "numpy>=1.20",
+        'pytest; extra == "test"',
+    ]
+    assert index.sent < 100 * 1024
+
+
+def test_no_metadata_without_range_support_or_wheel(index):
+    assert requires_dist("sdistonly", "1.0.0", "3.11", index.url) is None
+    assert requires_dist("missing", "1.0.0", "3.11", index.url) is None
+    assert requires_dist("bigpkg", "0.9.0", "3.11", index.url) is None
+    index.ranges = False
+    assert requires_dist("bigpkg", "1.0.0", "3.11", index.url) is None
+
+
+def test_pypi_dependencies_reads_metadata_from_index(index):
+    with patch("subprocess.check_output", side_effect=AssertionError):
+        dependencies = PypiDependencies(
+            {"bigpkg": "1.0.0", "numpy": "2.0.0"},
+            python_version="3.11",
+            cachefile=None,
+            index_url=index.url,
+        )
+        dependencies.add_user_specified("numpy", [])
+        assert dependencies.failed_requirements() == {}
+    assert dependencies.requirements["bigpkg"]["1.0.0"][0] == "numpy>=1.20"
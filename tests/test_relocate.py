@@ -0,0 +1,141 @@
+import os
+
+import pytest
+
+from komodo.relocate import main, move_release, relocate
+
+
+@pytest.fixture
+def release(tmp_path):
+    release = tmp_path / "prefix" / "bleeding"
+    root = release / "root"
+    (root / "bin").mkdir(parents=True)
+    (root / "lib" / "pkgconfig").mkdir(parents=True)
+    (release / "bleeding").write_text("python:\n  version: 3.11\n", encoding="utf-8")
+    (release / "enable").write_text(
+        f"export KOMODO_RELEASE=bleeding\nexport PATH={root}/bin\n", encoding="utf-8"
+    )
+    script = root / "bin" / "tool"
+    script.write_text(f"#!{root}/bin/python\nimport tool\n", encoding="utf-8")
+    script.chmod(0o755)
+    (root / "lib" / "pkgconfig" / "lib.pc").write_text(
+        f"prefix={root}\nother={release}-py311/root\n", encoding="utf-8"
+    )
+    (root / "lib" / "cache.json").write_bytes(b"\0\1" + os.fsencode(str(root)) + b"\0")
+    (root / "lib" / "data.bin").write_bytes(os.fsencode(str(root)))
+    os.symlink(root / "bin" / "tool", root / "bin" / "tool-link")
+    os.symlink("tool", root / "bin" / "relative-link")
+    return release
+
+
+def test_relocate_rewrites_text_files_and_symlinks(release, tmp_path):
+    new = str(tmp_path / "other" / "stable")
+    rewritten, binaries = relocate(release, str(release), new, workers=2)
+
+    root = release / "root"
+    assert (root / "bin" / "tool").read_text(encoding="utf-8") == (
+        f"#!{new}/root/bin/python\nimport tool\n"
+    )
+    assert os.access(root / "bin" / "tool", os.X_OK)
+    assert (root / "lib" / "pkgconfig" / "lib.pc").read_text(encoding="utf-8") == (
+        f"prefix={new}/root\nother={release}-py311/root\n"
+    )
+    assert os.readlink(root / "bin" / "tool-link") == f"{new}/root/bin/tool"
+    assert os.readlink(root / "bin" / "relative-link") == "tool"
+    # Binary content and files of unknown type are reported, not rewritten
+    assert binaries == [
+        str(root / "lib" / "cache.json"),
+        str(root / "lib" / "data.bin"),
+    ]
+    assert (root / "lib" / "data.bin").read_bytes() == os.fsencode(str(root))
+    assert sorted(rewritten) == sorted(
+        [
+            str(release / "enable"),
+            str(root / "bin" / "tool"),
+            str(root / "bin" / "tool-link"),
+            str(root / "lib" / "pkgconfig" / "lib.pc"),
+        ]
+    )
+
+
+def test_relocate_reports_executables_and_libraries_referring_to_old_prefix(
+    release, tmp_path
+):
+    root = release / "root"
+    library = root / "lib" / "libtool.so"
+    content = b"\x7fELF\0\0" + os.fsencode(f"{root}/lib") + b"\0"
+    library.write_bytes(content)
+    executable = root / "bin" / "compiled"
+    executable.write_bytes(content)
+    executable.chmod(0o755)
+    (root / "lib" / "empty.so").write_bytes(b"")
+
+    _, binaries = relocate(release, str(release), str(tmp_path / "stable"))
+
+    assert str(library) in binaries
+    assert str(executable) in binaries
+    assert library.read_bytes() == content
+    assert executable.read_bytes() == content
+
+
+def test_relocate_leaves_hard_links_alone(release, tmp_path):
+    script = release / "root" / "bin" / "tool"
+    cached = tmp_path / "cached-tool"
+    os.link(script, cached)
+
+    relocate(release, str(release), str(tmp_path / "stable"))
+
+    assert str(tmp_path / "stable") in script.read_text(encoding="utf-8")
+    assert str(release) in cached.read_text(encoding="utf-8")
+
+
+def test_move_release_renames_manifest_and_enable_scripts(release, tmp_path):
+    destination = tmp_path / "prefix" / "2024.01.00-py311"
+
+    move_release(release, destination, copy=True)
+
+    assert release.exists()
+    assert (destination / "2024.01.00-py311").is_file()
+    assert not (destination / "bleeding").exists()
+    enable = (destination / "enable").read_text(encoding="utf-8")
+    assert "KOMODO_RELEASE=2024.01.00-py311" in enable
+    assert f"{destination}/root/bin" in enable
+    assert str(release) not in enable
+    assert os.path.exists(destination / "enable.csh")
+
+
+def test_move_release_refuses_existing_destination(release, tmp_path):
+    with pytest.raises(FileExistsError):
+        move_release(release, release.parent)
+
+
+def test_main_moves_release(release, capsys):
+    destination = release.parent / "stable"
+    main([str(release), str(destination)])
+
+    assert not release.exists()
+    assert (destination / "stable").is_file()
+    assert "rewrote" in capsys.readouterr().out
+
+
+def test_move_release_built_under_symlinked_prefix(release, tmp_path):
+    linked = tmp_path / "linked"
+    os.symlink(release.parent, linked)
+    built_root = linked / "bleeding" / "root"
+    (release / "root" / "lib" / "pkgconfig" / "linked.pc").write_text(
+        f"prefix={built_root}\n", encoding="utf-8"
+    )
+    destination = tmp_path / "stable"
+
+    move_release(linked / "bleeding", destination)
+
+    pkgconfig = destination / "root" / "lib" / "pkgconfig"
+    assert (pkgconfig / "linked.pc").read_text(encoding="utf-8") == (
+        f"prefix={destination}/root\n"
+    )
+    assert (
+        (pkgconfig / "lib.pc")
+        .read_text(encoding="utf-8")
+        .startswith(f"prefix={destination}/root\n")
+    )
+    assert not release.exists()
@@ -0,0 +1,140 @@
+import pytest
+from packaging.requirements import Requirement
+
+from komodo.requirements_cache import RequirementsCache
+from komodo.reverse_deps import ReverseDependencies, main
+
+RELEASE = {
+    "python": "3.11-builtin",
+    "numpy": "1.26.4",
+    "scipy": "1.14.0",
+    "pandas": "2.2.2",
+    "ert": "main",
+    "semeio": "1.0.0",
+    "pywin32": "306",
+    "tomli": "2.0.1",
+}
+REPOSITORY = {
+    "python": {"3.11-builtin": {"source": None, "make": "sh"}},
+    "numpy": {"1.26.4": {"source": "pypi", "make": "pip"}},
+    "scipy": {"1.14.0": {"source": "pypi", "make": "pip"}},
+    "pandas": {"2.2.2": {"source": "pypi", "make": "pip", "depends": ["numpy"]}},
+    "ert": {
+        "main": {
+            "source": "git://github.com/equinor/ert.git",
+            "make": "pip",
+            "depends": ["python", "pandas", "scipy"],
+        }
+    },
+    "semeio": {"1.0.0": {"source": "pypi", "make": "pip"}},
+    "pywin32": {"306": {"source": "pypi", "make": "pip"}},
+    "tomli": {"2.0.1": {"source": "pypi", "make": "pip"}},
+}
+METADATA = {
+    ("numpy", "1.26.4"): [],
+    ("scipy", "1.14.0"): ["numpy<2.3,>=1.23.5"],
+    ("pandas", "2.2.2"): ["numpy>=1.23.2", 'tomli; extra == "toml"'],
+    ("semeio", "1.0.0"): ["ert", 'pywin32; sys_platform == "win32"'],
+    ("pywin32", "306"): [],
+    ("tomli", "2.0.1"): [],
+}
+
+
+@pytest.fixture
+def cachefile(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = RequirementsCache(path, "3.11")
+    for (name, version), requires_dist in METADATA.items():
+        cache.put(name, version, requires_dist)
+    cache.close()
+    return path
+
+
+@pytest.fixture
+def index(cachefile):
+    return ReverseDependencies.from_release(
+        RELEASE, REPOSITORY, "3.11.9", cachefile=cachefile
+    )
+
+
+def test_dependents_are_transitive(index):
+    assert index.dependents("numpy") == {"scipy", "pandas", "ert", "semeio"}
+    assert index.dependents("ert") == {"semeio"}
+    assert index.dependents("semeio") == set()
+
+
+def test_markers_and_unrequested_extras_are_not_dependencies(index):
+    assert index.dependents("pywin32") == set()
+    assert index.dependents("tomli") == set()
+
+
+def test_impact_of_version_change(index):
+    impact = index.impact("numpy", "2.3.0")
+    assert impact.affected == {"scipy", "pandas", "ert", "semeio"}
+    assert impact.incompatible == {"scipy": Requirement("numpy<2.3,>=1.23.5")}
+    assert index.impact("numpy", "2.2.0").incompatible == {}
+
+
+def test_large_release_is_indexed():
+    versions = {f"pkg{i}": "1.0.0" for i in range(700)}
+    requirements = {
+        f"pkg{i}": [Requirement(f"pkg{i // 2}")] if i else [] for i in range(700)
+    }
+    index = ReverseDependencies(versions, requirements)
+    assert len(index.dependents("pkg0")) == 699
+    assert index.dependents("pkg349") == {"pkg698", "pkg699"}
+
+
+def test_main_prints_dependents_and_dot(tmp_path, cachefile, capsys):
+    release_file = tmp_path / "release.yml"
+    release_file.write_text(
+        "\n".join(f"{name}: '{version}'" for name, version in RELEASE.items()),
+        encoding="utf-8",
+    )
+    repository_file = tmp_path / "repository.yml"
+    repository_file.write_text(
+        "numpy:\n  1.26.4:\n    source: pypi\n    make: pip\n    maintainer: scout\n"
+        "scipy:\n  1.14.0:\n    source: pypi\n    make: pip\n    maintainer: scout\n",
+        encoding="utf-8",
+    )
+    arguments = [
+        str(release_file),
+        str(repository_file),
+        "--pkg",
+        "numpy",
+        "--python-version",
+        "3.11.9",
+        "--cachefile",
+        cachefile,
+    ]
+
+    main([*arguments, "--version", "2.3.0"])
+    assert capsys.readouterr().out == "scipy (requires numpy<2.3,>=1.23.5)\n"
+
+    main([*arguments, "--dot"])
+    assert capsys.readouterr().out == 'digraph "numpy" {\n  "scipy" -> "numpy";\n}\n'
+
+
+def test_main_writes_no_cache_unless_asked_to(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "release.yml").write_text("numpy: '1.26.4'\n", encoding="utf-8")
+    (tmp_path / "repository.yml").write_text(
+        "numpy:\n  1.26.4:\n    source: pypi\n    make: pip\n    maintainer: scout\n",
+        encoding="utf-8",
+    )
+
+    main(
+        [
+            "release.yml",
+            "repository.yml",
+            "--pkg",
+            "numpy",
+            "--python-version",
+            "3.11.9",
+        ]
+    )
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "release.yml",
+        "repository.yml",
+    ]
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from komodo.scheduler import build_order, run_in_dependency_order
+
+
+def test_build_order_detects_circular_dependencies():
+    with pytest.raises(ValueError, match="Circular dependencies between a, b"):
+        build_order({"a": {"b"}, "b": {"a"}, "c": set()})
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_packages_are_built_after_their_dependencies(workers):
+    graph = {"d": {"b", "c"}, "b": {"a"}, "c": {"a"}, "a": set()}
+    built = []
+    lock = threading.Lock()
+
+    def build_package(name):
+        with lock:
+            assert graph[name].issubset(built)
+        time.sleep(0.01)
+        with lock:
+            built.append(name)
+
+    run_in_dependency_order(graph, build_package, workers=workers)
+    assert built[0] == "a"
+    assert set(built[1:3]) == {"b", "c"}
+    assert built[3] == "d"
+
+
+def test_independent_packages_are_built_at_the_same_time():
+    graph = {name: set() for name in "abc"}
+    barrier = threading.Barrier(3, timeout=5)
+    run_in_dependency_order(graph, lambda _: barrier.wait(), workers=3)
+
+
+def test_failing_package_stops_scheduling_of_dependents():
+    graph = {"a": set(), "b": set(), "c": {"a"}}
+    built = []
+
+    def build_package(name):
+        if name == "a":
+            raise RuntimeError("build of a failed")
+        built.append(name)
+
+    with pytest.raises(RuntimeError, match="build of a failed"):
+        run_in_dependency_order(graph, build_package, workers=2)
+    assert "c" not in built
+
+
+def test_output_of_parallel_builds_is_not_interleaved(capsys):
+    graph = {name: set() for name in "ab"}
+    barrier = threading.Barrier(2, timeout=5)
+
+    def build_package(name):
+        print(f"start {name}")
+        barrier.wait()
+        print(f"end {name}")
+
+    run_in_dependency_order(graph, build_package, workers=2)
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(zip(lines[::2], lines[1::2])) == [
+        ("start a", "end a"),
+        ("start b", "end b"),
+    ]
@@ -0,0 +1,41 @@
+import subprocess
+
+import pytest
+
+from komodo import shell as shell_module
+from komodo.shell import shell
+
+
+def test_output_is_written_to_log_file(tmp_path, capsys):
+    log_file = tmp_path / "pkg-1.0.log"
+    output = shell(["seq", "0", "999"], log_file=str(log_file))
+    lines = log_file.read_text(encoding="utf-8").splitlines()
+    assert lines[0].endswith("> seq 0 999")
+    assert lines[1:] == [str(i) for i in range(1000)]
+    assert output.decode().split() == [
+        str(i) for i in range(1000 - shell_module.TAIL_LINES, 1000)
+    ]
+    assert "wrote 1000 lines" in capsys.readouterr().out
+
+
+def test_failure_reports_tail_of_log(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(shell_module, "TAIL_LINES", 2)
+    log_file = tmp_path / "pkg-1.0.log"
+    script = tmp_path / "build.sh"
+    script.write_text("echo one; echo two; echo three >&2; exit 3", encoding="utf-8")
+    with pytest.raises(subprocess.CalledProcessError) as err:
+        shell(["sh", str(script)], log_file=str(log_file))
+    assert err.value.returncode == 3
+    assert err.value.output == b"two\nthree\n"
+    assert "one" in log_file.read_text(encoding="utf-8")
+    assert "two\nthree" in capsys.readouterr().err
+
+
+def test_progress_lines_are_printed_while_command_is_silent(
+    tmp_path, monkeypatch, capsys
+):
+    monkeypatch.setattr(shell_module, "PROGRESS_INTERVAL", 0.1)
+    script = tmp_path / "build.sh"
+    script.write_text("echo compiling a.c; sleep 0.5", encoding="utf-8")
+    shell(["sh", str(script)], log_file=str(tmp_path / "pkg.log"))
+    assert "pkg.log: 1 lines after 0s, compiling a.c" in capsys.readouterr().out
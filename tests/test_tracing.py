@@ -0,0 +1,44 @@
+import json
+import threading
+
+from komodo.shell import shell
+from komodo.tracing import Tracer, tracer
+
+
+def test_nested_spans_are_written_as_trace_events(tmp_path):
+    trace = Tracer()
+    with trace.span("Building", category="phase"):
+        with trace.span("numpy (1.26.4)", category="package", make="sh"):
+            pass
+        with trace.span("scipy (1.11.0)", category="package"):
+            pass
+    trace.write(tmp_path / "trace.json")
+
+    events = json.loads((tmp_path / "trace.json").read_text(encoding="utf-8"))[
+        "traceEvents"
+    ]
+    spans = {e["name"]: e for e in events if e["ph"] == "X"}
+    assert set(spans) == {"Building", "numpy (1.26.4)", "scipy (1.11.0)"}
+    phase, package = spans["Building"], spans["numpy (1.26.4)"]
+    assert phase["ts"] <= package["ts"]
+    assert package["ts"] + package["dur"] <= phase["ts"] + phase["dur"]
+    assert package["args"] == {"make": "sh"}
+    assert [e["args"]["name"] for e in events if e["ph"] == "M"] == [
+        threading.current_thread().name
+    ]
+
+
+def test_durations_lists_spans_of_one_category_in_start_order():
+    trace = Tracer()
+    with trace.span("first"), trace.span("inner", category="package"):
+        pass
+    with trace.span("second"):
+        pass
+    assert [name for name, _ in trace.durations("phase")] == ["first", "second"]
+
+
+def test_subprocesses_are_traced_without_arguments():
+    tracer.reset()
+    shell("echo https://SECRET@example.com")
+    [(name, _)] = tracer.durations("subprocess")
+    assert name == "echo"
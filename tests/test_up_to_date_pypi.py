@@ -1,7 +1,10 @@
 import functools
+import json
 import os
 import pathlib
 import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import MagicMock
 
 import pytest
@@ -11,13 +14,19 @@ from ruamel.yaml import YAML
 
 from komodo import check_up_to_date_pypi
 from komodo.check_up_to_date_pypi import (
+    CompatibilityIndex,
     compatible_versions,
     get_pypi_packages,
+    get_upgrade_proposals_for_releases,
     get_upgrade_proposals_from_pypi,
     insert_upgrade_proposals,
+    load_release_folder,
+    load_release_matrix,
     run_check_up_to_date,
     yaml_parser,
 )
+from komodo.pypi_snapshot import PypiSnapshot
+from tests import _get_test_root
 
 
 @pytest.mark.parametrize(
@@ -177,7 +186,7 @@ def test_run(monkeypatch):
     compatible_versions = MagicMock(return_value=["2.0.0"])
     monkeypatch.setattr(check_up_to_date_pypi, "get_pypi_info", response_mock)
     monkeypatch.setattr(
-        check_up_to_date_pypi,
+        check_up_to_date_pypi.CompatibilityIndex,
         "compatible_versions",
         compatible_versions,
     )
@@ -271,7 +280,9 @@ def test_check_up_to_date_file_output(monkeypatch, tmpdir, capsys):
                 ],
             },
         }
-        monkeypatch.setattr(requests, "get", MagicMock(return_value=request_mock))
+        monkeypatch.setattr(
+            requests.Session, "get", MagicMock(return_value=request_mock)
+        )
 
         run_check_up_to_date(
             f"{base_path}/release_file.yml",
@@ -440,7 +451,9 @@ def test_run_up_to_date(
             fout.write(str(release))
         request_mock = MagicMock()
         request_mock.json.return_value = request_json
-        monkeypatch.setattr(requests, "get", MagicMock(return_value=request_mock))
+        monkeypatch.setattr(
+            requests.Session, "get", MagicMock(return_value=request_mock)
+        )
 
         check_up_to_date_pypi.main()
         print_message = capsys.readouterr().out
@@ -516,7 +529,7 @@ def test_upgrade_type_grouping(release_file_content, tmpdir, monkeypatch, capsys
             fout.write(release_file_content)
         folder_name = os.getcwd()
 
-        def side_effect(url: str, timeout):
+        def side_effect(url: str, timeout, **kwargs):
             if "dummy_package_patch" in url.split("/"):
                 request_mock = MagicMock()
                 request_json = {
@@ -563,7 +576,7 @@ def test_upgrade_type_grouping(release_file_content, tmpdir, monkeypatch, capsys
             "new_file",
         ]
         monkeypatch.setattr(sys, "argv", arguments)
-        monkeypatch.setattr(requests, "get", MagicMock(side_effect=side_effect))
+        monkeypatch.setattr(requests.Session, "get", MagicMock(side_effect=side_effect))
         check_up_to_date_pypi.main()
         system_print = capsys.readouterr().out
 
@@ -641,7 +654,7 @@ def test_upgrade_ignore_flag(
             fout.write(release_file_content)
         folder_name = os.getcwd()
 
-    def side_effect(url: str, timeout):
+    def side_effect(url: str, timeout, **kwargs):
         if "dummy_package_patch" in url.split("/"):
             request_mock = MagicMock()
             request_json = {
@@ -700,7 +713,7 @@ def test_upgrade_ignore_flag(
         ignore_argument,
     ]
     monkeypatch.setattr(sys, "argv", arguments)
-    monkeypatch.setattr(requests, "get", MagicMock(side_effect=side_effect))
+    monkeypatch.setattr(requests.Session, "get", MagicMock(side_effect=side_effect))
 
     check_up_to_date_pypi.main()
     system_exit_message = capsys.readouterr().out
@@ -735,7 +748,7 @@ def create_stub_files(tmpdir) -> str:
         return os.getcwd()
 
 
-def side_effect(url: str, timeout, target_platform):
+def side_effect(url: str, timeout, target_platform, **kwargs):
     request_mock = MagicMock()
     if "dummy_package_compatible_upgrade_exists" in url.split("/"):
         request_json = {
@@ -783,7 +796,7 @@ def test_suggestor_filters_out_os_incompatible_versions_for_host_platform_by_def
     ]
     monkeypatch.setattr(sys, "argv", arguments)
     monkeypatch.setattr(
-        requests,
+        requests.Session,
         "get",
         MagicMock(
             side_effect=functools.partial(side_effect, target_platform=target_platform)
@@ -818,7 +831,7 @@ def test_suggestor_filters_out_os_incompatible_versions_on_specific_platform_fla
     ]
     monkeypatch.setattr(sys, "argv", arguments)
     monkeypatch.setattr(
-        requests,
+        requests.Session,
         "get",
         MagicMock(
             side_effect=functools.partial(side_effect, target_platform=target_platform)
@@ -846,7 +859,7 @@ def test_suggestor_shows_platform_independent_packages_and_source_distributions(
     ]
     monkeypatch.setattr(sys, "argv", arguments)
 
-    def side_effect(url: str, timeout):
+    def side_effect(url: str, timeout, **kwargs):
         request_mock = MagicMock()
         if "dummy_package_compatible_upgrade_exists" in url.split("/"):
             request_json = {
@@ -871,7 +884,7 @@ def test_suggestor_shows_platform_independent_packages_and_source_distributions(
         return request_mock
 
     monkeypatch.setattr(
-        requests,
+        requests.Session,
         "get",
         MagicMock(side_effect=side_effect),
     )
@@ -933,7 +946,7 @@ def test_upgrade_specific_versions_flag(
             fout.write(release_file_content)
         folder_name = os.getcwd()
 
-    def side_effect(url: str, timeout):
+    def side_effect(url: str, timeout, **kwargs):
         if "dummy_package_patch" in url.split("/"):
             request_mock = MagicMock()
             request_json = {
@@ -973,7 +986,7 @@ def test_upgrade_specific_versions_flag(
         flag,
     ]
     monkeypatch.setattr(sys, "argv", arguments)
-    monkeypatch.setattr(requests, "get", MagicMock(side_effect=side_effect))
+    monkeypatch.setattr(requests.Session, "get", MagicMock(side_effect=side_effect))
 
     check_up_to_date_pypi.main()
     system_exit_message = capsys.readouterr().out
@@ -981,3 +994,298 @@ def test_upgrade_specific_versions_flag(
         assert message in system_exit_message
     for message in unexpected_messages:
         assert message not in system_exit_message
+
+
+class _PypiJsonHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        package = self.path.split("/")[2]
+        body = json.dumps({"releases": {"1.0.0": []}, "name": package}).encode()
+        etag = f'"{package}-1"'
+        with self.server.lock:
+            self.server.requests.append((package, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(ThreadingHTTPServer):
+    # Accept all the concurrent connections without the client retrying
+    request_queue_size = 64
+
+
+def test_get_pypi_info_revalidates_cached_responses(monkeypatch, tmp_path):
+    httpd = _Server(("127.0.0.1", 0), _PypiJsonHandler)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        check_up_to_date_pypi,
+        "PYPI_JSON_URL",
+        f"http://127.0.0.1:{httpd.server_address[1]}/pypi/{{package}}/json",
+    )
+    packages = [f"package_{i}" for i in range(20)]
+    try:
+        first = check_up_to_date_pypi.get_pypi_info(packages, cache_dir=tmp_path)
+        second = check_up_to_date_pypi.get_pypi_info(packages, cache_dir=tmp_path)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    for responses in (first, second):
+        assert [package for package, _ in responses] == packages
+        assert all(response.ok for _, response in responses)
+        assert [response.json()["name"] for _, response in responses] == packages
+    assert sorted(httpd.requests[20:]) == sorted(
+        (package, f'"{package}-1"') for package in packages
+    )
+
+
+@pytest.mark.parametrize(
+    "cached",
+    ["not json", "[]", '{"content": "{}"}', '{"etag": null, "content": "{}"}'],
+)
+def test_get_pypi_info_ignores_unusable_cache_files(monkeypatch, tmp_path, cached):
+    (tmp_path / "package.json").write_text(cached, encoding="utf-8")
+    httpd = _Server(("127.0.0.1", 0), _PypiJsonHandler)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        check_up_to_date_pypi,
+        "PYPI_JSON_URL",
+        f"http://127.0.0.1:{httpd.server_address[1]}/pypi/{{package}}/json",
+    )
+    try:
+        ((_, response),) = check_up_to_date_pypi.get_pypi_info(
+            ["package"], cache_dir=tmp_path
+        )
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert httpd.requests == [("package", None)]
+    assert response.json()["name"] == "package"
+    cached = json.loads((tmp_path / "package.json").read_text(encoding="utf-8"))
+    assert cached["etag"] == '"package-1"'
+
+
+def test_upgrade_proposals_from_snapshot(monkeypatch, tmp_path):
+    pypi_json = {
+        "releases": {
+            "2.0.0": [
+                {
+                    "filename": "dummy_package-2.0.0-py3-none-any.whl",
+                    "requires_python": ">=3.8",
+                    "yanked": False,
+                    "digests": {"sha256": "0" * 64},
+                }
+            ],
+            "3.0.0": [{"filename": "dummy_package-3.0.0.tar.gz", "yanked": True}],
+        }
+    }
+    response = MagicMock(ok=True)
+    response.json.return_value = pypi_json
+    monkeypatch.setattr(
+        check_up_to_date_pypi,
+        "get_pypi_info",
+        MagicMock(return_value=[("dummy_package", response)]),
+    )
+    (tmp_path / "repository.yml").write_text(
+        "dummy_package:\n  1.0.0:\n    source: pypi\n    make: pip\n"
+        "    maintainer: scout\n",
+        encoding="utf-8",
+    )
+    check_up_to_date_pypi.snapshot_main(
+        [str(tmp_path / "repository.yml"), str(tmp_path / "snapshot.json.gz")]
+    )
+    snapshot = PypiSnapshot.load(tmp_path / "snapshot.json.gz")
+    assert snapshot.releases("Dummy-Package")["2.0.0"] == [
+        {
+            "filename": "dummy_package-2.0.0-py3-none-any.whl",
+            "requires_python": ">=3.8",
+        }
+    ]
+
+    monkeypatch.setattr(
+        check_up_to_date_pypi, "get_pypi_info", MagicMock(side_effect=AssertionError)
+    )
+    assert get_upgrade_proposals_from_pypi(
+        {"dummy_package": "1.0.0"},
+        {"dummy_package": {"1.0.0": {"source": "pypi"}}},
+        "3.11.9",
+        "linux",
+        snapshot=snapshot,
+    ) == {"dummy_package": {"previous": "1.0.0", "suggested": "2.0.0"}}
+    with pytest.raises(ValueError, match="not in the pypi snapshot"):
+        get_upgrade_proposals_from_pypi(
+            {"other_package": "1.0.0"},
+            {"other_package": {"1.0.0": {"source": "pypi"}}},
+            "3.11.9",
+            "linux",
+            snapshot=snapshot,
+        )
+
+
+def test_snapshot_keeps_creation_time_while_metadata_is_unchanged(tmp_path):
+    path = tmp_path / "snapshot.json.gz"
+    releases = {"1.0.0": [{"filename": "pkg-1.0.0.tar.gz"}]}
+    PypiSnapshot({"pkg": releases}, created="2024-01-01T00:00:00+00:00").write(path)
+    content = path.read_bytes()
+
+    PypiSnapshot({"pkg": releases}).write(path)
+    assert path.read_bytes() == content
+
+    releases["2.0.0"] = [{"filename": "pkg-2.0.0.tar.gz"}]
+    PypiSnapshot({"pkg": releases}, created="2024-02-01T00:00:00+00:00").write(path)
+    assert PypiSnapshot.load(path).created == "2024-02-01T00:00:00+00:00"
+
+
+def test_compatibility_index_checks_wheel_tags():
+    index = CompatibilityIndex(
+        {
+            "1.0.0": [{"filename": "pkg-1.0.0.tar.gz"}],
+            "1.1.0": [
+                {"filename": "pkg-1.1.0-cp38-cp38-manylinux_2_17_x86_64.whl"},
+                {"filename": "pkg-1.1.0-cp311-cp311-macosx_11_0_arm64.whl"},
+            ],
+            "1.2.0": [
+                {"filename": "pkg-1.2.0-cp39-abi3-manylinux_2_28_x86_64.whl"},
+                {"filename": "pkg-1.2.0-cp39-abi3-win_amd64.whl"},
+            ],
+            "1.3.0": [{"filename": "pkg-1.3.0-py3-none-any.whl", "yanked": True}],
+            "2.0.0rc1": [{"filename": "pkg-2.0.0rc1-py3-none-any.whl"}],
+        }
+    )
+    parse = version.parse
+    assert index.compatible_versions("3.8.18", "linux") == [
+        parse("1.0.0"),
+        parse("1.1.0"),
+    ]
+    assert index.compatible_versions("3.11.9", "linux") == [
+        parse("1.0.0"),
+        parse("1.2.0"),
+    ]
+    assert index.compatible_versions("3.11.9", "darwin") == [
+        parse("1.0.0"),
+        parse("1.1.0"),
+    ]
+    assert index.compatible_versions("3.12.1", "win32") == [
+        parse("1.0.0"),
+        parse("1.2.0"),
+    ]
+
+
+def test_compatibility_indices_are_reused(monkeypatch):
+    response = MagicMock(ok=True)
+    response.json.return_value = {
+        "releases": {"2.0.0": [{"filename": "pkg-2.0.0-py3-none-any.whl"}]}
+    }
+    get_pypi_info = MagicMock(return_value=[("pkg", response)])
+    monkeypatch.setattr(check_up_to_date_pypi, "get_pypi_info", get_pypi_info)
+    indices = {}
+    for python_version in ["3.8.18", "3.11.9"]:
+        assert get_upgrade_proposals_from_pypi(
+            {"pkg": "1.0.0"},
+            {"pkg": {"1.0.0": {"source": "pypi"}}},
+            python_version,
+            "linux",
+            indices=indices,
+        ) == {"pkg": {"previous": "1.0.0", "suggested": "2.0.0"}}
+    assert get_pypi_info.call_count == 1
+    assert list(indices) == ["pkg"]
+
+
+def test_releases_in_folder_are_checked_with_one_fetch_per_package(
+    tmp_path, monkeypatch, capsys
+):
+    releases = {
+        "2024.01.00-py38-rhel8": {"numpy": "1.24.4", "pytz": "2023.3"},
+        "2024.01.00-py311-rhel8": {"numpy": "1.26.4", "pytz": "2023.3"},
+    }
+    release_folder = tmp_path / "releases"
+    release_folder.mkdir()
+    for release_name, release in releases.items():
+        (release_folder / f"{release_name}.yml").write_text(
+            "".join(f"{name}: '{version}'\n" for name, version in release.items()),
+            encoding="utf-8",
+        )
+    repository_file = tmp_path / "repository.yml"
+    repository_file.write_text(
+        "numpy:\n"
+        "  1.26.4:\n    source: pypi\n    make: pip\n    maintainer: scout\n"
+        "  1.24.4:\n    source: pypi\n    make: pip\n    maintainer: scout\n"
+        "pytz:\n"
+        "  '2023.3':\n    source: pypi\n    make: pip\n    maintainer: scout\n",
+        encoding="utf-8",
+    )
+    pypi_releases = {
+        "numpy": {
+            "1.24.4": [{"requires_python": ">=3.8", "filename": "numpy-1.24.4.tar.gz"}],
+            "1.26.4": [{"requires_python": ">=3.9", "filename": "numpy-1.26.4.tar.gz"}],
+            "2.2.0": [{"requires_python": ">=3.10", "filename": "numpy-2.2.0.tar.gz"}],
+        },
+        "pytz": {"2023.3": [{"filename": "pytz-2023.3.tar.gz"}]},
+    }
+    fetched = []
+
+    def get(url, **kwargs):
+        package = url.split("/")[-2]
+        fetched.append(package)
+        response = MagicMock()
+        response.json.return_value = {"releases": pypi_releases[package]}
+        return response
+
+    monkeypatch.setattr(requests.Session, "get", MagicMock(side_effect=get))
+
+    loaded = load_release_folder(str(release_folder), "3.12")
+    assert {name: python for name, (_, python) in loaded.items()} == {
+        "2024.01.00-py311-rhel8": "3.11",
+        "2024.01.00-py38-rhel8": "3.8",
+    }
+    repository = yaml_parser().load(repository_file.read_text(encoding="utf-8"))
+    proposals = get_upgrade_proposals_for_releases(loaded, repository, "linux")
+    assert sorted(fetched) == ["numpy", "pytz"]
+    assert proposals == {
+        "2024.01.00-py311-rhel8": {
+            "numpy": {"previous": "1.26.4", "suggested": "2.2.0"}
+        },
+        "2024.01.00-py38-rhel8": {},
+    }
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["", str(release_folder), str(repository_file), "--no-cache"],
+    )
+    check_up_to_date_pypi.main()
+    output = capsys.readouterr().out
+    assert (
+        "2024.01.00-py38-rhel8 (python version: 3.8):\nAll packages up to date!!!"
+        in (output)
+    )
+    assert "numpy not at latest pypi version: 2.2.0, is at: 1.26.4" in output
+
+
+def test_load_release_matrix():
+    releases = load_release_matrix(
+        os.path.join(_get_test_root(), "data/test_release_matrix.yml"),
+        {"rhel": ["8"], "py": ["38", "311"]},
+    )
+    assert list(releases) == [
+        "test_release_matrix-py38-rhel8",
+        "test_release_matrix-py311-rhel8",
+    ]
+    release, python_version = releases["test_release_matrix-py311-rhel8"]
+    assert python_version == "3.11"
+    assert release["lib1"] == "1.2.6+builtin"
@@ -0,0 +1,125 @@
+from pathlib import Path
+from unittest.mock import patch
+
+from packaging.tags import Tag
+
+from komodo import wheelhouse as wheelhouse_module
+from komodo.fetch import fetch
+from komodo.wheelhouse import Wheelhouse, pip_compatible_tags
+
+PIP_DEBUG_OUTPUT = b"""pip 24.0 from /usr/lib/python3.11/site-packages/pip (python 3.11)
+sys.version: 3.11.7
+Compatible tags: 3
+  cp311-cp311-manylinux_2_17_x86_64
+  cp311-abi3-manylinux_2_17_x86_64
+  py3-none-any
+"""
+
+
+def _pip_download(filenames, commands):
+    """A stand-in for shell() writing filenames to the --dest directory."""
+
+    def shell(cmd, *args, **kwargs):
+        commands.append(cmd)
+        dest = next((arg for arg in cmd if arg.startswith("--dest ")), None)
+        if dest is None:
+            return b""
+        for filename in filenames:
+            (Path(dest.split(" ", 1)[1]) / filename).touch()
+        return b""
+
+    return shell
+
+
+def test_pip_compatible_tags():
+    with patch.object(wheelhouse_module, "shell", return_value=PIP_DEBUG_OUTPUT):
+        tags = pip_compatible_tags("pip")
+    assert Tag("cp311", "cp311", "manylinux_2_17_x86_64") in tags
+    assert Tag("py3", "none", "any") in tags
+    assert len(tags) == 3
+
+    with patch.object(wheelhouse_module, "shell", return_value=b""):
+        assert pip_compatible_tags("pip") is None
+
+
+def test_missing_only_counts_compatible_distributions(tmp_path):
+    wheelhouse = Wheelhouse(tmp_path)
+    for filename in [
+        "numpy-1.26.4-cp312-cp312-manylinux_2_17_x86_64.whl",
+        "PyYAML-6.0.1.tar.gz",
+        "six-1.16.0-py2.py3-none-any.whl",
+        "not-a-distribution.txt",
+    ]:
+        (wheelhouse.files / filename).touch()
+    requirements = ["numpy==1.26.4", "pyyaml==6.0.1", "six==1.16.0", "attrs==23.2.0"]
+    tags = {Tag("cp311", "cp311", "manylinux_2_17_x86_64"), Tag("py3", "none", "any")}
+
+    assert wheelhouse.missing(requirements) == ["attrs==23.2.0"]
+    assert wheelhouse.missing(requirements, tags) == ["numpy==1.26.4", "attrs==23.2.0"]
+
+
+def test_missing_includes_requirements_on_invalid_versions(tmp_path):
+    wheelhouse = Wheelhouse(tmp_path)
+    (wheelhouse.files / "six-1.16.0-py2.py3-none-any.whl").touch()
+
+    assert wheelhouse.missing(["six==1.16.0", "legacy==1.0-custom-build"]) == [
+        "legacy==1.0-custom-build"
+    ]
+
+
+def test_download_adds_files_and_writes_simple_index(tmp_path):
+    wheelhouse = Wheelhouse(tmp_path)
+    commands = []
+    filenames = ["PyYAML-6.0.1.tar.gz", "six-1.16.0-py2.py3-none-any.whl"]
+    with patch.object(wheelhouse_module, "shell", _pip_download(filenames, commands)):
+        wheelhouse.download(["pyyaml==6.0.1", "six==1.16.0"], pip="/bin/pip")
+
+    assert commands[0][:3] == ["/bin/pip", "download", "--no-deps"]
+    assert sorted(p.name for p in wheelhouse.files.iterdir()) == sorted(filenames)
+    assert list((tmp_path / "tmp").iterdir()) == []
+
+    root_page = (wheelhouse.simple / "index.html").read_text(encoding="utf-8")
+    assert '<a href="pyyaml/">pyyaml</a>' in root_page
+    assert '<a href="six/">six</a>' in root_page
+    project_page = (wheelhouse.simple / "pyyaml" / "index.html").read_text(
+        encoding="utf-8"
+    )
+    assert '<a href="../../files/PyYAML-6.0.1.tar.gz">' in project_page
+    assert wheelhouse.index_url == f"{wheelhouse.simple.as_uri()}/"
+
+
+def test_fetch_only_downloads_missing_pypi_packages(tmp_path):
+    wheelhouse = Wheelhouse(tmp_path / "wheelhouse")
+    (wheelhouse.files / "six-1.16.0-py2.py3-none-any.whl").touch()
+    repositories = {
+        name: {
+            version: {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+                "depends": [],
+            },
+        }
+        for name, version in [("six", "1.16.0"), ("pyyaml", "6.0.1")]
+    }
+    commands = []
+    shell = _pip_download(["PyYAML-6.0.1.tar.gz"], commands)
+    with patch.object(wheelhouse_module, "shell", shell):
+        fetch(
+            {"six": "1.16.0", "pyyaml": "6.0.1"},
+            repositories,
+            str(tmp_path / "downloads"),
+            wheelhouse=wheelhouse,
+        )
+        assert commands[-1][-1] == "pyyaml==6.0.1"
+        assert len(commands) == 2  # pip debug and pip download
+
+        commands.clear()
+        fetch(
+            {"six": "1.16.0", "pyyaml": "6.0.1"},
+            repositories,
+            str(tmp_path / "downloads2"),
+            wheelhouse=wheelhouse,
+        )
+        assert len(commands) == 1  # only pip debug
+    assert list((tmp_path / "downloads").iterdir()) == []